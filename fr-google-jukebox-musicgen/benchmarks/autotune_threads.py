@@ -0,0 +1,107 @@
+"""Find the best generation slots x torch threads per slot for this machine.
+
+For every combination fitting in the cores, runs as many concurrent requests as there are
+slots through the service (as benchmark_musicgen does) and measures the throughput (tokens
+per second of all the streams together) and the latency (time to first audio). Only the
+combinations whose streams keep up with playback (real-time factor below 1) are eligible,
+unless none does. The best combination for each objective is written to the report as
+environment settings, and optionally to a .env file read by the service on startup:
+
+    python -m benchmarks.autotune_threads --duration 10 --env-file .env --objective latency
+
+Runs on the tiny offline model by default, give `--model` (a local checkpoint or a hub
+name, like MODEL_NAME) to tune for a real one. Run it from fr-google-jukebox-musicgen.
+"""
+
+import argparse
+import contextlib
+import json
+import sys
+import tempfile
+import warnings
+
+import torch
+from transformers import MusicgenForConditionalGeneration, MusicgenProcessor
+
+from benchmarks.benchmark_musicgen import build_generator, run_case
+from benchmarks.tiny_musicgen import build_offline_processor, build_tiny_model
+from service.cpu_affinity import available_cores
+
+
+def candidates(cores: int, max_slots: int):
+    """(slots, threads per slot) pairs using at most `cores` threads: powers of two and
+    the number of cores itself."""
+    sizes = sorted({2**i for i in range(cores.bit_length()) if 2**i <= cores} | {cores})
+    return [
+        (slots, threads)
+        for slots in sizes
+        if slots <= max_slots
+        for threads in sizes
+        if slots * threads <= cores
+    ]
+
+
+def best(results, objective: str):
+    eligible = [r for r in results if r["real_time_factor"] < 1] or results
+    if objective == "throughput":
+        result = max(eligible, key=lambda r: r["tokens_per_s"])
+    else:
+        result = min(eligible, key=lambda r: r["time_to_first_audio_s"])
+    return {
+        "GENERATION_CONCURRENCY": str(result["concurrency"]),
+        "TORCH_THREADS_PER_SLOT": str(result["torch_threads_per_slot"]),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--model", help="Checkpoint to tune for instead of the tiny model")
+    parser.add_argument("--duration", type=float, default=10.0)
+    parser.add_argument("--play-steps", default="adaptive")
+    parser.add_argument("--cores", type=int, default=len(available_cores()))
+    parser.add_argument("--max-slots", type=int, default=8)
+    parser.add_argument("--warmup-runs", type=int, default=1)
+    parser.add_argument("--output", default="autotune.json", help="JSON report")
+    parser.add_argument("--env-file", help="Write the best settings to this .env file")
+    parser.add_argument("--objective", choices=("throughput", "latency"), default="throughput")
+    args = parser.parse_args()
+
+    warnings.filterwarnings("ignore")
+    if args.model:
+        model = MusicgenForConditionalGeneration.from_pretrained(args.model).eval()
+        processor = MusicgenProcessor.from_pretrained(args.model)
+    else:
+        model, processor = build_tiny_model(), build_offline_processor()
+
+    results = []
+    # the service logs to stdout, only the report is printed there
+    with tempfile.TemporaryDirectory() as storage_dir, contextlib.redirect_stdout(sys.stderr):
+        for slots, threads in candidates(args.cores, args.max_slots):
+            generator = build_generator(slots, storage_dir, model, processor, threads)
+            for _ in range(args.warmup_runs):
+                run_case(generator, args.duration, args.play_steps, slots)
+            result = run_case(generator, args.duration, args.play_steps, slots)
+            print(json.dumps(result))
+            results.append(result)
+
+    report = {
+        "model": args.model or "tiny-random",
+        "torch": torch.__version__,
+        "cores": args.cores,
+        "duration_s": args.duration,
+        "throughput": best(results, "throughput"),
+        "latency": best(results, "latency"),
+        "results": results,
+    }
+    with open(args.output, "w") as f:
+        f.write(json.dumps(report, indent=2))
+    print(json.dumps({"throughput": report["throughput"], "latency": report["latency"]}))
+
+    if args.env_file:
+        with open(args.env_file, "a") as f:
+            for name, value in report[args.objective].items():
+                f.write(f"{name}={value}\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+"""Benchmark of the streamed output formats: encoder CPU time against bytes saved.
+
+Encodes a track chunk by chunk with every output format, the way the service streams it,
+and compares the CPU time and the size with the int16 WAV stream. Run it from
+fr-google-jukebox-musicgen:
+
+    python -m benchmarks.benchmark_encoders --duration 30 --chunk-s 1
+
+Without `--input` the track is synthetic: a few harmonics with vibrato and noise, closer
+to music than a pure tone for the encoders. `--input` takes a WAV file instead, for
+example a track generated by the service.
+"""
+
+import argparse
+import json
+import time
+import wave
+
+import numpy as np
+
+from service.audio_encoder import OUTPUT_FORMATS, StreamingAudioEncoder, get_bitrate
+from service.pcm import PcmEncoder, wav_header
+
+
+def synthetic_track(duration_s: float, sample_rate: int, seed: int = 0) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(duration_s * sample_rate)) / sample_rate
+    phase = 2 * np.pi * 220 * t + 3 * np.sin(2 * np.pi * 5 * t)
+    audio = sum(np.sin(k * phase) / k for k in range(1, 6))
+    audio = audio * (0.5 + 0.5 * np.sin(2 * np.pi * 0.5 * t) ** 2)
+    audio += 0.05 * rng.standard_normal(t.shape[0])
+    return (0.4 * audio / np.abs(audio).max()).astype(np.float32)
+
+
+def read_track(path: str):
+    with wave.open(path, "rb") as f:
+        if f.getsampwidth() != 2:
+            raise ValueError("Only int16 WAV files are supported")
+        frames = np.frombuffer(f.readframes(f.getnframes()), dtype=np.int16)
+        # keep the first channel, the service streams mono
+        audio = frames.reshape(-1, f.getnchannels())[:, 0]
+        return audio.astype(np.float32) / 32768, f.getframerate()
+
+
+def encode(output_format: str, audio: np.ndarray, sample_rate: int, chunk_size: int):
+    """Bytes and CPU seconds of the stream, and the delay before its first byte."""
+    start_cpu = time.process_time()
+    first_byte_s = None
+    size = 0
+    if output_format == "wav":
+        encoder = PcmEncoder("int16")
+        size += len(wav_header(sample_rate))
+    else:
+        encoder = StreamingAudioEncoder(
+            output_format, sample_rate, bitrate=get_bitrate(output_format)
+        )
+
+    for offset in range(0, audio.shape[0], chunk_size):
+        data = encoder.encode(audio[offset : offset + chunk_size])
+        if data and first_byte_s is None:
+            # seconds of audio the client waits for before it gets anything
+            first_byte_s = (offset + chunk_size) / sample_rate
+        size += len(data)
+    if output_format != "wav":
+        size += len(encoder.close())
+    return size, time.process_time() - start_cpu, first_byte_s
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--input", help="int16 WAV file to encode instead of the synthetic track")
+    parser.add_argument("--duration", type=float, default=30.0)
+    parser.add_argument("--sample-rate", type=int, default=32000)
+    parser.add_argument("--chunk-s", type=float, default=1.0)
+    parser.add_argument("--formats", nargs="+", default=list(OUTPUT_FORMATS))
+    parser.add_argument("--output", help="Write the JSON report to this file instead of stdout")
+    args = parser.parse_args()
+
+    if args.input:
+        audio, sample_rate = read_track(args.input)
+    else:
+        sample_rate = args.sample_rate
+        audio = synthetic_track(args.duration, sample_rate)
+    duration_s = audio.shape[0] / sample_rate
+    chunk_size = int(args.chunk_s * sample_rate)
+
+    report = {
+        "input": args.input or "synthetic",
+        "duration_s": duration_s,
+        "sample_rate": sample_rate,
+        "chunk_s": args.chunk_s,
+        "results": [],
+    }
+    wav_bytes = None
+    for output_format in args.formats:
+        # the first stream pays for loading the codec, it isn't timed
+        encode(output_format, audio[:chunk_size], sample_rate, chunk_size)
+        size, cpu_s, first_byte_s = encode(output_format, audio, sample_rate, chunk_size)
+        if output_format == "wav":
+            wav_bytes = size
+        report["results"].append(
+            {
+                "format": output_format,
+                "bytes": size,
+                "kbit_per_s": size * 8 / duration_s / 1000,
+                # encoder CPU seconds per second of audio
+                "cpu_real_time_factor": cpu_s / duration_s,
+                "first_byte_after_s": first_byte_s,
+            }
+        )
+
+    # size relative to the int16 WAV stream, and CPU spent for every MB it saves
+    wav_bytes = wav_bytes or audio.shape[0] * 2
+    for result in report["results"]:
+        result["size_ratio"] = result["bytes"] / wav_bytes
+        saved_mb = (wav_bytes - result["bytes"]) / 10**6
+        cpu_s = result["cpu_real_time_factor"] * duration_s
+        result["cpu_ms_per_mb_saved"] = 1000 * cpu_s / saved_mb if saved_mb > 0 else None
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,242 @@
+"""Offline benchmark of the MusicGen streaming service.
+
+Runs MusigGenGenerator end to end (queue, token generation, decoding, WAV encoding and the
+upload to a local directory) on a tiny randomly initialised MusicGen, so it needs neither a
+GPU nor a download. Run it from fr-google-jukebox-musicgen:
+
+    python -m benchmarks.benchmark_musicgen --durations 5 10 --play-steps adaptive 2 \
+        --concurrency 2
+
+`--play-steps` takes fixed chunk sizes in seconds, or `adaptive` for the chunk schedule
+configured by CHUNK_FIRST_S, CHUNK_GROWTH and CHUNK_MAX_S (or by the preset).
+
+`--presets draft standard studio` runs every case with each preset, on the model given
+with `--model` for all of them. `--write-presets presets.json` writes the presets with
+their measured latency and real-time factor, for the PRESETS_FILE of the service.
+
+The service settings (DECODE_MODE, DECODE_WORKER, BATCH_MAX_SIZE, ...) are read from the
+environment as usual and recorded in the JSON report.
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import resource
+import sys
+import tempfile
+import time
+import warnings
+from threading import Thread
+
+import torch
+from transformers import MusicgenForConditionalGeneration, MusicgenProcessor
+
+from benchmarks.tiny_musicgen import build_offline_processor, build_tiny_model
+from service.cpu_affinity import available_cores
+
+SERVICE_SETTINGS = (
+    "DECODE_MODE",
+    "DECODE_CONTEXT_S",
+    "DECODE_OVERLAP_S",
+    "DECODE_WORKER",
+    "CHUNK_FIRST_S",
+    "CHUNK_GROWTH",
+    "CHUNK_MAX_S",
+    "BATCH_MAX_SIZE",
+    "BATCH_WINDOW_S",
+    "TORCH_THREADS_PER_SLOT",
+    "CPU_PRECISION",
+    "PRESETS_FILE",
+    "DEFAULT_PRESET",
+)
+
+PROMPTS = [
+    "chill lofi beat with piano",
+    "energetic techno track with heavy bass",
+    "calm ambient music with soft strings",
+    "upbeat funk song with guitar and drums",
+]
+
+
+def build_generator(
+    concurrency: int, storage_dir: str, model=None, processor=None, threads_per_slot: int = 0
+):
+    """A generator running the given model, the tiny one by default."""
+    # every request is generated, nothing is served from the cache
+    os.environ.update(
+        STORAGE_BACKEND="local",
+        LOCAL_STORAGE_DIR=storage_dir,
+        CACHE_MAX_MB="0",
+        GENERATION_CONCURRENCY=str(concurrency),
+        GENERATION_QUEUE_DEPTH=str(concurrency),
+        TORCH_THREADS_PER_SLOT=str(threads_per_slot),
+    )
+    from service.musicgen_generator import MusigGenGenerator
+
+    generator = MusigGenGenerator()
+    if model is None:
+        model, processor = build_tiny_model(), build_offline_processor()
+    generator.load(model=model, processor=processor)
+    return generator
+
+
+def run_request(generator, index, duration, play_steps_s, result, preset=None):
+    from service.musicgen_stream import ChunkSchedule
+
+    schedule = None if play_steps_s == "adaptive" else ChunkSchedule.fixed(float(play_steps_s))
+    start_time = time.perf_counter()
+    first_audio_s = None
+    size = 0
+    for chunk in generator.generate_audio_stream(
+        uuid=f"benchmark-{index}",
+        text_prompt=PROMPTS[index % len(PROMPTS)],
+        audio_length_in_s=duration,
+        schedule=schedule,
+        seed=index,
+        preset=generator.get_preset(preset),
+    ):
+        if first_audio_s is None:
+            first_audio_s = time.perf_counter() - start_time
+        size += len(chunk)
+    result.update(
+        time_to_first_audio_s=first_audio_s,
+        elapsed_s=time.perf_counter() - start_time,
+        bytes=size,
+    )
+
+
+def run_case(generator, duration, play_steps_s, concurrency, preset=None):
+    from service.metrics import metrics
+
+    before = metrics.snapshot()
+    results = [{} for _ in range(concurrency)]
+    threads = [
+        Thread(
+            target=run_request,
+            args=(generator, i, duration, play_steps_s, results[i], preset),
+        )
+        for i in range(concurrency)
+    ]
+    start_time = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall_s = time.perf_counter() - start_time
+
+    # the generation jobs can outlive their streams, the next case starts on an idle pool
+    while generator.generation_pool.in_flight:
+        time.sleep(0.01)
+    pool_busy_s = time.perf_counter() - start_time
+
+    after = metrics.snapshot()
+    stage = {
+        name: after.get(f"pipeline_{name}_s", 0.0) - before.get(f"pipeline_{name}_s", 0.0)
+        for name in ("generate", "decode", "audio")
+    }
+    tokens = concurrency * int(duration * generator.frame_rate)
+
+    return {
+        "preset": generator.get_preset(preset).name,
+        "duration_s": duration,
+        "play_steps_s": play_steps_s,
+        "concurrency": concurrency,
+        "torch_threads_per_slot": torch.get_num_threads(),
+        "wall_s": wall_s,
+        "pool_busy_s": pool_busy_s,
+        "time_to_first_audio_s": max(r["time_to_first_audio_s"] for r in results),
+        "tokens_per_s": tokens / wall_s,
+        # processing time per second of audio, below 1 is faster than real time
+        "real_time_factor": max(r["elapsed_s"] for r in results) / duration,
+        "generate_real_time_factor": stage["generate"] / stage["audio"],
+        "decode_real_time_factor": stage["decode"] / stage["audio"],
+        "decode_share": stage["decode"] / (stage["generate"] + stage["decode"]),
+        # peak of the whole process so far, it never decreases between cases
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--durations", type=float, nargs="+", default=[5.0, 10.0])
+    parser.add_argument("--play-steps", nargs="+", default=["adaptive", "4"])
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 2])
+    parser.add_argument(
+        "--warmup-runs",
+        type=int,
+        default=1,
+        help="Untimed runs of each case first, 0 includes the first-call costs in the results",
+    )
+    parser.add_argument("--model", help="Checkpoint to measure instead of the tiny model")
+    parser.add_argument(
+        "--presets", nargs="+", help="Presets to run every case with, DEFAULT_PRESET only if unset"
+    )
+    parser.add_argument("--write-presets", help="Write the presets with their measurements here")
+    parser.add_argument("--output", help="Write the JSON report to this file instead of stdout")
+    args = parser.parse_args()
+
+    warnings.filterwarnings("ignore")
+    model = processor = None
+    if args.model:
+        model = MusicgenForConditionalGeneration.from_pretrained(args.model).eval()
+        processor = MusicgenProcessor.from_pretrained(args.model)
+    report = {
+        "model": args.model or "tiny-random",
+        "torch": torch.__version__,
+        "cores": len(available_cores()),
+        "warmup_runs": args.warmup_runs,
+        "settings": {name: os.environ[name] for name in SERVICE_SETTINGS if name in os.environ},
+        "results": [],
+    }
+
+    # the service logs to stdout, only the report is printed there
+    with tempfile.TemporaryDirectory() as storage_dir, contextlib.redirect_stdout(sys.stderr):
+        for concurrency in args.concurrency:
+            generator = build_generator(concurrency, storage_dir, model, processor)
+            for preset in args.presets or [None]:
+                for duration in args.durations:
+                    for play_steps_s in args.play_steps:
+                        # on CPU, oneDNN prepares its kernels again for every new window length
+                        for _ in range(args.warmup_runs):
+                            run_case(generator, duration, play_steps_s, concurrency, preset)
+                        result = run_case(generator, duration, play_steps_s, concurrency, preset)
+                        print(json.dumps(result))
+                        report["results"].append(result)
+
+    if args.write_presets:
+        presets = {}
+        for name in args.presets or [generator.default_preset]:
+            preset = generator.get_preset(name).to_dict()
+            preset["measured"] = {
+                "model": report["model"],
+                "cores": report["cores"],
+                "results": [
+                    {
+                        key: result[key]
+                        for key in (
+                            "duration_s",
+                            "play_steps_s",
+                            "concurrency",
+                            "time_to_first_audio_s",
+                            "real_time_factor",
+                        )
+                    }
+                    for result in report["results"]
+                    if result["preset"] == name
+                ],
+            }
+            presets[name] = preset
+        with open(args.write_presets, "w") as f:
+            f.write(json.dumps(presets, indent=2))
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
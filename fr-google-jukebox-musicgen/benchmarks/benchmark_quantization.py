@@ -0,0 +1,188 @@
+"""Benchmark of the CPU precisions of MusicGen: speed, memory and quality against fp32.
+
+Generates the same prompt with the same seed in every CPU_PRECISION and reports the
+speedup and the memory saved over fp32, with two quality proxies:
+
+- the log-spectral distance (dB) between the audio and the fp32 audio. Sampling diverges
+  as soon as one token differs, so it is reported next to the distance between two fp32
+  tracks of different seeds: a precision scoring close to that floor produces different
+  music, not degraded music.
+- the next-token distributions with teacher forcing on the fp32 tokens: how often the
+  most likely token is the same, and their mean KL divergence from fp32.
+
+Runs on the tiny offline model by default, give `--model` (a local checkpoint or a hub
+name, like MODEL_NAME) to measure a real one. Run it from fr-google-jukebox-musicgen:
+
+    python -m benchmarks.benchmark_quantization --model facebook/musicgen-small --duration 5
+"""
+
+import argparse
+import copy
+import io
+import json
+import time
+import warnings
+
+import torch
+from transformers import MusicgenForConditionalGeneration, MusicgenProcessor, set_seed
+from transformers.generation.streamers import BaseStreamer
+
+from benchmarks.tiny_musicgen import build_offline_processor, build_tiny_model
+from service.cpu_precision import CPU_PRECISIONS, apply_cpu_precision, precision_context
+
+
+class TokenRecorder(BaseStreamer):
+    """Keeps the decoder input ids, one column per generation step."""
+
+    def __init__(self):
+        self.columns = []
+
+    def put(self, value):
+        self.columns.append(value.reshape(value.shape[0], -1))
+
+    def end(self):
+        pass
+
+    def tokens(self) -> torch.Tensor:
+        return torch.cat(self.columns, dim=-1)
+
+
+def weights_mb(model) -> float:
+    # serialized, so the packed int8 weights are counted as well
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.tell() / 2**20
+
+
+def generate(model, inputs, precision, max_new_tokens, seed):
+    recorder = TokenRecorder()
+    set_seed(seed)
+    start_time = time.perf_counter()
+    with torch.inference_mode(), precision_context(precision):
+        audio = model.generate(**inputs, max_new_tokens=max_new_tokens, streamer=recorder)
+    elapsed = time.perf_counter() - start_time
+    return audio[0, 0].float(), recorder.tokens(), elapsed
+
+
+def log_spectral_distance(audio, reference, n_fft=1024) -> float:
+    length = min(audio.shape[-1], reference.shape[-1])
+    window = torch.hann_window(n_fft)
+    spectra = [
+        torch.stft(x[:length], n_fft, window=window, return_complex=True).abs().pow(2) + 1e-10
+        for x in (audio, reference)
+    ]
+    difference = 10 * torch.log10(spectra[0] / spectra[1])
+    # RMS over the frequencies, mean over the frames
+    return difference.pow(2).mean(dim=0).sqrt().mean().item()
+
+
+def next_token_log_probs(model, inputs, tokens, precision):
+    decoder = model.decoder
+    generation_config = model.generation_config
+    # the decoder sees the tokens with the delay pattern of the codebooks applied, built
+    # from the start tokens as generate does
+    _, mask = decoder.build_delay_pattern_mask(
+        tokens[:, :1], pad_token_id=generation_config.pad_token_id, max_length=tokens.shape[-1]
+    )
+    tokens = decoder.apply_delay_pattern_mask(tokens, mask)
+    with torch.inference_mode(), precision_context(precision):
+        logits = model(**inputs, decoder_input_ids=tokens[:, :-1]).logits
+    # only the positions where the next token is sampled, not forced by the pattern
+    sampled = mask[:, 1:] == -1
+    return logits.float().log_softmax(-1)[sampled]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--model", help="Checkpoint to measure instead of the tiny model")
+    parser.add_argument("--prompt", default="chill lofi beat with piano")
+    parser.add_argument("--duration", type=float, default=5.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--runs", type=int, default=2, help="Timed runs, the best is kept")
+    parser.add_argument("--precisions", nargs="+", default=list(CPU_PRECISIONS))
+    parser.add_argument("--output", help="Write the JSON report to this file instead of stdout")
+    args = parser.parse_args()
+
+    warnings.filterwarnings("ignore")
+    if args.model:
+        base_model = MusicgenForConditionalGeneration.from_pretrained(
+            args.model, torch_dtype=torch.float32
+        ).eval()
+        processor = MusicgenProcessor.from_pretrained(args.model)
+    else:
+        base_model = build_tiny_model()
+        processor = build_offline_processor()
+    inputs = processor(text=[args.prompt], padding=True, return_tensors="pt")
+    max_new_tokens = int(args.duration * base_model.audio_encoder.config.frame_rate)
+
+    report = {
+        "model": args.model or "tiny-random",
+        "torch": torch.__version__,
+        "torch_threads": torch.get_num_threads(),
+        "duration_s": args.duration,
+        "seed": args.seed,
+        "results": [],
+    }
+    reference = None
+    for precision in args.precisions:
+        model = apply_cpu_precision(copy.deepcopy(base_model), precision)
+        # untimed first run, kernels are selected and memory allocated on first use
+        generate(model, inputs, precision, max_new_tokens, args.seed)
+        runs = [
+            generate(model, inputs, precision, max_new_tokens, args.seed) for _ in range(args.runs)
+        ]
+        audio, tokens, elapsed = min(runs, key=lambda run: run[2])
+
+        result = {
+            "precision": precision,
+            "generate_s": elapsed,
+            "tokens_per_s": max_new_tokens / elapsed,
+            "real_time_factor": elapsed / args.duration,
+            "weights_mb": weights_mb(model),
+        }
+        if reference is None:
+            # every precision is compared with the first one, fp32 by default
+            other_seed = generate(model, inputs, precision, max_new_tokens, args.seed + 1)[0]
+            reference = {
+                "precision": precision,
+                "audio": audio,
+                "tokens": tokens,
+                "log_probs": next_token_log_probs(model, inputs, tokens, precision),
+                "generate_s": elapsed,
+                "weights_mb": result["weights_mb"],
+            }
+            report["reference"] = precision
+            report["different_seed_log_spectral_distance_db"] = log_spectral_distance(
+                other_seed, audio
+            )
+
+        log_probs = next_token_log_probs(model, inputs, reference["tokens"], precision)
+        reference_log_probs = reference["log_probs"]
+        result.update(
+            speedup=reference["generate_s"] / elapsed,
+            memory_saved_mb=reference["weights_mb"] - result["weights_mb"],
+            log_spectral_distance_db=log_spectral_distance(audio, reference["audio"]),
+            top_token_agreement=(
+                (log_probs.argmax(-1) == reference_log_probs.argmax(-1)).float().mean().item()
+            ),
+            # KL(reference || precision) of the next-token distributions
+            mean_kl_divergence=(
+                (reference_log_probs.exp() * (reference_log_probs - log_probs))
+                .sum(-1)
+                .mean()
+                .item()
+            ),
+        )
+        print(json.dumps(result))
+        report["results"].append(result)
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
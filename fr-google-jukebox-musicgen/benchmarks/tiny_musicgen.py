@@ -0,0 +1,83 @@
+import torch
+from tokenizers import Tokenizer, models, pre_tokenizers, processors
+from transformers import (
+    EncodecConfig,
+    EncodecFeatureExtractor,
+    MusicgenConfig,
+    MusicgenDecoderConfig,
+    MusicgenForConditionalGeneration,
+    MusicgenProcessor,
+    T5Config,
+    T5TokenizerFast,
+)
+
+# Words known by the offline tokenizer, everything else maps to <unk>
+VOCABULARY = (
+    "a an and the with of in for music song track beat drums bass guitar piano synth "
+    "strings vocals melody rhythm chill lofi jazz rock pop techno house ambient classical "
+    "hip hop funk disco metal reggae upbeat calm dark happy sad energetic slow fast "
+    "relaxing epic dreamy warm bright heavy soft loud electronic acoustic retro"
+).split()
+
+
+def build_tiny_model(seed: int = 0) -> MusicgenForConditionalGeneration:
+    """A randomly initialised MusicGen with the frame rate and sampling rate of the real
+    checkpoints (50 Hz codes, 32 kHz audio) but tiny layers, so it runs on CPU offline."""
+    torch.manual_seed(seed)
+    text_encoder = T5Config(
+        vocab_size=len(VOCABULARY) + 3, d_model=64, d_ff=128, num_layers=2, num_heads=4, d_kv=16
+    )
+    audio_encoder = EncodecConfig(
+        sampling_rate=32000,
+        upsampling_ratios=[8, 5, 4, 4],
+        codebook_size=2048,
+        codebook_dim=32,
+        hidden_size=32,
+        num_filters=8,
+        num_lstm_layers=1,
+        target_bandwidths=[2.0],
+    )
+    decoder = MusicgenDecoderConfig(
+        vocab_size=2048,
+        hidden_size=64,
+        num_hidden_layers=2,
+        num_attention_heads=4,
+        ffn_dim=128,
+        num_codebooks=4,
+        pad_token_id=2048,
+        bos_token_id=2048,
+        decoder_start_token_id=2048,
+    )
+    config = MusicgenConfig.from_sub_models_config(text_encoder, audio_encoder, decoder)
+    model = MusicgenForConditionalGeneration(config).eval()
+
+    # same sampling setup as the released checkpoints
+    model.generation_config.pad_token_id = 2048
+    model.generation_config.decoder_start_token_id = 2048
+    model.generation_config.do_sample = True
+    model.generation_config.guidance_scale = 3.0
+    model.generation_config.top_k = 250
+
+    # the codebooks are initialised to zeros, which would decode every code to the same audio
+    with torch.no_grad():
+        for name, buffer in model.audio_encoder.named_buffers():
+            if name.endswith("codebook.embed"):
+                buffer.normal_(0, 1)
+    return model
+
+
+def build_offline_processor() -> MusicgenProcessor:
+    """A MusicGen processor with an in-memory word level tokenizer, no download needed."""
+    vocab = {"<pad>": 0, "</s>": 1, "<unk>": 2}
+    vocab.update({word: i + 3 for i, word in enumerate(VOCABULARY)})
+
+    tokenizer = Tokenizer(models.WordLevel(vocab, unk_token="<unk>"))
+    tokenizer.pre_tokenizer = pre_tokenizers.Whitespace()
+    tokenizer.post_processor = processors.TemplateProcessing(
+        single="$A </s>", special_tokens=[("</s>", 1)]
+    )
+
+    return MusicgenProcessor(
+        feature_extractor=EncodecFeatureExtractor(sampling_rate=32000),
+        tokenizer=T5TokenizerFast(tokenizer_object=tokenizer, extra_ids=0),
+    )
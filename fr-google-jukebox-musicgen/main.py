@@ -1,33 +1,171 @@
+from contextlib import asynccontextmanager
+from typing import Optional
 from fastapi import FastAPI, Query, HTTPException
 from fastapi.responses import StreamingResponse
+from starlette.concurrency import iterate_in_threadpool, run_in_threadpool
 from model.models import MusicGenRequest
+from service.audio_encoder import MEDIA_TYPES
+from service.generation_pool import QueueFullError
+from service.metrics import memory_usage, metrics
 from service.musicgen_generator import MusigGenGenerator
 
 
-app = FastAPI()
 musicGenGenerator = MusigGenGenerator()
 
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # The server binds its port right away, the model is loaded in the background (unless
+    # it was loaded before the workers were forked, see serve.py)
+    if not musicGenGenerator.ready.is_set():
+        musicGenGenerator.load_in_background()
+    yield
+
+
+app = FastAPI(lifespan=lifespan)
+
+
+async def stream_until_disconnect(audio_stream, ticket):
+    """Forward the audio to the client, and cancel the generation if the client goes away
+    before the end of the stream."""
+    finished = False
+    try:
+        async for chunk in iterate_in_threadpool(audio_stream):
+            yield chunk
+        finished = True
+    finally:
+        if not finished and ticket is not None:
+            ticket.cancel()
+
+
 @app.get("/generate_audio")
 async def generate(
     uuid: str = Query(...),
     prompt: str = Query(...),
     duration: int = Query(...),
+    seed: int = Query(0),
+    first_chunk_s: Optional[float] = Query(None),
+    chunk_growth: Optional[float] = Query(None),
+    max_chunk_s: Optional[float] = Query(None),
+    sample_format: Optional[str] = Query(None),
+    output_format: str = Query("wav", alias="format"),
+    preset: Optional[str] = Query(None),
 ):
     try:
 
         # Validate the request parameters
-        request_body = MusicGenRequest(uuid=uuid, prompt=prompt, duration=duration)
+        request_body = MusicGenRequest(
+            uuid=uuid,
+            prompt=prompt,
+            duration=duration,
+            seed=seed,
+            first_chunk_s=first_chunk_s,
+            chunk_growth=chunk_growth,
+            max_chunk_s=max_chunk_s,
+            sample_format=sample_format,
+            output_format=output_format,
+            preset=preset,
+        )
+
+        if not musicGenGenerator.ready.is_set():
+            raise HTTPException(
+                status_code=503,
+                detail="Model is still loading.",
+                headers={"Retry-After": "30"},
+            )
+
+        try:
+            generation_preset = musicGenGenerator.get_preset(request_body.preset)
+            # the first request of a preset loads its model
+            await run_in_threadpool(musicGenGenerator.prepare_preset, generation_preset)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        schedule = musicGenGenerator.chunk_schedule(
+            first_chunk_s=request_body.first_chunk_s,
+            growth=request_body.chunk_growth,
+            max_chunk_s=request_body.max_chunk_s,
+            preset=generation_preset,
+        )
+
+        # Identical generations are replayed from the cache without queueing
+        cached = await run_in_threadpool(
+            musicGenGenerator.find_cached,
+            text_prompt=request_body.prompt,
+            audio_length_in_s=request_body.duration,
+            schedule=schedule,
+            seed=request_body.seed,
+            preset=generation_preset,
+        )
+        if cached is not None:
+            return StreamingResponse(
+                stream_until_disconnect(
+                    musicGenGenerator.replay_audio_stream(
+                        request_body.uuid,
+                        cached,
+                        sample_format=request_body.sample_format,
+                        output_format=request_body.output_format,
+                    ),
+                    None,
+                ),
+                media_type=MEDIA_TYPES[request_body.output_format],
+                headers={"X-Cache": "HIT"},
+            )
+
+        # Reject right away when the generation queue is full
+        ticket = musicGenGenerator.admit()
+
+        audio_stream = musicGenGenerator.generate_audio_stream(
+            uuid=request_body.uuid,
+            text_prompt=request_body.prompt,
+            audio_length_in_s=request_body.duration,
+            schedule=schedule,
+            seed=request_body.seed,
+            ticket=ticket,
+            sample_format=request_body.sample_format,
+            output_format=request_body.output_format,
+            preset=generation_preset,
+        )
 
         return StreamingResponse(
-            musicGenGenerator.generate_audio_stream(
-                uuid=request_body.uuid,
-                text_prompt=request_body.prompt,
-                audio_length_in_s=request_body.duration,
-            ),
-            media_type="audio/x-wav",
+            stream_until_disconnect(audio_stream, ticket),
+            media_type=MEDIA_TYPES[request_body.output_format],
+            headers={**ticket.headers(), "X-Cache": "MISS"},
         )
 
+    except HTTPException:
+        raise
+    except QueueFullError as e:
+        raise HTTPException(
+            status_code=429,
+            detail=str(e),
+            headers={"Retry-After": str(e.retry_after)},
+        )
     except Exception as e:
         print(e)
         raise HTTPException(status_code=500, detail="Error generating audio.")
+
+
+@app.get("/metrics")
+async def get_metrics():
+    return {**metrics.snapshot(), **memory_usage()}
+
+
+@app.get("/presets")
+async def get_presets():
+    return musicGenGenerator.describe_presets()
+
+
+@app.get("/health")
+async def health():
+    return {"status": "ok"}
+
+
+@app.get("/ready")
+async def ready():
+    if musicGenGenerator.load_error is not None:
+        raise HTTPException(
+            status_code=503, detail=f"Model failed to load: {musicGenGenerator.load_error}"
+        )
+    if not musicGenGenerator.ready.is_set():
+        raise HTTPException(status_code=503, detail="Model is still loading.")
+    return {"status": "ready", "load_timings": musicGenGenerator.load_timings}
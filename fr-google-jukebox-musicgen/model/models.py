@@ -1,11 +1,26 @@
+import os
+
 from pydantic import BaseModel, Field, validator
-from typing import Optional
+from typing import Literal, Optional
 
 
 class MusicGenRequest(BaseModel):
     prompt: str = Field(..., max_length=200)
     uuid: str
-    duration: Optional[int] = Field(None, ge=10, le=45)
+    # up to MAX_DURATION_S, tracks longer than LONG_FORM_WINDOW_S are generated in windows
+    duration: Optional[int] = Field(None, ge=10)
+    # same prompt, duration and seed give the same track
+    seed: int = Field(0, ge=0, le=2**32 - 1)
+    # chunk schedule of the stream, the service defaults are used for the missing values
+    first_chunk_s: Optional[float] = Field(None, ge=0.2, le=10)
+    chunk_growth: Optional[float] = Field(None, ge=1, le=4)
+    max_chunk_s: Optional[float] = Field(None, ge=0.2, le=10)
+    # PCM sample format of the WAV stream, PCM_FORMAT by default
+    sample_format: Optional[Literal["int16", "int24", "float32"]] = None
+    # container streamed to the client, the stored track is always a WAV
+    output_format: Literal["wav", "opus", "flac", "mp3"] = "wav"
+    # speed and quality preset (see GET /presets), DEFAULT_PRESET by default
+    preset: Optional[str] = Field(None, max_length=50)
 
     @validator("prompt")
     def validate_prompt(cls, value):
@@ -15,8 +30,9 @@ class MusicGenRequest(BaseModel):
 
     @validator("duration")
     def validate_duration(cls, value):
-        if value is not None and (value < 10 or value > 45):
-            raise ValueError("Duration must be between 10 and 45")
+        max_duration = int(os.getenv("MAX_DURATION_S", "300"))
+        if value is not None and (value < 10 or value > max_duration):
+            raise ValueError(f"Duration must be between 10 and {max_duration}")
         return value
 
 
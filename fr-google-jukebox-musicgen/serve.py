@@ -0,0 +1,137 @@
+"""Serve the MusicGen service from several worker processes sharing one copy of the model.
+
+The model is loaded once by this process, which then forks the workers. The weights are
+never written to, so their pages stay shared between all the processes instead of being
+copied: memory grows with the activations of each worker, not with the size of the model.
+Every worker runs uvicorn on the same listening socket and the kernel hands each new
+connection to one of them. A worker that dies is forked again from the loaded model.
+
+    python serve.py --workers 4 --host 0.0.0.0 --port 8000 --cpu-affinity cores
+
+With `--cpu-affinity cores` every worker is pinned to its own group of cores, with `numa`
+the workers are spread over the NUMA nodes first. The torch threads of each worker are
+budgeted from the cores it gets (see TORCH_THREADS_PER_SLOT).
+
+Serving this way is CPU only: CUDA can't be used in a forked process, so the model is
+loaded on the CPU even when there is a GPU. Run main.py with uvicorn to generate on the GPU.
+"""
+
+import argparse
+import gc
+import os
+import signal
+import socket
+import sys
+
+import torch
+
+# The parent must not start a pool of OpenMP threads: the forked workers would hang on
+# their first parallel operation. Each worker sets its own number of threads.
+torch.set_num_threads(1)
+
+import uvicorn  # noqa: E402
+
+from service.cpu_affinity import AFFINITY_MODES, available_cores, worker_cores  # noqa: E402
+
+
+def run_worker(index: int, sock: socket.socket, cores, shared_cores: int, log_level: str):
+    import main
+    from service.metrics import metrics
+
+    generator = main.musicGenGenerator
+    if cores is not None:
+        os.sched_setaffinity(0, cores)
+        metrics.set("worker_cores", ",".join(map(str, cores)))
+        generator.configure_threads()
+    else:
+        # the workers all run on every core, each one gets its share
+        generator.configure_threads(cores=shared_cores)
+    generator.reset_after_fork()
+    metrics.set("worker", index)
+    if generator.warmup_on_load:
+        generator.warmup()
+
+    config = uvicorn.Config(main.app, fd=sock.fileno(), log_level=log_level)
+    uvicorn.Server(config).run()
+
+
+def fork_worker(index: int, sock: socket.socket, args) -> int:
+    cores = worker_cores(index, args.workers, args.cpu_affinity)
+    shared_cores = max(1, len(available_cores()) // args.workers)
+    pid = os.fork()
+    if pid == 0:
+        # uvicorn installs its own handlers for a graceful shutdown
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        exit_code = 0
+        try:
+            run_worker(index, sock, cores, shared_cores, args.log_level)
+        except BaseException as e:
+            print(f"Worker {index} failed: {e}")
+            exit_code = 1
+        finally:
+            os._exit(exit_code)
+    print(f"Started worker {index} (pid {pid}, cores {cores or 'shared'})")
+    return pid
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--workers", type=int, default=int(os.getenv("SERVE_WORKERS", "2")))
+    parser.add_argument(
+        "--cpu-affinity",
+        choices=AFFINITY_MODES,
+        default=os.getenv("CPU_AFFINITY", "none"),
+        help="Pin each worker to its own group of cores, or to the cores of a NUMA node",
+    )
+    parser.add_argument("--log-level", default="info")
+    args = parser.parse_args()
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((args.host, args.port))
+    sock.listen(2048)
+    sock.set_inheritable(True)
+
+    import main as service
+
+    if torch.cuda.is_available():
+        print("serve.py is CPU only, the forked workers can't use CUDA: loading on the CPU")
+    # the workers warm up themselves, running the model here would start the thread pools
+    service.musicGenGenerator.load(warmup=False, configure_threads=False, device="cpu")
+
+    # the objects created so far are left out of the garbage collection of the workers,
+    # which would otherwise write to (and copy) their pages
+    gc.freeze()
+
+    workers = {fork_worker(i, sock, args): i for i in range(args.workers)}
+    stopping = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in workers:
+            os.kill(pid, signal.SIGTERM)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    while workers:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        index = workers.pop(pid, None)
+        if index is None:
+            continue
+        if not stopping:
+            print(f"Worker {index} exited with status {status}, starting it again")
+            workers[fork_worker(index, sock, args)] = index
+
+    sock.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
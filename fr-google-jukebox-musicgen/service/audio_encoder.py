@@ -0,0 +1,103 @@
+# Copy of fr-google-jukebox/app/music/service/audio_encoder.py, the backend and the MusicGen
+# service are built separately. Keep both files the same apart from this comment.
+import io
+import os
+
+import numpy as np
+
+# Media type of every output format, "wav" is streamed as raw PCM by the service
+MEDIA_TYPES = {
+    "wav": "audio/x-wav",
+    "opus": "audio/ogg",
+    "flac": "audio/flac",
+    "mp3": "audio/mpeg",
+}
+OUTPUT_FORMATS = tuple(MEDIA_TYPES)
+
+# container, codec, sample rate (None keeps the input rate) and default bitrate of each format
+_CODECS = {
+    "opus": ("ogg", "libopus", 48000, 64000),
+    "flac": ("flac", "flac", None, None),
+    "mp3": ("mp3", "libmp3lame", None, 128000),
+}
+
+# Ogg pages are flushed every 100 ms instead of every second, so audio goes out per chunk
+_CONTAINER_OPTIONS = {"ogg": {"page_duration": "100000"}}
+
+
+class _ByteSink(io.RawIOBase):
+    """File-like target of the muxer, collects the bytes written since the last take()."""
+
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.buffer += data
+        return len(data)
+
+    def take(self) -> bytes:
+        data = bytes(self.buffer)
+        self.buffer.clear()
+        return data
+
+
+def require_av(output_format: str):
+    """Import PyAV, which is only needed for the compressed formats."""
+    if output_format not in _CODECS:
+        raise ValueError(f"output_format must be one of {tuple(_CODECS)}, got {output_format!r}")
+    try:
+        import av
+    except ImportError as e:
+        raise RuntimeError(f"The {output_format} format needs PyAV (pip install av)") from e
+    return av
+
+
+class StreamingAudioEncoder:
+    """Encodes float audio chunks to Ogg/Opus, FLAC or MP3 as they are produced.
+
+    Every call to `encode` returns the container bytes produced so far, `close` flushes
+    the encoder and returns the end of the stream. Needs PyAV (`pip install av`).
+    """
+
+    def __init__(self, output_format: str, sample_rate: int, channels: int = 1, bitrate=None):
+        self.av = require_av(output_format)
+        self.sample_rate = sample_rate
+        self.layout = "mono" if channels == 1 else "stereo"
+        self.pts = 0
+
+        container, codec, codec_rate, default_bitrate = _CODECS[output_format]
+        self.sink = _ByteSink()
+        self.container = self.av.open(
+            self.sink, mode="w", format=container, options=_CONTAINER_OPTIONS.get(container, {})
+        )
+        # frames are resampled to the codec rate by PyAV when it differs from the input
+        self.stream = self.container.add_stream(
+            codec, rate=codec_rate or sample_rate, layout=self.layout
+        )
+        if default_bitrate is not None:
+            self.stream.bit_rate = bitrate or default_bitrate
+
+    def encode(self, audio: np.ndarray) -> bytes:
+        """Encode `audio`, shaped (frames,) for mono or (channels, frames)."""
+        audio = np.ascontiguousarray(np.atleast_2d(audio), dtype=np.float32)
+        if audio.shape[-1]:
+            frame = self.av.AudioFrame.from_ndarray(audio, format="fltp", layout=self.layout)
+            frame.sample_rate = self.sample_rate
+            frame.pts = self.pts
+            self.pts += audio.shape[-1]
+            self.container.mux(self.stream.encode(frame))
+        return self.sink.take()
+
+    def close(self) -> bytes:
+        self.container.mux(self.stream.encode(None))
+        self.container.close()
+        return self.sink.take()
+
+
+def get_bitrate(output_format: str):
+    """Bitrate set for `output_format` in the environment (e.g. OPUS_BITRATE=96000)."""
+    bitrate = os.getenv(f"{output_format.upper()}_BITRATE")
+    return int(bitrate) if bitrate else None
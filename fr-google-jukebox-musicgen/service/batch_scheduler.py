@@ -0,0 +1,139 @@
+import time
+from threading import Condition, Event, Thread
+from typing import Callable, List, Optional
+
+
+class BatchRequest:
+    def __init__(
+        self,
+        text_prompt: str,
+        audio_length_in_s: float,
+        schedule,
+        seed: int = 0,
+        ticket=None,
+        preset=None,
+        decode_mode=None,
+    ):
+        self.text_prompt = text_prompt
+        self.audio_length_in_s = audio_length_in_s
+        self.schedule = schedule
+        self.seed = seed
+        self.ticket = ticket
+        self.preset = preset
+        self.decode_mode = decode_mode
+        self.arrived_at = time.monotonic()
+
+        # set by the scheduler once the batch this request belongs to has started
+        self.streamer = None
+        self.row = None
+        self.error = None
+        self.started = Event()
+
+    def start(self, streamer, row: int):
+        self.streamer = streamer
+        self.row = row
+        self.started.set()
+
+    def fail(self, error: Exception):
+        self.error = error
+        if self.ticket is not None:
+            self.ticket.release()
+        self.started.set()
+
+    def stream(self, max_samples: Optional[int] = None):
+        """Yield the audio of this request's row, cut at `max_samples` when the batch
+        generates longer than this request asked for."""
+        self.started.wait()
+        if self.error is not None:
+            raise self.error
+
+        remaining = max_samples
+        for new_audio in self.streamer.iter_row(self.row):
+            if remaining is not None:
+                new_audio = new_audio[:remaining]
+                remaining -= len(new_audio)
+            if len(new_audio):
+                yield new_audio
+            if remaining == 0:
+                return
+
+
+class BatchScheduler:
+    """Collects the requests arriving within `window_s` of each other and hands them to
+    `run_batch` as a single batch. Requests are batched together when they use the same
+    preset, decode mode, chunk schedule and seed, and their durations are within
+    `duration_tolerance_s` of the oldest one."""
+
+    def __init__(
+        self,
+        run_batch: Callable[[List[BatchRequest]], None],
+        max_batch_size: int = 4,
+        window_s: float = 0.5,
+        duration_tolerance_s: float = 5.0,
+    ):
+        self.run_batch = run_batch
+        self.max_batch_size = max_batch_size
+        self.window_s = window_s
+        self.duration_tolerance_s = duration_tolerance_s
+
+        self.pending: List[BatchRequest] = []
+        self.condition = Condition()
+        self.thread = Thread(target=self._loop, daemon=True)
+        self.thread.start()
+
+    def submit(
+        self,
+        text_prompt,
+        audio_length_in_s,
+        schedule,
+        seed=0,
+        ticket=None,
+        preset=None,
+        decode_mode=None,
+    ) -> BatchRequest:
+        request = BatchRequest(
+            text_prompt, audio_length_in_s, schedule, seed, ticket, preset, decode_mode
+        )
+        with self.condition:
+            self.pending.append(request)
+            self.condition.notify()
+        return request
+
+    def _compatible(self, first: BatchRequest, other: BatchRequest) -> bool:
+        return (
+            other.preset is first.preset
+            and other.decode_mode == first.decode_mode
+            and other.schedule == first.schedule
+            and other.seed == first.seed
+            and abs(other.audio_length_in_s - first.audio_length_in_s) <= self.duration_tolerance_s
+        )
+
+    def _next_batch(self) -> List[BatchRequest]:
+        first = self.pending[0]
+        return [request for request in self.pending if self._compatible(first, request)][
+            : self.max_batch_size
+        ]
+
+    def _loop(self):
+        while True:
+            with self.condition:
+                while not self.pending:
+                    self.condition.wait()
+
+                # wait for the window of the oldest request to close, or for its batch to fill up
+                deadline = self.pending[0].arrived_at + self.window_s
+                while len(self._next_batch()) < self.max_batch_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.condition.wait(timeout=remaining)
+
+                batch = self._next_batch()
+                self.pending = [request for request in self.pending if request not in batch]
+
+            try:
+                self.run_batch(batch)
+            except Exception as e:
+                print(f"Batch of {len(batch)} requests failed to start: {e}")
+                for request in batch:
+                    request.fail(e)
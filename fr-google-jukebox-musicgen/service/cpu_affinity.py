@@ -0,0 +1,72 @@
+import glob
+import os
+import re
+from typing import Dict, List, Optional
+
+AFFINITY_MODES = ("none", "cores", "numa")
+
+
+def available_cores() -> List[int]:
+    """The cores this process may run on."""
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def _parse_cpu_list(cpu_list: str) -> List[int]:
+    # e.g. "0-3,8-11"
+    cores = []
+    for part in cpu_list.strip().split(","):
+        if "-" in part:
+            first, last = part.split("-")
+            cores.extend(range(int(first), int(last) + 1))
+        elif part:
+            cores.append(int(part))
+    return cores
+
+
+def numa_nodes() -> Dict[int, List[int]]:
+    """Cores of each NUMA node, empty where the topology isn't exposed."""
+    nodes = {}
+    for path in glob.glob("/sys/devices/system/node/node[0-9]*/cpulist"):
+        node = int(re.search(r"node(\d+)", path).group(1))
+        with open(path) as f:
+            cores = _parse_cpu_list(f.read())
+        if cores:
+            nodes[node] = cores
+    return nodes
+
+
+def _split(cores: List[int], parts: int, index: int) -> List[int]:
+    """The `index`-th of `parts` contiguous groups of cores, groups share cores when there
+    are more parts than cores."""
+    if parts >= len(cores):
+        return [cores[index % len(cores)]]
+    size, remainder = divmod(len(cores), parts)
+    start = index * size + min(index, remainder)
+    return cores[start : start + size + (index < remainder)]
+
+
+def worker_cores(index: int, workers: int, mode: str) -> Optional[List[int]]:
+    """Cores to pin the `index`-th of `workers` worker processes to, None to leave it free.
+
+    `cores` splits the available cores in contiguous groups, `numa` spreads the workers over
+    the NUMA nodes first and splits the cores of each node between its workers."""
+    if mode not in AFFINITY_MODES:
+        raise ValueError(f"CPU affinity must be one of {AFFINITY_MODES}, got {mode!r}")
+    if mode == "none":
+        return None
+    cores = available_cores()
+    if mode == "numa":
+        allowed = set(cores)
+        nodes = [
+            [core for core in node_cores if core in allowed]
+            for _, node_cores in sorted(numa_nodes().items())
+        ]
+        nodes = [node_cores for node_cores in nodes if node_cores]
+        if len(nodes) > 1:
+            node_cores = nodes[index % len(nodes)]
+            # workers of the same node, by their rank on it
+            node_workers = len(range(index % len(nodes), workers, len(nodes)))
+            return _split(node_cores, node_workers, index // len(nodes))
+    return _split(cores, workers, index)
@@ -0,0 +1,31 @@
+import contextlib
+
+import torch
+
+# fp32 is the precision of the checkpoints, int8 quantizes the weights of the decoder's
+# linear layers and bf16 runs the generation under autocast
+CPU_PRECISIONS = ("fp32", "int8", "bf16")
+
+
+def apply_cpu_precision(model, precision: str):
+    """Prepare a model loaded in fp32 for `precision` on CPU.
+
+    int8 uses dynamic quantization: the weights of every linear layer of the decoder (the
+    transformer that generates the tokens, where the time goes) are stored as int8 and the
+    activations are quantized on the fly. The text encoder runs once per request and
+    EnCodec is made of convolutions, both are left in fp32."""
+    if precision not in CPU_PRECISIONS:
+        raise ValueError(f"precision must be one of {CPU_PRECISIONS}, got {precision!r}")
+    if precision == "int8":
+        torch.ao.quantization.quantize_dynamic(
+            model.decoder, {torch.nn.Linear}, dtype=torch.qint8, inplace=True
+        )
+    return model
+
+
+def precision_context(precision: str):
+    """Context to generate in, autocast is only entered for bf16. The dynamically quantized
+    layers only take fp32 inputs, which is why int8 and bf16 can't be combined."""
+    if precision == "bf16":
+        return torch.autocast("cpu", dtype=torch.bfloat16)
+    return contextlib.nullcontext()
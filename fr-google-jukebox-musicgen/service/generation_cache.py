@@ -0,0 +1,243 @@
+import fcntl
+import hashlib
+import json
+import os
+import unicodedata
+from collections import OrderedDict
+from contextlib import contextmanager
+from threading import Lock, Thread
+from typing import List, Optional
+
+import numpy as np
+from google.cloud import storage
+
+
+def normalize_prompt(prompt: str) -> str:
+    # The tokenizer is case sensitive, only the spacing and unicode form are normalized
+    return " ".join(unicodedata.normalize("NFC", prompt).split())
+
+
+def cache_key(model_name: str, prompt: str, duration: float, seed: int, params: dict) -> str:
+    """Content address of a generation: everything that changes the generated audio."""
+    fields = {
+        "model": model_name,
+        "prompt": normalize_prompt(prompt),
+        "duration": float(duration),
+        "seed": seed,
+        "params": params,
+    }
+    return hashlib.sha256(json.dumps(fields, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+class CacheEntry:
+    """The float32 PCM of a generated track, and the sizes of the chunks it was streamed in."""
+
+    def __init__(self, audio: np.ndarray, chunk_sizes: List[int], sampling_rate: int):
+        self.audio = audio
+        self.chunk_sizes = chunk_sizes
+        self.sampling_rate = sampling_rate
+
+    @classmethod
+    def from_chunks(cls, chunks: List[np.ndarray], sampling_rate: int) -> "CacheEntry":
+        audio = np.concatenate(chunks).astype(np.float32) if chunks else np.zeros(0, np.float32)
+        return cls(audio, [len(chunk) for chunk in chunks], sampling_rate)
+
+    def chunks(self):
+        """Replay the audio with the chunk cadence it was generated with."""
+        offset = 0
+        for size in self.chunk_sizes:
+            yield self.audio[offset : offset + size]
+            offset += size
+
+    @property
+    def nbytes(self) -> int:
+        return self.audio.nbytes
+
+    def metadata(self) -> bytes:
+        return json.dumps(
+            {"sampling_rate": self.sampling_rate, "chunk_sizes": self.chunk_sizes}
+        ).encode("utf-8")
+
+    @classmethod
+    def from_bytes(cls, pcm: bytes, metadata: bytes) -> "CacheEntry":
+        metadata = json.loads(metadata)
+        return cls(
+            np.frombuffer(pcm, dtype=np.float32),
+            metadata["chunk_sizes"],
+            metadata["sampling_rate"],
+        )
+
+
+class LocalCacheTier:
+    """Least recently used entries on the local disk, evicted beyond `max_bytes`.
+
+    The workers of serve.py share the directory, each with its own index of it: entries
+    missing from the index are looked up on the disk, and the size accounting is rebuilt
+    from the directory, under a file lock, before evicting."""
+
+    def __init__(self, root: str, max_bytes: int):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.lock = Lock()
+        os.makedirs(root, exist_ok=True)
+
+        # key -> size on disk, oldest first
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self._scan()
+
+    def _path(self, key: str, extension: str) -> str:
+        return os.path.join(self.root, f"{key}.{extension}")
+
+    def _scan(self):
+        """Rebuild the index from the directory, the least recently used entries first."""
+        files = []
+        for file in os.listdir(self.root):
+            if not file.endswith(".pcm"):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.root, file))
+            except OSError:
+                # evicted by another worker in the meantime
+                continue
+            files.append((stat.st_mtime_ns, file[: -len(".pcm")], stat.st_size))
+        files.sort()
+        self.entries = OrderedDict((key, size) for _, key, size in files)
+        self.total_bytes = sum(self.entries.values())
+
+    @contextmanager
+    def _directory_lock(self):
+        with self.lock, open(os.path.join(self.root, ".lock"), "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def get(self, key: str) -> Optional[CacheEntry]:
+        with self.lock:
+            indexed = key in self.entries
+            if indexed:
+                self.entries.move_to_end(key)
+        # another worker may have written it
+        if not indexed and not os.path.exists(self._path(key, "pcm")):
+            return None
+        try:
+            with open(self._path(key, "json"), "rb") as f:
+                metadata = f.read()
+            with open(self._path(key, "pcm"), "rb") as f:
+                pcm = f.read()
+            # the evictions of every worker go by the modification times
+            os.utime(self._path(key, "pcm"))
+        except OSError:
+            # evicted in the meantime
+            with self.lock:
+                self.total_bytes -= self.entries.pop(key, 0)
+            return None
+        if not indexed:
+            with self.lock:
+                self.total_bytes += len(pcm) - self.entries.get(key, 0)
+                self.entries[key] = len(pcm)
+        return CacheEntry.from_bytes(pcm, metadata)
+
+    def put(self, key: str, entry: CacheEntry):
+        if entry.nbytes > self.max_bytes:
+            return
+        # written under a temporary name first, readers never see a partial entry. The name
+        # is unique to the process, the workers of serve.py share the directory
+        for extension, data in (("json", entry.metadata()), ("pcm", entry.audio.tobytes())):
+            path = self._path(key, extension)
+            with open(f"{path}.{os.getpid()}.tmp", "wb") as f:
+                f.write(data)
+            os.replace(f"{path}.{os.getpid()}.tmp", path)
+
+        with self._directory_lock():
+            # the other workers have written and evicted entries since the last scan
+            self._scan()
+            while self.total_bytes > self.max_bytes:
+                evicted, size = self.entries.popitem(last=False)
+                self.total_bytes -= size
+                for extension in ("pcm", "json"):
+                    try:
+                        os.remove(self._path(evicted, extension))
+                    except OSError:
+                        pass
+
+
+class GCSCacheTier:
+    """Entries shared by every instance of the service, kept in a bucket."""
+
+    def __init__(self, bucket_name: str, prefix: str = "generation-cache"):
+        self.bucket_name = bucket_name
+        self.prefix = prefix
+        self._client = None
+
+    @property
+    def client(self) -> storage.Client:
+        if self._client is None:
+            self._client = storage.Client()
+        return self._client
+
+    def _blob(self, key: str, extension: str) -> storage.Blob:
+        return self.client.bucket(self.bucket_name).blob(f"{self.prefix}/{key}.{extension}")
+
+    def get(self, key: str) -> Optional[CacheEntry]:
+        try:
+            metadata = self._blob(key, "json").download_as_bytes()
+            pcm = self._blob(key, "pcm").download_as_bytes()
+        except Exception:
+            return None
+        return CacheEntry.from_bytes(pcm, metadata)
+
+    def put(self, key: str, entry: CacheEntry):
+        # the metadata goes last, an entry is only found once both objects exist
+        self._blob(key, "pcm").upload_from_string(
+            entry.audio.tobytes(), content_type="application/octet-stream"
+        )
+        self._blob(key, "json").upload_from_string(
+            entry.metadata(), content_type="application/json"
+        )
+
+
+class GenerationCache:
+    """Looks entries up on the local disk first, then in the optional GCS tier."""
+
+    def __init__(self, local: Optional[LocalCacheTier], remote: Optional[GCSCacheTier] = None):
+        self.local = local
+        self.remote = remote
+
+    def get(self, key: str) -> Optional[CacheEntry]:
+        if self.local is not None:
+            entry = self.local.get(key)
+            if entry is not None:
+                return entry
+        if self.remote is not None:
+            entry = self.remote.get(key)
+            if entry is not None:
+                if self.local is not None:
+                    self.local.put(key, entry)
+                return entry
+        return None
+
+    def put(self, key: str, entry: CacheEntry):
+        """Store the entry in the background, the stream isn't held back by it."""
+        Thread(target=self._put, args=(key, entry), daemon=True).start()
+
+    def _put(self, key: str, entry: CacheEntry):
+        try:
+            if self.local is not None:
+                self.local.put(key, entry)
+            if self.remote is not None:
+                self.remote.put(key, entry)
+        except Exception as e:
+            print(f"Failed to cache generation {key}: {e}")
+
+
+def get_generation_cache() -> Optional[GenerationCache]:
+    max_bytes = int(float(os.getenv("CACHE_MAX_MB", "2048")) * 1024 * 1024)
+    bucket_name = os.getenv("CACHE_BUCKET")
+    local = LocalCacheTier(os.getenv("CACHE_DIR", "cache"), max_bytes) if max_bytes > 0 else None
+    remote = GCSCacheTier(bucket_name) if bucket_name else None
+    if local is None and remote is None:
+        return None
+    return GenerationCache(local, remote)
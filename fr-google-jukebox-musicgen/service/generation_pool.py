@@ -0,0 +1,125 @@
+import math
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from threading import Event, Lock
+from typing import Callable, List
+
+import torch
+from transformers import StoppingCriteria
+
+
+class QueueFullError(Exception):
+    def __init__(self, retry_after: int):
+        super().__init__(f"Generation queue is full, retry in {retry_after} seconds.")
+        self.retry_after = retry_after
+
+
+class GenerationTicket:
+    """A reserved place in the generation pool. It is released when the job it was submitted
+    with finishes, or explicitly when the request fails before submitting a job."""
+
+    def __init__(self, pool: "GenerationPool", position: int, eta_s: float):
+        self.pool = pool
+        self.position = position
+        self.eta_s = eta_s
+        self.released = False
+        self.cancel_event = Event()
+
+    def release(self):
+        self.pool._release(self)
+
+    def cancel(self):
+        """Stop generating for this request, e.g. because its client went away."""
+        self.cancel_event.set()
+
+    @property
+    def cancelled(self) -> bool:
+        return self.cancel_event.is_set()
+
+    def headers(self) -> dict:
+        return {
+            "X-Queue-Position": str(self.position),
+            "X-Queue-ETA": f"{self.eta_s:.1f}",
+        }
+
+
+class CancellationCriteria(StoppingCriteria):
+    """Stops the rows of a generation whose ticket has been cancelled."""
+
+    def __init__(self, tickets: List[GenerationTicket]):
+        self.tickets = tickets
+
+    @property
+    def cancelled(self) -> bool:
+        """Whether every row has been cancelled, the generation is then stopped."""
+        return all(ticket.cancelled for ticket in self.tickets)
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs):
+        cancelled = torch.tensor([ticket.cancelled for ticket in self.tickets], device="cpu")
+        # MusicGen generates one row per codebook of each request
+        rows_per_ticket = input_ids.shape[0] // len(self.tickets)
+        return cancelled.repeat_interleave(rows_per_ticket).to(input_ids.device)
+
+
+class GenerationPool:
+    """Runs generation jobs on a fixed number of worker threads.
+
+    `concurrency` jobs run at the same time, each of them holding up to `slots_per_job`
+    requests (the batch size), and at most `queue_depth` more requests wait for a worker.
+    Requests beyond that are rejected right away instead of slowing everyone down.
+    """
+
+    def __init__(self, concurrency: int = 1, queue_depth: int = 4, slots_per_job: int = 1):
+        self.concurrency = concurrency
+        self.queue_depth = queue_depth
+        self.slots = concurrency * slots_per_job
+        self.executor = ThreadPoolExecutor(
+            max_workers=concurrency, thread_name_prefix="generation"
+        )
+
+        self.lock = Lock()
+        self.in_flight = 0
+        # moving average of the job duration, used for the queue ETA
+        self.average_job_s = None
+
+    def admit(self) -> GenerationTicket:
+        with self.lock:
+            if self.in_flight >= self.slots + self.queue_depth:
+                raise QueueFullError(retry_after=max(1, math.ceil(self._job_estimate_s())))
+
+            position = max(0, self.in_flight - self.slots + 1)
+            eta_s = math.ceil(position / self.slots) * self._job_estimate_s()
+            self.in_flight += 1
+            return GenerationTicket(self, position, eta_s)
+
+    def submit(self, tickets: List[GenerationTicket], fn: Callable, **kwargs) -> Future:
+        return self.executor.submit(self._run, tickets, fn, kwargs)
+
+    def _job_estimate_s(self) -> float:
+        return self.average_job_s if self.average_job_s is not None else 30.0
+
+    def _run(self, tickets, fn, kwargs):
+        start_time = time.monotonic()
+        try:
+            return fn(**kwargs)
+        except Exception as e:
+            # generate can't post-process the truncated codes of a job stopped by cancellation
+            if all(ticket.cancelled for ticket in tickets):
+                return None
+            print(f"Generation job failed: {e}")
+            raise
+        finally:
+            duration = time.monotonic() - start_time
+            with self.lock:
+                if self.average_job_s is None:
+                    self.average_job_s = duration
+                else:
+                    self.average_job_s = 0.8 * self.average_job_s + 0.2 * duration
+            for ticket in tickets:
+                ticket.release()
+
+    def _release(self, ticket: GenerationTicket):
+        with self.lock:
+            if not ticket.released:
+                ticket.released = True
+                self.in_flight -= 1
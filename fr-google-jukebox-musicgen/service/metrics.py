@@ -0,0 +1,40 @@
+from threading import Lock
+
+
+class ServiceMetrics:
+    """Thread-safe counters reported by the /metrics endpoint."""
+
+    def __init__(self):
+        self.lock = Lock()
+        self.counters = {}
+
+    def increment(self, name: str, value: float = 1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def set(self, name: str, value: float):
+        with self.lock:
+            self.counters[name] = value
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            return dict(self.counters)
+
+
+metrics = ServiceMetrics()
+
+
+def memory_usage() -> dict:
+    """Resident and proportional memory of the process in MB. Pages shared with other
+    processes, like the weights shared by the workers of serve.py, are divided between them
+    in the proportional figure. Empty where /proc isn't available."""
+    usage = {}
+    try:
+        with open("/proc/self/smaps_rollup") as f:
+            for line in f:
+                name, _, value = line.partition(":")
+                if name in ("Rss", "Pss"):
+                    usage[f"memory_{name.lower()}_mb"] = int(value.split()[0]) / 1024
+    except OSError:
+        pass
+    return usage
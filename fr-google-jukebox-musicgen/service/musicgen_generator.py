@@ -1,138 +1,722 @@
 import os
-from threading import Thread
-from google.cloud import storage
-import numpy as np
-from service.musicgen_stream import MusicgenStreamer
+from service.audio_encoder import StreamingAudioEncoder, get_bitrate, require_av
+from service.batch_scheduler import BatchScheduler
+from service.cpu_affinity import available_cores
+from service.cpu_precision import CPU_PRECISIONS, apply_cpu_precision, precision_context
+from service.generation_cache import CacheEntry, cache_key, get_generation_cache
+from service.generation_pool import CancellationCriteria, GenerationPool
+from service.metrics import metrics
+from service.musicgen_stream import ChunkSchedule, MusicgenStreamer
+from service.pcm import SAMPLE_FORMATS, PcmEncoder, wav_header
+from service.presets import GenerationPreset, load_presets
+from service.storage_backend import get_storage_backend
+from service.text_encoding_cache import TextEncodingCache
 import torch
 import time
-from transformers import MusicgenForConditionalGeneration, MusicgenProcessor, set_seed
+from threading import Event, Lock, Thread
+from huggingface_hub import snapshot_download
+from transformers import (
+    MusicgenForConditionalGeneration,
+    MusicgenProcessor,
+    StoppingCriteriaList,
+    set_seed,
+)
 from dotenv import load_dotenv
 
 
 load_dotenv()
 
 
+# Only the safetensors weights are downloaded, they are memory-mapped when deserialized
+MODEL_FILE_PATTERNS = ["*.json", "*.safetensors", "*.model", "*.txt"]
+
+
+class ModelVariant:
+    """A loaded model, with the cache of its text encodings."""
+
+    def __init__(self, name, model, processor, text_encodings: TextEncodingCache):
+        self.name = name
+        self.model = model
+        self.processor = processor
+        self.text_encodings = text_encodings
+
+
 class MusigGenGenerator:
     def __init__(self):
         # Defaults
         self.model_name = os.getenv("MODEL_NAME", "facebook/musicgen-large")
         self.bucket_name = os.getenv("BUCKET_NAME")
+        self.decode_mode = os.getenv("DECODE_MODE", "incremental")
+        self.decode_context_s = float(os.getenv("DECODE_CONTEXT_S", "1.0"))
+        self.decode_overlap_s = float(os.getenv("DECODE_OVERLAP_S", "0.25"))
+        self.decode_worker = os.getenv("DECODE_WORKER", "true").lower() == "true"
+        self.sample_format = os.getenv("PCM_FORMAT", "int16")
+        if self.sample_format not in SAMPLE_FORMATS:
+            raise ValueError(f"PCM_FORMAT must be one of {SAMPLE_FORMATS}")
+        self.dither = os.getenv("PCM_DITHER", "false").lower() == "true"
+        self.default_schedule = ChunkSchedule(
+            first_chunk_s=float(os.getenv("CHUNK_FIRST_S", "1.0")),
+            growth=float(os.getenv("CHUNK_GROWTH", "2.0")),
+            max_chunk_s=float(os.getenv("CHUNK_MAX_S", "4.0")),
+            safety=float(os.getenv("CHUNK_BUFFER_SAFETY", "1.5")),
+        )
+        self.batch_max_size = int(os.getenv("BATCH_MAX_SIZE", "1"))
+        self.batch_window_s = float(os.getenv("BATCH_WINDOW_S", "0.5"))
+        self.batch_duration_tolerance_s = float(os.getenv("BATCH_DURATION_TOLERANCE_S", "5"))
+        self.generation_concurrency = int(os.getenv("GENERATION_CONCURRENCY", "1"))
+        self.generation_queue_depth = int(os.getenv("GENERATION_QUEUE_DEPTH", "4"))
+        self.warmup_on_load = os.getenv("WARMUP_ON_LOAD", "false").lower() == "true"
+        # torch threads of each generation slot, the cores divided between the slots if unset
+        self.threads_per_slot = int(os.getenv("TORCH_THREADS_PER_SLOT", "0"))
+        self.text_encoding_cache_size = int(os.getenv("TEXT_ENCODING_CACHE_SIZE", "256"))
+        # longer tracks are generated in windows, each one continuing from the end of the last
+        self.long_form_window_s = float(os.getenv("LONG_FORM_WINDOW_S", "30"))
+        self.long_form_context_s = float(os.getenv("LONG_FORM_CONTEXT_S", "10"))
+        if not 0 < self.long_form_context_s < self.long_form_window_s:
+            raise ValueError("LONG_FORM_CONTEXT_S must be between 0 and LONG_FORM_WINDOW_S")
+        self.cpu_precision = os.getenv("CPU_PRECISION", "fp32")
+        if self.cpu_precision not in CPU_PRECISIONS:
+            raise ValueError(f"CPU_PRECISION must be one of {CPU_PRECISIONS}")
+        self.presets = load_presets(os.getenv("PRESETS_FILE"))
+        self.default_preset = os.getenv("DEFAULT_PRESET", "standard")
+        if self.default_preset not in self.presets:
+            raise ValueError(f"DEFAULT_PRESET must be one of {list(self.presets)}")
+        # presets whose model is loaded with MODEL_NAME's instead of on their first request
+        self.preload_presets = [
+            name.strip() for name in os.getenv("PRELOAD_PRESETS", "").split(",") if name.strip()
+        ]
+        for name in self.preload_presets:
+            if name not in self.presets:
+                raise ValueError(f"PRELOAD_PRESETS must be among {list(self.presets)}")
+        self.storage = get_storage_backend(self.bucket_name)
+        self.cache = get_generation_cache()
+        if self.cache is not None and (self.generation_concurrency > 1 or self.batch_max_size > 1):
+            # set_seed seeds the RNG shared by every generation thread, and the samples of a
+            # batched row depend on the rows batched with it: the seed only decides the audio
+            # of a generation running alone
+            print("Generation cache disabled, generations don't run one at a time")
+            self.cache = None
+
+        # The model is loaded by load(), the service accepts requests once it is ready
+        self.model = None
+        self.processor = None
+        self.precision = None
+        self.text_encodings = None
+        # the models of the presets by name, MODEL_NAME's included, and why the presets
+        # whose model couldn't be loaded are unavailable
+        self.variants = {}
+        self.preset_errors = {}
+        self.variants_lock = Lock()
+        self.device = None
+        self.given_model = False
+        self.ready = Event()
+        self.load_error = None
+        self.load_timings = {}
+
+        self.__start_scheduling()
+
+    def __start_scheduling(self):
+        self.generation_pool = GenerationPool(
+            concurrency=self.generation_concurrency,
+            queue_depth=self.generation_queue_depth,
+            slots_per_job=self.batch_max_size,
+        )
+
+        # Requests are only batched together when batching is enabled
+        self.batch_scheduler = None
+        if self.batch_max_size > 1:
+            self.batch_scheduler = BatchScheduler(
+                self.__run_batch,
+                max_batch_size=self.batch_max_size,
+                window_s=self.batch_window_s,
+                duration_tolerance_s=self.batch_duration_tolerance_s,
+            )
 
-        # Load the model
+    def reset_after_fork(self):
+        """Start the queue and the batching again in a forked worker, threads don't survive
+        a fork. The loaded model is kept, its weights stay shared with the parent."""
+        self.__start_scheduling()
+
+    def load_in_background(self) -> Thread:
+        """Load the model without blocking the server, `ready` is set once it is done."""
+        thread = Thread(target=self.load, daemon=True)
+        thread.start()
+        return thread
+
+    def configure_threads(self, cores=None):
+        """Give each generation slot its budget of torch threads. The setting is global to
+        the process but every generation thread runs its operations on its own team of that
+        many threads, so the slots don't oversubscribe the `cores` (the cores this process
+        may run on by default)."""
+        if cores is None:
+            cores = len(available_cores())
+        threads = self.threads_per_slot or max(1, cores // self.generation_concurrency)
+        torch.set_num_threads(threads)
+        metrics.set("torch_threads_per_slot", threads)
+        print(f"{self.generation_concurrency} generation slots of {threads} threads")
+
+    def load(self, model=None, processor=None, warmup=None, configure_threads=True, device=None):
+        """Load the model named by MODEL_NAME and those of DEFAULT_PRESET and PRELOAD_PRESETS,
+        or use the given model and processor for every preset (e.g. the tiny offline model of
+        the benchmarks). The models of the other presets are loaded on their first request.
+        `warmup` defaults to WARMUP_ON_LOAD, the threads are left alone by a process forking
+        workers afterwards (see serve.py). `device` defaults to the GPU when there is one."""
         print("Loading model...")
         start_time = time.time()
-        self.model = MusicgenForConditionalGeneration.from_pretrained(self.model_name)
+        if device is None:
+            device = "cuda:0" if torch.cuda.is_available() else "cpu"
+        if warmup is None:
+            warmup = self.warmup_on_load
+        if configure_threads:
+            self.configure_threads()
+        try:
+            # CPU_PRECISION only applies on CPU, the GPU runs the model in half precision
+            self.precision = self.cpu_precision if device == "cpu" else "fp16"
+            self.device = device
+            given_model = model is not None
+            self.given_model = given_model
+            if given_model:
+                model = self.__prepare_model(model, device, self.load_timings)
+            else:
+                model, processor = self.__load_model(self.model_name, device, self.load_timings)
+            self.model = model
+            self.processor = processor
+            self.text_encodings = TextEncodingCache(
+                self.model, self.processor, self.text_encoding_cache_size
+            )
+            self.sampling_rate = self.model.audio_encoder.config.sampling_rate
+            self.frame_rate = self.model.audio_encoder.config.frame_rate
 
-        device = "cuda:0" if torch.cuda.is_available() else "cpu"
-        print(f"Current Device: {self.model.device}")
-        if device != self.model.device:
+            default = ModelVariant(
+                self.model_name, self.model, self.processor, self.text_encodings
+            )
+            self.variants = {self.model_name: default}
+            for name in [self.default_preset, *self.preload_presets]:
+                try:
+                    self.prepare_preset(self.presets[name])
+                except ValueError:
+                    # the other presets are still served
+                    pass
+            if self.default_preset in self.preset_errors:
+                raise RuntimeError(
+                    f"Default preset {self.default_preset} is unavailable: "
+                    f"{self.preset_errors[self.default_preset]}"
+                )
+
+            if warmup:
+                phase_start = time.time()
+                self.warmup()
+                self.load_timings["warmup_s"] = time.time() - phase_start
+        except Exception as e:
+            self.load_error = e
+            print(f"Model failed to load: {e}")
+            raise
+
+        self.load_timings["total_s"] = time.time() - start_time
+        for phase, duration in self.load_timings.items():
+            metrics.set(f"model_load_{phase}", duration)
+        print(f"Model loaded in {self.load_timings['total_s']} seconds ({self.load_timings}).")
+        self.ready.set()
+
+    def __load_model(self, model_name, device, timings=None):
+        """Download and deserialize a model, on `device` and in the service's precision."""
+        timings = timings if timings is not None else {}
+        # Download
+        phase_start = time.time()
+        if os.path.isdir(model_name):
+            model_path = model_name
+        else:
+            model_path = snapshot_download(model_name, allow_patterns=MODEL_FILE_PATTERNS)
+        timings["download_s"] = time.time() - phase_start
+
+        # Deserialize, straight to half precision when it is going to run on the GPU
+        phase_start = time.time()
+        model = MusicgenForConditionalGeneration.from_pretrained(
+            model_path,
+            use_safetensors=True,
+            low_cpu_mem_usage=True,
+            torch_dtype=torch.float16 if device == "cuda:0" else torch.float32,
+        )
+        processor = MusicgenProcessor.from_pretrained(model_path)
+        timings["deserialize_s"] = time.time() - phase_start
+        return self.__prepare_model(model, device, timings), processor
+
+    def __prepare_model(self, model, device, timings):
+        # Device move
+        phase_start = time.time()
+        print(f"Current Device: {model.device}")
+        if device != model.device:
             print("Loading model into  GPU")
-            self.model.to(device)
-            if device == "cuda:0":
-                self.model.half()
-
-        self.processor = MusicgenProcessor.from_pretrained(self.model_name)
-
-        self.sampling_rate = self.model.audio_encoder.config.sampling_rate
-        self.frame_rate = self.model.audio_encoder.config.frame_rate
-
-        end_time = time.time()
-        print(f"Model loaded in {end_time - start_time} seconds.")
-
-    def genHeader(self, sampleRate, bitsPerSample, channels):
-        datasize = 2000 * 10**6
-        o = bytes("RIFF", "ascii")  # (4byte) Marks file as RIFF
-        o += (datasize + 36).to_bytes(
-            4, "little"
-        )  # (4byte) File size in bytes excluding this and RIFF marker
-        o += bytes("WAVE", "ascii")  # (4byte) File type
-        o += bytes("fmt ", "ascii")  # (4byte) Format Chunk Marker
-        o += (16).to_bytes(4, "little")  # (4byte) Length of above format data
-        o += (1).to_bytes(2, "little")  # (2byte) Format type (1 - PCM)
-        o += (channels).to_bytes(2, "little")  # (2byte)
-        o += (sampleRate).to_bytes(4, "little")  # (4byte)
-        o += (sampleRate * channels * bitsPerSample // 8).to_bytes(
-            4, "little"
-        )  # (4byte)
-        o += (channels * bitsPerSample // 8).to_bytes(2, "little")  # (2byte)
-        o += (bitsPerSample).to_bytes(2, "little")  # (2byte)
-        o += bytes("data", "ascii")  # (4byte) Data Chunk Marker
-        o += (datasize).to_bytes(4, "little")  # (4byte) Data size in bytes
-        return o
+            model.to(device)
+        timings["device_move_s"] = time.time() - phase_start
+
+        if self.precision == "int8":
+            phase_start = time.time()
+            apply_cpu_precision(model, self.precision)
+            timings["quantize_s"] = time.time() - phase_start
+        return model
+
+    def get_preset(self, name=None) -> GenerationPreset:
+        """The preset of that name, DEFAULT_PRESET by default. Raises ValueError when there
+        is no such preset or when its model couldn't be loaded."""
+        name = name or self.default_preset
+        if name not in self.presets:
+            raise ValueError(f"Unknown preset {name!r}, expected one of {list(self.presets)}.")
+        if name in self.preset_errors:
+            raise ValueError(f"Preset {name} is unavailable: {self.preset_errors[name]}")
+        return self.presets[name]
+
+    def prepare_preset(self, preset: GenerationPreset) -> ModelVariant:
+        """The model of the preset, loaded on the first call, which blocks until it is done.
+        Raises ValueError when it couldn't be loaded, the preset is unavailable from then on."""
+        model_name = preset.model or self.model_name
+        variant = self.variants.get(model_name)
+        if variant is not None:
+            return variant
+        with self.variants_lock:
+            if preset.name in self.preset_errors:
+                raise ValueError(
+                    f"Preset {preset.name} is unavailable: {self.preset_errors[preset.name]}"
+                )
+            variant = self.variants.get(model_name)
+            if variant is not None:
+                return variant
+            if self.given_model:
+                # the given model stands in for every variant
+                variant = self.variants[self.model_name]
+            else:
+                try:
+                    phase_start = time.time()
+                    variant_model, variant_processor = self.__load_model(model_name, self.device)
+                    variant = ModelVariant(
+                        model_name,
+                        variant_model,
+                        variant_processor,
+                        TextEncodingCache(
+                            variant_model, variant_processor, self.text_encoding_cache_size
+                        ),
+                    )
+                    duration = time.time() - phase_start
+                    self.load_timings[f"variant_{preset.name}_s"] = duration
+                    metrics.set(f"model_load_variant_{preset.name}_s", duration)
+                except Exception as e:
+                    print(f"Model {model_name} of preset {preset.name} failed to load: {e}")
+                    self.preset_errors[preset.name] = str(e)
+                    raise ValueError(f"Preset {preset.name} is unavailable: {e}") from e
+            self.variants[model_name] = variant
+            return variant
+
+    def describe_presets(self) -> dict:
+        return {
+            "default": self.default_preset,
+            "presets": {
+                name: {
+                    **preset.to_dict(),
+                    "loaded": (preset.model or self.model_name) in self.variants,
+                    "available": name not in self.preset_errors,
+                    "error": self.preset_errors.get(name),
+                }
+                for name, preset in self.presets.items()
+            },
+        }
+
+    def __decode_mode(self, decode_mode=None, preset=None) -> str:
+        """The decode mode of the request, else the preset's, else DECODE_MODE."""
+        return (
+            decode_mode or (preset.decode_mode if preset is not None else None) or self.decode_mode
+        )
+
+    def __variant(self, preset=None) -> ModelVariant:
+        preset = preset or self.presets[self.default_preset]
+        return self.prepare_preset(preset)
+
+    def warmup(self):
+        """Stream a short generation so the first request doesn't pay for kernel selection
+        and memory allocation. It runs the first chunks of the default schedule, which primes
+        the decoding of the first and of the following windows. Every loaded model is warmed
+        up, with the first preset using it."""
+        max_new_tokens = int(self.frame_rate * 2 * self.default_schedule.max_chunk_s)
+        warmed_up = []
+        for name, preset in self.presets.items():
+            variant = self.variants.get(preset.model or self.model_name)
+            if variant is None or variant in warmed_up:
+                continue
+            warmed_up.append(variant)
+            streamer = self.__create_streamer(
+                self.default_schedule, max_new_tokens, model=variant.model
+            )
+            self.__generate(
+                seed=0,
+                prompts=["warm up"],
+                streamer=streamer,
+                max_new_tokens=max_new_tokens,
+                preset=preset,
+            )
+            for _ in streamer:
+                pass
 
     def generate_audio_stream(
-        self, uuid, text_prompt, audio_length_in_s=10.0, play_steps_in_s=4.0, seed=0
+        self,
+        uuid,
+        text_prompt,
+        audio_length_in_s=10.0,
+        schedule=None,
+        seed=0,
+        decode_mode=None,
+        ticket=None,
+        sample_format=None,
+        output_format="wav",
+        preset=None,
     ):
-        max_new_tokens = int(self.frame_rate * audio_length_in_s)
-        play_steps = int(self.frame_rate * play_steps_in_s)
+        """Queue the generation right away and return a generator streaming its audio bytes.
+
+        `preset` is the GenerationPreset of the generation, DEFAULT_PRESET by default.
+        `schedule` is the ChunkSchedule of the stream, the one of the preset by default.
+        `ticket` is the place reserved with `admit()`, one is reserved here when not given.
+        `sample_format` is one of SAMPLE_FORMATS, PCM_FORMAT by default, used for the WAV
+        output. `output_format` is one of OUTPUT_FORMATS, the stored track is a WAV
+        whatever the format streamed to the client."""
+        if ticket is None:
+            ticket = self.admit()
 
-        inputs = self.processor(
-            text=text_prompt,
-            padding=True,
-            return_tensors="pt",
+        preset = preset or self.get_preset()
+        schedule = self.__generation_schedule(schedule or self.chunk_schedule(preset=preset))
+        decode_mode = self.__decode_mode(decode_mode, preset)
+        try:
+            if output_format != "wav":
+                # fail before generating anything when the encoder can't be used
+                require_av(output_format)
+            key = self.generation_key(
+                text_prompt, audio_length_in_s, schedule, seed, decode_mode, preset
+            )
+            if self.batch_scheduler is not None:
+                request = self.batch_scheduler.submit(
+                    text_prompt,
+                    audio_length_in_s,
+                    schedule,
+                    seed,
+                    ticket=ticket,
+                    preset=preset,
+                    decode_mode=decode_mode,
+                )
+                audio_stream = request.stream(
+                    max_samples=int(audio_length_in_s * self.sampling_rate)
+                )
+            else:
+                model = self.__variant(preset).model
+                max_new_tokens = self.__new_tokens(audio_length_in_s, model)
+
+                audio_stream = self.__create_streamer(
+                    schedule, max_new_tokens, decode_mode, model=model
+                )
+
+                generation_kwargs = dict(
+                    prompts=[text_prompt],
+                    streamer=audio_stream,
+                    max_new_tokens=max_new_tokens,
+                    stopping_criteria=StoppingCriteriaList([CancellationCriteria([ticket])]),
+                    preset=preset,
+                )
+                self.generation_pool.submit(
+                    [ticket], self.__generate, seed=seed, **generation_kwargs
+                )
+        except Exception:
+            ticket.release()
+            raise
+
+        return self.__stream_audio(
+            uuid,
+            audio_stream,
+            ticket,
+            cache_key=key,
+            sample_format=sample_format,
+            output_format=output_format,
         )
 
-        streamer = MusicgenStreamer(
-            self.model, device=self.model.device, play_steps=play_steps
+    def chunk_schedule(self, first_chunk_s=None, growth=None, max_chunk_s=None, preset=None):
+        """The chunk schedule of the preset, with the values given for this request. The
+        values the preset leaves to None are those of the default chunk schedule."""
+        if preset is not None:
+            first_chunk_s = first_chunk_s or preset.first_chunk_s
+            growth = growth or preset.chunk_growth
+            max_chunk_s = max_chunk_s or preset.max_chunk_s
+        default = self.default_schedule
+        if first_chunk_s is None and growth is None and max_chunk_s is None:
+            return default
+        first_chunk_s = first_chunk_s or default.first_chunk_s
+        return ChunkSchedule(
+            first_chunk_s=first_chunk_s,
+            growth=growth or default.growth,
+            max_chunk_s=max(max_chunk_s or default.max_chunk_s, first_chunk_s),
+            safety=default.safety,
         )
 
-        generation_kwargs = dict(
-            **inputs.to(self.model.device),
-            streamer=streamer,
-            max_new_tokens=max_new_tokens,
+    def __generation_schedule(self, schedule: ChunkSchedule) -> ChunkSchedule:
+        """The schedule a generation streams with. The boundaries of adaptive chunks depend
+        on the speed of the host, and with incremental decoding so does the audio (through
+        the crossfades at the boundaries): with the cache, the chunks only depend on the
+        parameters of the schedule so that a cached track is the audio of its key."""
+        if self.cache is None:
+            return schedule
+        return schedule.without_adaptation()
+
+    def generation_key(
+        self, text_prompt, audio_length_in_s, schedule=None, seed=0, decode_mode=None, preset=None
+    ):
+        preset = preset or self.presets[self.default_preset]
+        variant = self.__variant(preset)
+        generation_config = variant.model.generation_config
+        overrides = preset.generation_kwargs()
+        params = {
+            "do_sample": generation_config.do_sample,
+            "guidance_scale": overrides.get("guidance_scale", generation_config.guidance_scale),
+            "temperature": overrides.get("temperature", generation_config.temperature),
+            "top_k": overrides.get("top_k", generation_config.top_k),
+            "top_p": overrides.get("top_p", generation_config.top_p),
+            # the chunk boundaries change the crossfades of the incremental decoding
+            "schedule": self.__generation_schedule(
+                schedule or self.chunk_schedule(preset=preset)
+            ).key(),
+            "decode_mode": self.__decode_mode(decode_mode, preset),
+            "precision": self.precision,
+        }
+        if audio_length_in_s > self.long_form_window_s:
+            params["long_form"] = (self.long_form_window_s, self.long_form_context_s)
+        return cache_key(variant.name, text_prompt, audio_length_in_s, seed, params)
+
+    def find_cached(
+        self, text_prompt, audio_length_in_s, schedule=None, seed=0, decode_mode=None, preset=None
+    ):
+        """The cached audio of an identical generation, or None."""
+        if self.cache is None:
+            return None
+        key = self.generation_key(
+            text_prompt, audio_length_in_s, schedule, seed, decode_mode, preset
         )
-        thread = Thread(target=self.model.generate, kwargs=generation_kwargs)
-        thread.start()
+        entry = self.cache.get(key)
+        metrics.increment("cache_hits" if entry is not None else "cache_misses")
+        return entry
 
-        set_seed(seed)
+    def replay_audio_stream(
+        self, uuid, entry: CacheEntry, sample_format=None, output_format="wav"
+    ):
+        """Stream a cached generation, with the chunks it was generated in."""
+        if output_format != "wav":
+            require_av(output_format)
+        return self.__stream_audio(
+            uuid, entry.chunks(), sample_format=sample_format, output_format=output_format
+        )
 
+    def admit(self):
+        """Reserve a place in the generation pool, raises QueueFullError when it is full."""
+        return self.generation_pool.admit()
 
-        bitsPerSample = 16
+    def __stream_audio(
+        self,
+        uuid,
+        audio_stream,
+        ticket=None,
+        cache_key=None,
+        sample_format=None,
+        output_format="wav",
+    ):
+        sample_format = sample_format or self.sample_format
         channels = 1
-        wav_header = self.genHeader(self.sampling_rate, bitsPerSample, channels)
+        encoder = PcmEncoder(sample_format, channels, dither=self.dither)
+        header = wav_header(self.sampling_rate, channels, sample_format)
+        # the client gets compressed frames, the WAV is still stored
+        compressed = None
+        if output_format != "wav":
+            compressed = StreamingAudioEncoder(
+                output_format, self.sampling_rate, channels, bitrate=get_bitrate(output_format)
+            )
 
-        source_file_name = "output.wav"
-        binary_chunks_to_write = []
+        # every chunk is piped to storage as soon as it is produced, the header of the stored
+        # file is written once its size is known
+        upload = self.storage.open_upload(
+            f"{uuid}/output.wav", content_type="audio/wav", header_size=len(header)
+        )
+        completed = False
+        failed = False
+        chunks = []
 
-        # yielding the audio as stream
-        first_run = True
-        for new_audio in streamer:
-            print(
-                f"Sample of length: {round(new_audio.shape[0] / self.sampling_rate, 2)} seconds"
-            )
-            if first_run:
-                data = wav_header + np.int16(new_audio * self.sampling_rate).tobytes()
+        try:
+            # yielding the audio as stream
+            first_run = True
+            for new_audio in audio_stream:
+                if cache_key is not None:
+                    chunks.append(new_audio)
+                length_s = round(new_audio.shape[0] / self.sampling_rate, 2)
+                print(f"Sample of length: {length_s} seconds")
+                data = encoder.encode(new_audio)
+                upload.write(data)
+                if compressed is not None:
+                    data = compressed.encode(new_audio)
+                elif first_run:
+                    data = header + data
                 first_run = False
+                if data:
+                    yield data
+            if compressed is not None:
+                yield compressed.close()
+            # a cancelled generation ends early, its audio is incomplete
+            completed = ticket is None or not ticket.cancelled
+        except Exception:
+            # the generation or its decoding failed, the track is truncated
+            failed = True
+            raise
+        finally:
+            # the upload finishes in the background, the response is not held back by it
+            if completed:
+                upload.close(
+                    header=wav_header(self.sampling_rate, channels, sample_format, upload.size)
+                )
+                metrics.increment("generations_completed")
+                if cache_key is not None and self.cache is not None:
+                    self.cache.put(cache_key, CacheEntry.from_chunks(chunks, self.sampling_rate))
             else:
-                data = np.int16(new_audio * self.sampling_rate).tobytes()
-            binary_chunks_to_write.append(data)
-            yield data
+                upload.abort()
+                metrics.increment("generations_failed" if failed else "generations_cancelled")
 
+    def __create_streamer(
+        self, schedule, max_new_tokens, decode_mode=None, batch_size=1, model=None
+    ):
+        model = model or self.model
+        return MusicgenStreamer(
+            model,
+            device=model.device,
+            schedule=schedule,
+            decode_mode=decode_mode or self.decode_mode,
+            context_frames=int(self.frame_rate * self.decode_context_s),
+            overlap_frames=int(self.frame_rate * self.decode_overlap_s),
+            # the buffer of a stream generated in windows holds about one window
+            max_new_tokens=min(max_new_tokens, int(self.frame_rate * self.long_form_window_s)),
+            batch_size=batch_size,
+            decode_worker=self.decode_worker,
+        )
 
-        reassembled_binary_data = b"".join(binary_chunks_to_write)
+    def __run_batch(self, requests):
+        # requests are only batched with requests using the same preset, decode mode and seed
+        preset = requests[0].preset
+        model = self.__variant(preset).model
+        # the batch runs until its longest request is done, shorter ones are cut when streamed
+        max_new_tokens = self.__new_tokens(
+            max(request.audio_length_in_s for request in requests), model
+        )
+        streamer = self.__create_streamer(
+            requests[0].schedule,
+            max_new_tokens,
+            decode_mode=requests[0].decode_mode,
+            batch_size=len(requests),
+            model=model,
+        )
 
-        # Save the binary data to a .wav file
-        with open("output.wav", "wb") as wav_file:
-            wav_file.write(reassembled_binary_data)
+        tickets = [request.ticket for request in requests]
+        generation_kwargs = dict(
+            prompts=[request.text_prompt for request in requests],
+            streamer=streamer,
+            max_new_tokens=max_new_tokens,
+            stopping_criteria=StoppingCriteriaList([CancellationCriteria(tickets)]),
+            preset=preset,
+        )
+        self.generation_pool.submit(
+            tickets, self.__generate, seed=requests[0].seed, **generation_kwargs
+        )
+        print(f"Generating a batch of {len(requests)} requests ({max_new_tokens} tokens)")
 
-        print("Audio file has been reassembled and saved as 'output.wav'.")
-        
-        self.__upload_to_gcs(uuid, source_file_name)
-        self.__delete_local_file(source_file_name)
+        for row, request in enumerate(requests):
+            request.start(streamer, row)
 
-    def __delete_local_file(self, file_name):
-        if os.path.exists(file_name):
-            os.remove(file_name)
-            print(f"File {file_name} deleted from local filesystem.")
-        else:
-            print(f"File {file_name} not found.")
+    def __new_tokens(self, audio_length_in_s, model) -> int:
+        """Tokens to generate for `audio_length_in_s` of audio. Each codebook is delayed by one
+        more step than the previous one, the codes of the last frame are only complete
+        num_codebooks - 1 tokens after its first one."""
+        return int(self.frame_rate * audio_length_in_s) + model.decoder.num_codebooks - 1
 
-    def __upload_to_gcs(self, uuid, source_file_name):
-        file_uri = f"{uuid}/{source_file_name}"
-        storage_client = storage.Client()
-        bucket = storage_client.bucket(self.bucket_name)
-        blob = bucket.blob(file_uri)
+    def __generate(
+        self, seed, prompts, streamer, max_new_tokens, preset=None, **generation_kwargs
+    ):
+        try:
+            preset = preset or self.presets[self.default_preset]
+            model = self.__variant(preset).model
+            generation_kwargs.update(preset.generation_kwargs())
+            # the prompts are encoded in the generation thread, or taken from the cache
+            generation_kwargs.update(
+                self.__variant(preset).text_encodings.inputs(
+                    prompts, guidance_scale=generation_kwargs.get("guidance_scale")
+                )
+            )
+            # seeded in the generation thread, right before sampling starts
+            set_seed(seed)
+            with precision_context(self.precision):
+                # the tokens completing the last frame don't make a track longer than a window
+                delay = model.decoder.num_codebooks - 1
+                if max_new_tokens - delay > int(self.frame_rate * self.long_form_window_s):
+                    return self.__generate_windows(
+                        model, streamer, max_new_tokens, **generation_kwargs
+                    )
+                return model.generate(
+                    streamer=streamer, max_new_tokens=max_new_tokens, **generation_kwargs
+                )
+        except BaseException as e:
+            # the consumers would otherwise wait for the end of the stream forever
+            streamer.fail(e)
+            raise
 
-        blob.upload_from_filename(source_file_name)
+    @staticmethod
+    def __cancelled(generation_kwargs) -> bool:
+        return any(
+            isinstance(criteria, CancellationCriteria) and criteria.cancelled
+            for criteria in generation_kwargs.get("stopping_criteria", [])
+        )
 
-        print(f"File {source_file_name} uploaded to {file_uri}.")
+    def __generate_windows(self, model, streamer, max_new_tokens, **generation_kwargs):
+        """Generate a long track in windows of LONG_FORM_WINDOW_S, every window after the
+        first one continuing from the last LONG_FORM_CONTEXT_S of codes of the previous one.
+        The attention cache and the cost of a token stay those of a single window, whatever
+        the length of the track."""
+        window_tokens = int(self.frame_rate * self.long_form_window_s)
+        context_frames = int(self.frame_rate * self.long_form_context_s)
+        continuation_tokens = window_tokens - context_frames
+        delay = model.decoder.num_codebooks - 1
+        new_tokens = min(max_new_tokens, window_tokens)
+        decoder_input_ids = None
+        windows = 0
+        try:
+            while True:
+                streamer.more_windows = new_tokens < max_new_tokens - streamer.generated_tokens
+                expected_tokens = streamer.generated_tokens + new_tokens
+                try:
+                    model.generate(
+                        decoder_input_ids=decoder_input_ids,
+                        streamer=streamer,
+                        max_new_tokens=new_tokens,
+                        **generation_kwargs,
+                    )
+                except Exception:
+                    # generate can't post-process the codes of a window stopped by
+                    # cancellation, the stream still ends with the audio generated so far
+                    if not self.__cancelled(generation_kwargs):
+                        raise
+                windows += 1
+                # a window stopped early has been cancelled
+                if not streamer.more_windows or streamer.generated_tokens < expected_tokens:
+                    break
+                # the frames still missing codebooks are generated again by the next window
+                decoder_input_ids = streamer.continue_window(context_frames, continuation_tokens)
+                remaining_tokens = max_new_tokens - streamer.generated_tokens
+                # the last window also generates the tokens completing the last frame
+                if remaining_tokens <= continuation_tokens + delay:
+                    new_tokens = remaining_tokens
+                else:
+                    new_tokens = continuation_tokens
+        except BaseException:
+            # the stream is failed by the caller instead of being ended
+            streamer.more_windows = False
+            raise
+        finally:
+            metrics.increment("long_form_windows", windows)
+        if streamer.more_windows:
+            # cancelled before the last window, the stream still has to end
+            streamer.more_windows = False
+            streamer.end()
@@ -1,12 +1,87 @@
+import time
 from queue import Queue
+from threading import Thread
 from typing import Optional
 
 import numpy as np
 import torch
 
-from transformers import MusicgenForConditionalGeneration, MusicgenProcessor, set_seed
+from transformers import MusicgenForConditionalGeneration
 from transformers.generation.streamers import BaseStreamer
 
+from service.metrics import metrics
+
+# "full" re-decodes the whole token cache on every chunk (cost grows with the track length),
+# "incremental" only decodes the newest frames plus a bounded context window.
+DECODE_MODES = ("full", "incremental")
+
+
+class GenerationFailed(Exception):
+    """The generation or the decoding of a stream failed before its end."""
+
+
+class ChunkSchedule:
+    """Sizes of the chunks a stream is decoded in.
+
+    The first chunk is short so playback starts quickly, each following chunk is `growth`
+    times the previous one, up to `max_chunk_s`. A chunk only grows while the audio already
+    buffered ahead of the playback covers the time it takes to generate it (times `safety`),
+    so a slow generation keeps small chunks instead of letting the player run dry. A schedule
+    that isn't `adaptive` grows regardless of the generation speed, its chunk boundaries
+    only depend on its parameters.
+    """
+
+    def __init__(
+        self,
+        first_chunk_s: float = 1.0,
+        growth: float = 2.0,
+        max_chunk_s: float = 4.0,
+        safety: float = 1.5,
+        adaptive: bool = True,
+    ):
+        if first_chunk_s <= 0 or growth < 1 or max_chunk_s < first_chunk_s:
+            raise ValueError(
+                "Expected first_chunk_s > 0, growth >= 1 and max_chunk_s >= first_chunk_s"
+            )
+        self.first_chunk_s = first_chunk_s
+        self.growth = growth
+        self.max_chunk_s = max_chunk_s
+        self.safety = safety
+        self.adaptive = adaptive
+
+    @classmethod
+    def fixed(cls, chunk_s: float) -> "ChunkSchedule":
+        return cls(first_chunk_s=chunk_s, growth=1.0, max_chunk_s=chunk_s)
+
+    def without_adaptation(self) -> "ChunkSchedule":
+        return ChunkSchedule(
+            self.first_chunk_s, self.growth, self.max_chunk_s, self.safety, adaptive=False
+        )
+
+    def key(self) -> tuple:
+        return (self.first_chunk_s, self.growth, self.max_chunk_s, self.safety, self.adaptive)
+
+    def __eq__(self, other):
+        return isinstance(other, ChunkSchedule) and self.key() == other.key()
+
+    def __hash__(self):
+        return hash(self.key())
+
+    def first_steps(self, frame_rate: int) -> int:
+        return max(1, int(self.first_chunk_s * frame_rate))
+
+    def next_steps(
+        self, previous_steps: int, frame_rate: int, buffered_s: float, generated_fps: float
+    ) -> int:
+        """Frames of the next chunk, given the previous one, the seconds of audio buffered
+        ahead of the playback and the measured generation speed in frames per second."""
+        steps = min(int(previous_steps * self.growth), int(self.max_chunk_s * frame_rate))
+        if self.adaptive and generated_fps > 0:
+            affordable = int(buffered_s * generated_fps / self.safety)
+            steps = min(steps, max(affordable, previous_steps))
+        return max(steps, self.first_steps(frame_rate))
+
+
 class MusicgenStreamer(BaseStreamer):
     def __init__(
         self,
@@ -15,27 +90,91 @@ class MusicgenStreamer(BaseStreamer):
         play_steps: Optional[int] = 10,
         stride: Optional[int] = None,
         timeout: Optional[float] = None,
+        decode_mode: str = "incremental",
+        context_frames: Optional[int] = None,
+        overlap_frames: Optional[int] = None,
+        max_new_tokens: Optional[int] = None,
+        batch_size: int = 1,
+        decode_worker: bool = True,
+        schedule: Optional[ChunkSchedule] = None,
     ):
         self.decoder = model.decoder
         self.audio_encoder = model.audio_encoder
         self.generation_config = model.generation_config
         self.device = device if device is not None else model.device
 
+        if decode_mode not in DECODE_MODES:
+            raise ValueError(f"decode_mode must be one of {DECODE_MODES}, got {decode_mode!r}")
+        self.decode_mode = decode_mode
+        self.batch_size = batch_size
+
+        # with a schedule, `play_steps` is the size of its first chunk
+        self.frame_rate = self.audio_encoder.config.frame_rate
+        self.schedule = schedule
+        if schedule is not None:
+            play_steps = schedule.first_steps(self.frame_rate)
         self.play_steps = play_steps
+        self.chunk_steps = play_steps
+        self.next_window_at = play_steps
+        self.hop_length = int(np.prod(self.audio_encoder.config.upsampling_ratios))
         if stride is not None:
             self.stride = stride
         else:
-            hop_length = np.prod(self.audio_encoder.config.upsampling_ratios)
-            self.stride = hop_length * (play_steps - self.decoder.num_codebooks) // 6
-        self.token_cache = None
+            self.stride = self.hop_length * (play_steps - self.decoder.num_codebooks) // 6
         self.to_yield = 0
 
-        # varibles used in the thread process
-        self.audio_queue = Queue()
+        # generated tokens are written into a buffer sized for the whole generation up front,
+        # `token_cache` is a view over the part that has been written so far
+        self.max_new_tokens = max_new_tokens
+        self.token_buffer = None
+        self.cursor = 0
+        # frames of the track before the first one in the buffer, dropped by continue_window
+        self.frame_offset = 0
+
+        # long-form generation runs generate once per window, the stream only ends with the
+        # last one (see continue_window)
+        self.more_windows = False
+        self.skip_prompt = False
+        self.forced_tokens = None
+
+        # incremental decoding: frames of already streamed codes decoded again in front of each
+        # new window, and samples held back at the end of a window to crossfade with the next one
+        self.context_frames = context_frames if context_frames is not None else play_steps // 2
+        overlap_frames = (
+            overlap_frames if overlap_frames is not None else max(1, self.context_frames // 4)
+        )
+        if overlap_frames > self.context_frames:
+            raise ValueError("overlap_frames must not be larger than context_frames")
+        self.overlap = overlap_frames * self.hop_length
+        fade_in = 0.5 - 0.5 * np.cos(np.linspace(0.0, np.pi, self.overlap, dtype=np.float32))
+        self.fade_in = fade_in
+        self.fade_out = 1.0 - fade_in
+        self.overlap_tail = None
+
+        # varibles used in the thread process, one audio queue per row of the batch
+        self.audio_queues = [Queue() for _ in range(batch_size)]
+        self.audio_queue = self.audio_queues[0]
         self.stop_signal = None
         self.timeout = timeout
 
+        # the generate thread only hands the token windows over, a worker thread decodes them
+        # so token generation doesn't stall while EnCodec runs
+        self.decode_queue = Queue()
+        self.decode_thread = None
+        if decode_worker:
+            self.decode_thread = Thread(target=self._decode_loop, daemon=True)
+            self.decode_thread.start()
+
+        # time spent in each stage of the pipeline, and the seconds of audio it produced
+        self.generate_started_at = None
+        self.first_audio_at = None
+        self.timings = {"generate_s": 0.0, "decode_s": 0.0, "audio_s": 0.0}
+
     def apply_delay_pattern_mask(self, input_ids):
+        audio_codes = self.revert_delay_pattern(input_ids)
+        return self.decode_audio_codes(audio_codes)
+
+    def revert_delay_pattern(self, input_ids):
         # build the delay pattern mask for offsetting each codebook prediction by 1 (this behaviour is specific to MusicGen)
         _, decoder_delay_pattern_mask = self.decoder.build_delay_pattern_mask(
             input_ids[:, :1],
@@ -43,65 +182,284 @@ class MusicgenStreamer(BaseStreamer):
             max_length=input_ids.shape[-1],
         )
         # apply the pattern mask to the input ids
-        input_ids = self.decoder.apply_delay_pattern_mask(
-            input_ids, decoder_delay_pattern_mask
-        )
+        input_ids = self.decoder.apply_delay_pattern_mask(input_ids, decoder_delay_pattern_mask)
 
         # revert the pattern delay mask by filtering the pad token id
         input_ids = input_ids[input_ids != self.generation_config.pad_token_id].reshape(
-            1, self.decoder.num_codebooks, -1
+            self.batch_size, self.decoder.num_codebooks, -1
         )
 
         # append the frame dimension back to the audio codes
         input_ids = input_ids[None, ...]
 
         # send the input_ids to the correct device
-        input_ids = input_ids.to(self.audio_encoder.device)
+        return input_ids.to(self.audio_encoder.device)
 
+    def decode_audio_codes(self, audio_codes):
         output_values = self.audio_encoder.decode(
-            input_ids,
-            audio_scales=[None],
+            audio_codes,
+            audio_scales=[None] * self.batch_size,
         )
-        audio_values = output_values.audio_values[0, 0]
+        audio_values = output_values.audio_values[:, 0]
         return audio_values.cpu().float().numpy()
 
+    def decode_window(self, input_ids, stream_end: bool = False, frame_offset: int = 0):
+        """Decode the frames generated since the last chunk, with `context_frames` of already
+        streamed codes in front so the codec starts from a warmed-up state. The first samples
+        are crossfaded with the tail held back from the previous window. The codes start
+        `frame_offset` frames into the track."""
+        audio_codes = self.revert_delay_pattern(input_ids)
+        to_yield = self.to_yield - frame_offset * self.hop_length
+        start_frame = max(0, to_yield // self.hop_length - self.context_frames)
+        audio_values = self.decode_audio_codes(audio_codes[..., start_frame:])
+        new_audio = audio_values[:, to_yield - start_frame * self.hop_length :]
+
+        if self.overlap_tail is not None:
+            seam = min(self.overlap_tail.shape[-1], new_audio.shape[-1])
+            new_audio[:, :seam] = (
+                self.overlap_tail[:, :seam] * self.fade_out[:seam]
+                + new_audio[:, :seam] * self.fade_in[:seam]
+            )
+
+        if stream_end:
+            self.overlap_tail = None
+        elif new_audio.shape[-1] > self.overlap:
+            self.overlap_tail = new_audio[:, -self.overlap :].copy()
+            new_audio = new_audio[:, : -self.overlap]
+        else:
+            # not enough new audio for a seam yet, keep all of it for the next window
+            self.overlap_tail = new_audio.copy()
+            return new_audio[:, :0]
+
+        self.to_yield += new_audio.shape[-1]
+        return new_audio
+
+    @property
+    def token_cache(self):
+        if self.token_buffer is None:
+            return None
+        return self.token_buffer[:, : self.cursor]
+
+    def write_tokens(self, tokens):
+        num_tokens = tokens.shape[-1]
+        if self.token_buffer is None:
+            # the first call holds the decoder prompt, every following call a single frame
+            capacity = num_tokens + (
+                self.max_new_tokens if self.max_new_tokens is not None else self.play_steps
+            )
+            self.token_buffer = torch.empty((tokens.shape[0], capacity), dtype=tokens.dtype)
+        elif self.cursor + num_tokens > self.token_buffer.shape[-1]:
+            # more tokens than announced, grow geometrically to keep appends amortised
+            capacity = max(2 * self.token_buffer.shape[-1], self.cursor + num_tokens)
+            token_buffer = torch.empty((tokens.shape[0], capacity), dtype=tokens.dtype)
+            token_buffer[:, : self.cursor] = self.token_cache
+            self.token_buffer = token_buffer
+
+        self.token_buffer[:, self.cursor : self.cursor + num_tokens] = tokens
+        self.cursor += num_tokens
+
     def put(self, value):
         batch_size = value.shape[0] // self.decoder.num_codebooks
-        if batch_size > 1:
-            raise ValueError("MusicgenStreamer only supports batch size 1")
+        if batch_size != self.batch_size:
+            raise ValueError(
+                f"MusicgenStreamer was created for batch size {self.batch_size}, got {batch_size}"
+            )
 
-        if self.token_cache is None:
-            self.token_cache = value
-        else:
-            self.token_cache = torch.concatenate(
-                [self.token_cache, value[:, None]], dim=-1
+        if self.generate_started_at is None:
+            self.generate_started_at = time.perf_counter()
+        if self.skip_prompt:
+            # the prompt of a continuation window holds frames that are already in the buffer
+            self.skip_prompt = False
+            return
+        tokens = value if value.dim() == 2 else value[:, None]
+        if self.forced_tokens is not None and self.forced_tokens.shape[-1]:
+            forced = self.forced_tokens[:, :1]
+            tokens = torch.where(forced == -1, tokens, forced)
+            self.forced_tokens = self.forced_tokens[:, 1:]
+        self.write_tokens(tokens)
+
+        if self.token_cache.shape[-1] >= self.next_window_at:
+            self.submit_window(self.token_cache.clone())
+            self.chunk_steps = self.next_chunk_steps()
+            self.next_window_at += self.chunk_steps
+
+    def next_chunk_steps(self) -> int:
+        if self.schedule is None:
+            return self.play_steps
+
+        now = time.perf_counter()
+        submitted_s = self.cursor / self.frame_rate
+        # playback starts when the first audio comes out of the decoder
+        played_s = now - self.first_audio_at if self.first_audio_at is not None else 0.0
+        elapsed = now - self.generate_started_at
+        generated_fps = self.cursor / elapsed if elapsed > 0 else 0.0
+        return self.schedule.next_steps(
+            self.chunk_steps, self.frame_rate, submitted_s - played_s, generated_fps
+        )
+
+    @property
+    def generated_tokens(self) -> int:
+        """Tokens generated for the track so far, counted as generate counts its new tokens."""
+        if self.token_buffer is None:
+            return 0
+        # the first column holds the decoder start token
+        return self.frame_offset + self.cursor - 1
+
+    def continue_window(self, prompt_frames: int, max_new_tokens: int):
+        """Prepare the stream for the next window of a long-form generation, which generates
+        up to `max_new_tokens`, and return its decoder prompt: the start token followed by the
+        last `prompt_frames` complete frames of codes.
+
+        The frames whose delayed codebooks are not all generated yet are dropped, the next
+        window generates them again after the prompt. With incremental decoding the codes
+        before both the prompt and the decoding context are dropped as well, so the buffer
+        and the work of each chunk don't grow with the length of the track."""
+        num_codebooks = self.decoder.num_codebooks
+        start_token_id = self.generation_config.decoder_start_token_id
+        audio_codes = self.revert_delay_pattern(self.token_cache)[0]
+        frames = audio_codes.shape[-1]
+
+        first_frame = 0
+        if self.decode_mode == "incremental":
+            # `to_yield` may lag behind while the decode worker runs, which only keeps more
+            streamed_frames = self.to_yield // self.hop_length - self.frame_offset
+            first_frame = max(
+                0, min(frames - prompt_frames, streamed_frames - self.context_frames)
             )
 
-        if self.token_cache.shape[-1] % self.play_steps == 0:
-            audio_values = self.apply_delay_pattern_mask(self.token_cache)
-            self.on_finalized_audio(audio_values[self.to_yield : -self.stride])
-            self.to_yield += len(audio_values) - self.to_yield - self.stride
+        def with_start_token(codes):
+            codes = codes.reshape(self.batch_size * num_codebooks, -1).cpu()
+            start = torch.full((codes.shape[0], 1), start_token_id, dtype=codes.dtype)
+            return torch.cat([start, codes], dim=-1)
+
+        # the kept frames are delayed again from a new start token
+        token_cache, _ = self.decoder.build_delay_pattern_mask(
+            with_start_token(audio_codes[..., first_frame:]),
+            pad_token_id=start_token_id,
+            max_length=frames - first_frame + 2 * num_codebooks,
+        )
+        self.token_buffer = None
+        self.cursor = 0
+        self.max_new_tokens = max_new_tokens
+        self.write_tokens(token_cache)
+        self.frame_offset += first_frame
+        self.next_window_at -= first_frame
+
+        prompt = with_start_token(audio_codes[..., -prompt_frames:])
+        # generate streams what it samples, not the prompt codes it puts in place of the
+        # delayed codebooks of the first columns after the prompt
+        _, pattern_mask = self.decoder.build_delay_pattern_mask(
+            prompt, pad_token_id=start_token_id, max_length=prompt.shape[-1] + 2 * num_codebooks
+        )
+        self.forced_tokens = pattern_mask[
+            :, prompt.shape[-1] : prompt.shape[-1] + num_codebooks - 1
+        ]
+        self.skip_prompt = True
+        return prompt
 
     def end(self):
         """Flushes any remaining cache and appends the stop symbol."""
-        if self.token_cache is not None:
-            audio_values = self.apply_delay_pattern_mask(self.token_cache)
+        if self.more_windows:
+            # generate ends every window, the stream goes on with the next one
+            return
+        if self.generate_started_at is not None:
+            self.timings["generate_s"] = time.perf_counter() - self.generate_started_at
+        tokens = self.token_cache.clone() if self.token_cache is not None else None
+        self.submit_window(tokens, stream_end=True)
+
+    def fail(self, error: BaseException):
+        """End the stream with `error`, raised to the consumers after the audio before it."""
+        if self.decode_thread is not None:
+            self.decode_queue.put(error)
         else:
-            audio_values = np.zeros(self.to_yield)
-        self.on_finalized_audio(audio_values[self.to_yield :], stream_end=True)
+            self.on_failed(error)
 
-    def on_finalized_audio(self, audio: np.ndarray, stream_end: bool = False):
-        """Put the new audio in the queue. If the stream is ending, also put a stop signal in the queue."""
-        self.audio_queue.put(audio, timeout=self.timeout)
+    def submit_window(self, tokens, stream_end: bool = False):
+        if self.decode_thread is not None:
+            self.decode_queue.put((tokens, stream_end, self.frame_offset))
+        else:
+            self.process_window(tokens, stream_end, self.frame_offset)
+
+    def process_window(self, tokens, stream_end: bool = False, frame_offset: int = 0):
+        """Decode a snapshot of the token cache and put its new audio in the queues."""
+        start_time = time.perf_counter()
+        # EnCodec always decodes in the precision of its weights, even inline under autocast
+        with torch.inference_mode(), torch.autocast(torch.device(self.device).type, enabled=False):
+            if tokens is None:
+                audio_values = np.zeros((self.batch_size, 0), dtype=np.float32)
+            elif self.decode_mode == "incremental":
+                audio_values = self.decode_window(
+                    tokens, stream_end=stream_end, frame_offset=frame_offset
+                )
+            else:
+                audio_values = self.apply_delay_pattern_mask(tokens)
+                if stream_end:
+                    audio_values = audio_values[:, self.to_yield :]
+                else:
+                    audio_values = audio_values[:, self.to_yield : -self.stride]
+                    self.to_yield += audio_values.shape[-1]
+        self.timings["decode_s"] += time.perf_counter() - start_time
+        self.timings["audio_s"] += audio_values.shape[-1] / self.audio_encoder.config.sampling_rate
+        self.on_finalized_audio(audio_values, stream_end=stream_end)
         if stream_end:
-            self.audio_queue.put(self.stop_signal, timeout=self.timeout)
+            self.report_timings()
+
+    def _decode_loop(self):
+        while True:
+            item = self.decode_queue.get()
+            if isinstance(item, BaseException):
+                self.on_failed(item)
+                return
+            tokens, stream_end, frame_offset = item
+            try:
+                self.process_window(tokens, stream_end, frame_offset)
+            except Exception as e:
+                print(f"Decoding failed: {e}")
+                # the consumers get the error instead of a stream that looks complete
+                self.on_failed(e)
+                return
+            if stream_end:
+                return
+
+    def report_timings(self):
+        metrics.increment("pipeline_generate_s", self.timings["generate_s"])
+        metrics.increment("pipeline_decode_s", self.timings["decode_s"])
+        metrics.increment("pipeline_audio_s", self.timings["audio_s"])
+
+    def on_finalized_audio(self, audio: np.ndarray, stream_end: bool = False):
+        """Put the new audio of each row in its queue. If the stream is ending, also put a stop
+        signal in the queues."""
+        if self.first_audio_at is None and audio.shape[-1]:
+            self.first_audio_at = time.perf_counter()
+        for audio_queue, row_audio in zip(self.audio_queues, audio):
+            audio_queue.put(row_audio, timeout=self.timeout)
+            if stream_end:
+                audio_queue.put(self.stop_signal, timeout=self.timeout)
+
+    def on_failed(self, error: BaseException):
+        """Put the error in the queues in place of the rest of the audio."""
+        for audio_queue in self.audio_queues:
+            audio_queue.put(error, timeout=self.timeout)
+
+    def iter_row(self, row: int):
+        """Iterate over the audio of a single row of the batch."""
+        audio_queue = self.audio_queues[row]
+        while True:
+            value = audio_queue.get(timeout=self.timeout)
+            if isinstance(value, BaseException):
+                raise GenerationFailed(f"Generation failed: {value}") from value
+            if not isinstance(value, np.ndarray) and value == self.stop_signal:
+                return
+            yield value
 
     def __iter__(self):
         return self
 
     def __next__(self):
         value = self.audio_queue.get(timeout=self.timeout)
+        if isinstance(value, BaseException):
+            raise GenerationFailed(f"Generation failed: {value}") from value
         if not isinstance(value, np.ndarray) and value == self.stop_signal:
             raise StopIteration()
         else:
-            return value
\ No newline at end of file
+            return value
@@ -0,0 +1,96 @@
+import json
+from typing import Dict, Optional
+
+from service.musicgen_stream import DECODE_MODES
+
+# sampling parameters of the generation config a preset may override
+SAMPLING_PARAMETERS = ("guidance_scale", "top_k", "top_p", "temperature")
+
+
+class GenerationPreset:
+    """A named trade-off between speed and quality.
+
+    It bundles the model variant generating the track (MODEL_NAME when None), its sampling
+    parameters and the chunk schedule and decoding of the stream. The values left to None
+    are those of the model's generation config and of the service settings. `measured`
+    holds the latency and real-time factor of the preset as measured by the benchmarks.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        model: Optional[str] = None,
+        guidance_scale: Optional[float] = None,
+        top_k: Optional[int] = None,
+        top_p: Optional[float] = None,
+        temperature: Optional[float] = None,
+        first_chunk_s: Optional[float] = None,
+        chunk_growth: Optional[float] = None,
+        max_chunk_s: Optional[float] = None,
+        decode_mode: Optional[str] = None,
+        description: str = "",
+        measured: Optional[dict] = None,
+    ):
+        if decode_mode is not None and decode_mode not in DECODE_MODES:
+            raise ValueError(f"decode_mode of preset {name!r} must be one of {DECODE_MODES}")
+        self.name = name
+        self.model = model
+        self.guidance_scale = guidance_scale
+        self.top_k = top_k
+        self.top_p = top_p
+        self.temperature = temperature
+        self.first_chunk_s = first_chunk_s
+        self.chunk_growth = chunk_growth
+        self.max_chunk_s = max_chunk_s
+        self.decode_mode = decode_mode
+        self.description = description
+        self.measured = measured
+
+    def generation_kwargs(self) -> dict:
+        """Arguments of `model.generate` overriding the generation config."""
+        return {
+            parameter: getattr(self, parameter)
+            for parameter in SAMPLING_PARAMETERS
+            if getattr(self, parameter) is not None
+        }
+
+    def to_dict(self) -> dict:
+        return dict(vars(self))
+
+
+DEFAULT_PRESETS = {
+    "draft": GenerationPreset(
+        "draft",
+        model="facebook/musicgen-small",
+        # without classifier free guidance every token is generated once instead of twice
+        guidance_scale=1.0,
+        first_chunk_s=0.5,
+        max_chunk_s=2.0,
+        description="Small model without guidance, for quick previews",
+    ),
+    "standard": GenerationPreset(
+        "standard",
+        description="MODEL_NAME with its generation config and the configured chunk schedule",
+    ),
+    "studio": GenerationPreset(
+        "studio",
+        guidance_scale=3.0,
+        first_chunk_s=2.0,
+        max_chunk_s=8.0,
+        # every chunk is decoded from the start of the track, without crossfaded seams
+        decode_mode="full",
+        description="MODEL_NAME decoded in full, with larger chunks",
+    ),
+}
+
+
+def load_presets(path: Optional[str] = None) -> Dict[str, GenerationPreset]:
+    """The default presets, with those of the JSON file at `path` added or replacing them.
+    The file maps the preset names to the arguments of GenerationPreset."""
+    presets = dict(DEFAULT_PRESETS)
+    if path:
+        with open(path) as f:
+            for name, values in json.load(f).items():
+                values.pop("name", None)
+                presets[name] = GenerationPreset(name, **values)
+    return presets
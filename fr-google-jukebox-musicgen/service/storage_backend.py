@@ -0,0 +1,215 @@
+import os
+from queue import Queue
+from threading import Thread
+
+from google.api_core.exceptions import NotFound
+from google.cloud import storage
+
+
+# Resumable uploads send the data in chunks that must be a multiple of 256 KiB
+UPLOAD_CHUNK_SIZE = 4 * 256 * 1024
+
+_CLOSE = object()
+_ABORT = object()
+
+
+class UploadAborted(Exception):
+    pass
+
+
+def cancel_blob_writer(writer):
+    """Drop a `Blob.open("wb")` writer without finalizing its object.
+
+    `BlobWriter.close()` sends the buffered data as the last chunk, which commits the object,
+    and the IO finalizer calls it on a dropped writer. Its buffer is closed instead so it
+    counts as closed, and the resumable session, if one was started, is cancelled."""
+    if writer is None:
+        return
+    writer._buffer.close()
+    if writer._upload_and_transport:
+        upload, transport = writer._upload_and_transport
+        try:
+            # GCS answers 499 once the session is cancelled
+            transport.request("DELETE", upload.resumable_url)
+        except Exception as e:
+            print(f"Could not cancel the upload session: {e}")
+
+
+class UploadSession:
+    """Streams the chunks of one object to storage from a background thread, so writing never
+    blocks the audio stream and the upload is finalized after the response has been sent.
+
+    The first `header_size` bytes of the object are reserved for a header only known once
+    everything has been written (e.g. the sizes of a WAV), given to `close`."""
+
+    def __init__(self, object_name: str, content_type: str, header_size: int = 0):
+        self.object_name = object_name
+        self.content_type = content_type
+        self.header_size = header_size
+        self.header = None
+        self.size = 0
+
+        self.queue = Queue()
+        self.thread = Thread(target=self._run)
+        self.thread.start()
+
+    def write(self, data: bytes):
+        self.size += len(data)
+        self.queue.put(data)
+
+    def close(self, header: bytes = None):
+        """Finalize the object once all the written chunks have been uploaded, starting
+        with `header` when space was reserved for one."""
+        if header is not None and len(header) != self.header_size:
+            raise ValueError(f"Expected a header of {self.header_size} bytes, got {len(header)}")
+        self.header = header
+        self.queue.put(_CLOSE)
+
+    def abort(self):
+        """Drop the upload, nothing is committed to storage."""
+        self.queue.put(_ABORT)
+
+    def join(self, timeout=None):
+        self.thread.join(timeout)
+
+    def _open(self):
+        raise NotImplementedError("Subclasses should implement this method.")
+
+    def _write_header(self, writer):
+        """Called once everything is written, before the writer is closed."""
+
+    def _commit(self):
+        """Called once the writer is closed."""
+
+    def _discard(self, writer):
+        """Drop the writer without committing what was written, instead of closing it."""
+        raise NotImplementedError("Subclasses should implement this method.")
+
+    def _run(self):
+        # The writer isn't used as a context manager: leaving it, even with an exception,
+        # closes it and closing commits the object, an aborted upload must be discarded.
+        writer = None
+        try:
+            writer = self._open()
+            while True:
+                data = self.queue.get()
+                if data is _CLOSE:
+                    break
+                if data is _ABORT:
+                    raise UploadAborted()
+                writer.write(data)
+            if self.header_size:
+                self._write_header(writer)
+            writer.close()
+            self._commit()
+            print(f"File {self.object_name} uploaded ({self.header_size + self.size} bytes).")
+        except UploadAborted:
+            self._discard(writer)
+            print(f"Upload of {self.object_name} aborted.")
+        except Exception as e:
+            if writer is not None and not writer.closed:
+                self._discard(writer)
+            print(f"Upload of {self.object_name} failed: {e}")
+
+
+class GCSUploadSession(UploadSession):
+    """Objects can't be rewritten in place, with a header the data goes to a temporary
+    object and the header is prepended by composing both once the upload is done."""
+
+    def __init__(self, blob: storage.Blob, content_type: str, header_size: int = 0):
+        self.blob = blob
+        bucket = blob.bucket
+        self.data_blob = bucket.blob(f"{blob.name}.data") if header_size else blob
+        self.header_blob = bucket.blob(f"{blob.name}.header")
+        super().__init__(blob.name, content_type, header_size)
+
+    def _open(self):
+        # the writer is a resumable upload session, the object exists once it is closed
+        return self.data_blob.open(
+            "wb", chunk_size=UPLOAD_CHUNK_SIZE, content_type=self.content_type
+        )
+
+    def _discard(self, writer):
+        cancel_blob_writer(writer)
+
+    def _commit(self):
+        if not self.header_size:
+            return
+        self.header_blob.upload_from_string(
+            self.header or bytes(self.header_size), content_type=self.content_type
+        )
+        try:
+            self.blob.content_type = self.content_type
+            self.blob.compose([self.header_blob, self.data_blob])
+        finally:
+            # the temporary objects go away whether or not the compose succeeded
+            for blob in (self.header_blob, self.data_blob):
+                try:
+                    blob.delete()
+                except NotFound:
+                    pass
+
+
+class LocalUploadSession(UploadSession):
+    def __init__(self, path: str, object_name: str, content_type: str, header_size: int = 0):
+        self.path = path
+        super().__init__(object_name, content_type, header_size)
+
+    def _open(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        file = open(self.path, "wb")
+        file.write(bytes(self.header_size))
+        return file
+
+    def _write_header(self, writer):
+        if self.header is not None:
+            writer.seek(0)
+            writer.write(self.header)
+
+    def _discard(self, writer):
+        if writer is not None:
+            writer.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class GCSStorageBackend:
+    def __init__(self, bucket_name: str):
+        self.bucket_name = bucket_name
+        self._client = None
+
+    @property
+    def client(self) -> storage.Client:
+        # Created on first use and reused by every upload afterwards
+        if self._client is None:
+            self._client = storage.Client()
+        return self._client
+
+    def open_upload(
+        self, object_name: str, content_type: str = "audio/wav", header_size: int = 0
+    ) -> UploadSession:
+        blob = self.client.bucket(self.bucket_name).blob(object_name)
+        return GCSUploadSession(blob, content_type, header_size)
+
+
+class LocalStorageBackend:
+    """Stand-in for GCS that writes the objects below a local directory."""
+
+    def __init__(self, root: str):
+        self.root = root
+
+    def open_upload(
+        self, object_name: str, content_type: str = "audio/wav", header_size: int = 0
+    ) -> UploadSession:
+        return LocalUploadSession(
+            os.path.join(self.root, object_name), object_name, content_type, header_size
+        )
+
+
+def get_storage_backend(bucket_name: str):
+    backend = os.getenv("STORAGE_BACKEND", "gcs")
+    if backend == "gcs":
+        return GCSStorageBackend(bucket_name)
+    if backend == "local":
+        return LocalStorageBackend(os.getenv("LOCAL_STORAGE_DIR", "storage"))
+    raise ValueError(f"Unknown STORAGE_BACKEND {backend!r}, expected 'gcs' or 'local'")
@@ -0,0 +1,104 @@
+import time
+from collections import OrderedDict
+from threading import Lock
+from typing import List, Optional
+
+import torch
+from transformers.modeling_outputs import BaseModelOutput
+
+from service.generation_cache import normalize_prompt
+from service.metrics import metrics
+
+
+class TextEncoding:
+    """The tokenized prompt and the text encoder's hidden states for it, without padding."""
+
+    def __init__(self, input_ids, attention_mask, hidden_states, encode_s: float):
+        self.input_ids = input_ids
+        self.attention_mask = attention_mask
+        self.hidden_states = hidden_states
+        # what a cache hit saves
+        self.encode_s = encode_s
+
+
+class TextEncodingCache:
+    """Least recently used text encodings of the prompts, by normalized prompt.
+
+    `inputs` returns the arguments of `model.generate` for a batch of prompts, with the
+    encoder outputs precomputed so generate doesn't run the text encoder again. Prompts
+    are encoded one by one and padded afterwards: the padded positions are masked out of
+    the cross-attention, so this gives the same decoder inputs as encoding them together.
+    """
+
+    def __init__(self, model, processor, max_entries: int = 256):
+        self.model = model
+        self.processor = processor
+        self.max_entries = max_entries
+        self.lock = Lock()
+        self.entries = OrderedDict()
+
+    def get(self, prompt: str) -> TextEncoding:
+        key = normalize_prompt(prompt)
+        with self.lock:
+            encoding = self.entries.get(key)
+            if encoding is not None:
+                self.entries.move_to_end(key)
+        if encoding is not None:
+            metrics.increment("text_encoding_cache_hits")
+            metrics.increment("text_encoding_saved_s", encoding.encode_s)
+            return encoding
+
+        encoding = self.encode(key)
+        metrics.increment("text_encoding_cache_misses")
+        metrics.increment("text_encoding_s", encoding.encode_s)
+        if self.max_entries > 0:
+            with self.lock:
+                self.entries[key] = encoding
+                while len(self.entries) > self.max_entries:
+                    self.entries.popitem(last=False)
+        return encoding
+
+    def encode(self, prompt: str) -> TextEncoding:
+        start_time = time.perf_counter()
+        inputs = self.processor(text=[prompt], return_tensors="pt").to(self.model.device)
+        with torch.inference_mode():
+            hidden_states = self.model.text_encoder(
+                input_ids=inputs.input_ids, attention_mask=inputs.attention_mask
+            ).last_hidden_state
+        return TextEncoding(
+            inputs.input_ids,
+            inputs.attention_mask,
+            hidden_states,
+            time.perf_counter() - start_time,
+        )
+
+    def inputs(self, prompts: List[str], guidance_scale: Optional[float] = None) -> dict:
+        """The arguments of `model.generate` for these prompts, `guidance_scale` defaults to
+        the one of the model's generation config."""
+        encodings = [self.get(prompt) for prompt in prompts]
+        length = max(encoding.input_ids.shape[-1] for encoding in encodings)
+        pad_token_id = self.processor.tokenizer.pad_token_id
+
+        def pad(tensor, value):
+            return torch.nn.functional.pad(tensor, (0, length - tensor.shape[-1]), value=value)
+
+        input_ids = torch.cat([pad(e.input_ids, pad_token_id) for e in encodings])
+        attention_mask = torch.cat([pad(e.attention_mask, 0) for e in encodings])
+        # hidden states are padded along the sequence, their second to last dimension
+        hidden_states = torch.cat(
+            [pad(e.hidden_states.transpose(1, 2), 0).transpose(1, 2) for e in encodings]
+        )
+
+        # classifier free guidance conditions on the prompts and on nothing, generate
+        # expects both halves when it is given the encoder outputs
+        if guidance_scale is None:
+            guidance_scale = self.model.generation_config.guidance_scale
+        if guidance_scale is not None and guidance_scale > 1:
+            hidden_states = torch.cat([hidden_states, torch.zeros_like(hidden_states)])
+            attention_mask = torch.cat([attention_mask, torch.zeros_like(attention_mask)])
+
+        return {
+            "input_ids": input_ids,
+            "attention_mask": attention_mask,
+            "encoder_outputs": BaseModelOutput(last_hidden_state=hidden_states),
+        }
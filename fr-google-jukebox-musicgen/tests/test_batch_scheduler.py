@@ -0,0 +1,97 @@
+import time
+from threading import Lock
+
+import pytest
+
+from service.batch_scheduler import BatchScheduler
+from service.musicgen_stream import ChunkSchedule
+
+
+class Recorder:
+    """A run_batch that starts every row with a fake streamer of its prompt."""
+
+    def __init__(self, error=None):
+        self.batches = []
+        self.lock = Lock()
+        self.error = error
+
+    def __call__(self, batch):
+        with self.lock:
+            self.batches.append([request.text_prompt for request in batch])
+        if self.error is not None:
+            raise self.error
+        for row, request in enumerate(batch):
+            request.start(None, row)
+
+    def wait(self, num_requests, timeout_s=5.0):
+        deadline = time.monotonic() + timeout_s
+        while sum(len(batch) for batch in self.batches) < num_requests:
+            assert time.monotonic() < deadline, "the scheduler didn't run every request"
+            time.sleep(0.01)
+        return sorted(sorted(batch) for batch in self.batches)
+
+
+def submit_all(scheduler, requests):
+    # held so every request is pending before the scheduler looks at them
+    with scheduler.condition:
+        return [scheduler.submit(*request) for request in requests]
+
+
+def test_compatible_requests_share_a_batch():
+    recorder = Recorder()
+    scheduler = BatchScheduler(recorder, max_batch_size=4, window_s=0.05)
+    schedule = ChunkSchedule.fixed(1.0)
+    requests = submit_all(
+        scheduler,
+        [("a", 10.0, schedule), ("b", 12.0, ChunkSchedule.fixed(1.0)), ("c", 8.0, schedule)],
+    )
+
+    assert recorder.wait(3) == [["a", "b", "c"]]
+    assert all(request.started.wait(5.0) for request in requests)
+    assert sorted(request.row for request in requests) == [0, 1, 2]
+
+
+@pytest.mark.parametrize(
+    "other",
+    [
+        {"audio_length_in_s": 20.0},
+        {"schedule": ChunkSchedule.fixed(2.0)},
+        {"seed": 1},
+        {"preset": object()},
+        {"decode_mode": "full"},
+    ],
+)
+def test_incompatible_requests_get_their_own_batch(other):
+    recorder = Recorder()
+    scheduler = BatchScheduler(recorder, window_s=0.05, duration_tolerance_s=5.0)
+    first = {
+        "text_prompt": "a",
+        "audio_length_in_s": 10.0,
+        "schedule": ChunkSchedule.fixed(1.0),
+        "decode_mode": "incremental",
+    }
+    with scheduler.condition:
+        scheduler.submit(**first)
+        scheduler.submit(**{**first, "text_prompt": "b", **other})
+
+    assert recorder.wait(2) == [["a"], ["b"]]
+
+
+def test_batches_are_limited_to_max_batch_size():
+    recorder = Recorder()
+    scheduler = BatchScheduler(recorder, max_batch_size=2, window_s=0.05)
+    schedule = ChunkSchedule.fixed(1.0)
+    submit_all(scheduler, [(prompt, 10.0, schedule) for prompt in "abcde"])
+
+    assert recorder.wait(5) == [["a", "b"], ["c", "d"], ["e"]]
+
+
+def test_failed_batch_fails_its_requests():
+    recorder = Recorder(error=RuntimeError("out of memory"))
+    scheduler = BatchScheduler(recorder, window_s=0.05)
+    schedule = ChunkSchedule.fixed(1.0)
+    requests = submit_all(scheduler, [("a", 10.0, schedule), ("b", 10.0, schedule)])
+
+    for request in requests:
+        with pytest.raises(RuntimeError, match="out of memory"):
+            next(request.stream())
@@ -0,0 +1,102 @@
+import numpy as np
+
+from service.generation_cache import (
+    CacheEntry,
+    GenerationCache,
+    LocalCacheTier,
+    cache_key,
+    normalize_prompt,
+)
+
+
+def entry(num_samples, value=0.5):
+    chunks = [np.full(num_samples // 2, value, np.float32)] * 2
+    return CacheEntry.from_chunks(chunks, 32000)
+
+
+def test_cache_key_only_ignores_the_spacing_of_the_prompt():
+    key = cache_key("musicgen-small", "calm  piano ", 10, 0, {"top_k": 250})
+    assert key == cache_key("musicgen-small", "calm piano", 10.0, 0, {"top_k": 250})
+    assert key != cache_key("musicgen-small", "Calm piano", 10, 0, {"top_k": 250})
+    assert key != cache_key("musicgen-small", "calm piano", 10, 1, {"top_k": 250})
+    assert key != cache_key("musicgen-small", "calm piano", 10, 0, {"top_k": 50})
+    assert key != cache_key("musicgen-medium", "calm piano", 10, 0, {"top_k": 250})
+    assert normalize_prompt("café\tjazz") == "café jazz"
+
+
+def test_entry_replays_its_chunks():
+    chunks = [np.arange(3, dtype=np.float32), np.arange(5, dtype=np.float32)]
+    cached = CacheEntry.from_chunks(chunks, 32000)
+    restored = CacheEntry.from_bytes(cached.audio.tobytes(), cached.metadata())
+
+    assert restored.sampling_rate == 32000
+    assert [chunk.tolist() for chunk in restored.chunks()] == [chunk.tolist() for chunk in chunks]
+
+
+def test_local_tier_evicts_the_least_recently_used(tmp_path):
+    tier = LocalCacheTier(str(tmp_path), max_bytes=3 * 400)
+    for key in ("a", "b", "c"):
+        tier.put(key, entry(100))
+    assert tier.get("a") is not None
+
+    tier.put("d", entry(100))
+    assert tier.get("b") is None
+    assert not (tmp_path / "b.pcm").exists()
+    assert [key for key in ("a", "c", "d") if tier.get(key) is not None] == ["a", "c", "d"]
+    assert tier.total_bytes == 3 * 400
+
+
+def test_local_tier_skips_entries_larger_than_the_cache(tmp_path):
+    tier = LocalCacheTier(str(tmp_path), max_bytes=400)
+    tier.put("a", entry(200))
+    assert tier.get("a") is None
+    assert tier.total_bytes == 0
+
+
+def test_local_tier_finds_the_entries_of_a_previous_process(tmp_path):
+    LocalCacheTier(str(tmp_path), max_bytes=1000).put("a", entry(100, value=0.25))
+    tier = LocalCacheTier(str(tmp_path), max_bytes=1000)
+
+    assert tier.total_bytes == 400
+    assert tier.get("a").audio.tolist() == [0.25] * 100
+
+
+def test_local_tiers_share_their_directory(tmp_path):
+    # the tiers of two serve.py workers, each with its own index of the directory
+    first = LocalCacheTier(str(tmp_path), max_bytes=3 * 400)
+    second = LocalCacheTier(str(tmp_path), max_bytes=3 * 400)
+
+    first.put("a", entry(100))
+    assert second.get("a") is not None
+    first.put("b", entry(100))
+    second.put("c", entry(100))
+    second.put("d", entry(100))
+
+    # the budget holds for the directory, not for each worker
+    assert sorted(path.stem for path in tmp_path.glob("*.pcm")) == ["b", "c", "d"]
+    assert second.total_bytes == 3 * 400
+    # the first worker still indexed the entry the second one evicted
+    assert first.get("a") is None
+    assert "a" not in first.entries
+    assert first.get("d") is not None
+
+
+class MemoryTier:
+    def __init__(self):
+        self.entries = {}
+
+    def get(self, key):
+        return self.entries.get(key)
+
+    def put(self, key, entry):
+        self.entries[key] = entry
+
+
+def test_remote_hits_are_copied_to_the_local_tier(tmp_path):
+    remote = MemoryTier()
+    remote.put("a", entry(100))
+    cache = GenerationCache(LocalCacheTier(str(tmp_path), max_bytes=1000), remote)
+
+    assert cache.get("a") is not None
+    assert cache.local.get("a") is not None
+    assert cache.get("b") is None
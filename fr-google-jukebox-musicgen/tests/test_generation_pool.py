@@ -0,0 +1,92 @@
+import time
+from threading import Event
+
+import pytest
+import torch
+
+from service.generation_pool import CancellationCriteria, GenerationPool, QueueFullError
+
+
+def test_requests_past_the_queue_depth_are_rejected():
+    pool = GenerationPool(concurrency=1, queue_depth=2)
+    tickets = [pool.admit() for _ in range(3)]
+    with pytest.raises(QueueFullError) as error:
+        pool.admit()
+    # no job finished yet, a job is estimated to take 30 seconds
+    assert error.value.retry_after == 30
+
+    tickets[0].release()
+    pool.admit()
+
+
+def test_tickets_know_their_place_in_the_queue():
+    pool = GenerationPool(concurrency=2, queue_depth=2)
+    headers = [pool.admit().headers() for _ in range(4)]
+
+    assert [header["X-Queue-Position"] for header in headers] == ["0", "0", "1", "2"]
+    assert [header["X-Queue-ETA"] for header in headers] == ["0.0", "0.0", "30.0", "30.0"]
+
+
+def test_tickets_are_released_once():
+    pool = GenerationPool(concurrency=1, queue_depth=0)
+    ticket = pool.admit()
+    ticket.release()
+    ticket.release()
+    assert pool.in_flight == 0
+
+
+def test_finished_jobs_free_their_slots():
+    pool = GenerationPool(concurrency=1, queue_depth=0, slots_per_job=2)
+    tickets = [pool.admit(), pool.admit()]
+    assert pool.submit(tickets, lambda value: value, value=4).result(timeout=5) == 4
+    assert pool.in_flight == 0
+
+    def fail():
+        raise RuntimeError("out of memory")
+
+    tickets = [pool.admit(), pool.admit()]
+    with pytest.raises(RuntimeError, match="out of memory"):
+        pool.submit(tickets, fail).result(timeout=5)
+    assert pool.in_flight == 0
+    # the queue ETA follows the duration of the jobs
+    assert pool.average_job_s < 1
+    assert pool.admit().headers()["X-Queue-Position"] == "0"
+
+
+def test_cancellation_stops_the_rows_of_the_cancelled_tickets():
+    pool = GenerationPool(concurrency=1, queue_depth=0, slots_per_job=2)
+    first, second = pool.admit(), pool.admit()
+    criteria = CancellationCriteria([first, second])
+    # 4 codebooks for each request
+    input_ids = torch.zeros((2 * 4, 3), dtype=torch.long)
+    assert not criteria(input_ids, None).any()
+
+    second.cancel()
+    assert criteria(input_ids, None).tolist() == [False] * 4 + [True] * 4
+    assert not criteria.cancelled
+    first.cancel()
+    assert criteria.cancelled
+
+
+def test_cancelled_ticket_stops_its_job_and_frees_its_slot():
+    pool = GenerationPool(concurrency=1, queue_depth=0)
+    ticket = pool.admit()
+    criteria = CancellationCriteria([ticket])
+    started = Event()
+
+    def generate():
+        # a generation loop stopping on its criteria, like generate
+        input_ids = torch.zeros((4, 1), dtype=torch.long)
+        while not criteria(input_ids, None).all():
+            started.set()
+            time.sleep(0.001)
+        raise RuntimeError("can't post-process the truncated codes")
+
+    future = pool.submit([ticket], generate)
+    assert started.wait(5)
+    ticket.cancel()
+
+    # the failure of a cancelled job isn't reported
+    assert future.result(timeout=5) is None
+    assert pool.in_flight == 0
+    pool.admit()
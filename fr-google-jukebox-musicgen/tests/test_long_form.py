@@ -0,0 +1,122 @@
+import time
+
+import numpy as np
+import pytest
+import torch
+
+import service.musicgen_generator
+from benchmarks.tiny_musicgen import build_offline_processor, build_tiny_model
+from service.metrics import metrics
+from service.musicgen_stream import ChunkSchedule, MusicgenStreamer
+
+DURATION_S = 3
+SAMPLING_RATE = 32000
+FRAME_RATE = 50
+# windows of a second, each one continuing from the last half second of the previous one
+WINDOW_S = 1.0
+CONTEXT_S = 0.5
+
+
+class RecordingStreamer(MusicgenStreamer):
+    """Keeps the streamers of the generator, and cancels `ticket` after `cancel_at` tokens."""
+
+    instances = []
+    ticket = None
+    cancel_at = None
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        RecordingStreamer.instances.append(self)
+
+    def put(self, value):
+        super().put(value)
+        if self.cancel_at is not None and self.generated_tokens >= self.cancel_at:
+            self.ticket.cancel()
+
+
+@pytest.fixture(scope="module")
+def generator(tmp_path_factory):
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        for name, value in {
+            "STORAGE_BACKEND": "local",
+            "LOCAL_STORAGE_DIR": str(tmp_path_factory.mktemp("storage")),
+            "CACHE_MAX_MB": "0",
+            "PCM_FORMAT": "float32",
+            "LONG_FORM_WINDOW_S": str(WINDOW_S),
+            "LONG_FORM_CONTEXT_S": str(CONTEXT_S),
+        }.items():
+            monkeypatch.setenv(name, value)
+        monkeypatch.setattr(service.musicgen_generator, "MusicgenStreamer", RecordingStreamer)
+
+        generator = service.musicgen_generator.MusigGenGenerator()
+        generator.load(build_tiny_model(), build_offline_processor())
+        yield generator
+
+
+def generate(generator, decode_mode, ticket=None) -> np.ndarray:
+    data = b"".join(
+        generator.generate_audio_stream(
+            uuid=f"long-{decode_mode}",
+            text_prompt="calm piano",
+            audio_length_in_s=DURATION_S,
+            schedule=ChunkSchedule.fixed(1.0),
+            seed=0,
+            decode_mode=decode_mode,
+            ticket=ticket,
+        )
+    )
+    # float32 samples after the 44 bytes of the WAV header
+    return np.frombuffer(data[44:], dtype="<f4")
+
+
+@pytest.fixture(scope="module")
+def full(generator):
+    windows_before = metrics.snapshot().get("long_form_windows", 0)
+    audio = generate(generator, "full")
+    windows = metrics.snapshot()["long_form_windows"] - windows_before
+    return audio, RecordingStreamer.instances[-1], windows
+
+
+def test_windows_stream_the_whole_duration(full):
+    audio, _, windows = full
+    assert audio.shape == (DURATION_S * SAMPLING_RATE,)
+    # every window after the first one generates half a second of codes, the frames whose
+    # delayed codebooks the previous one left incomplete included
+    assert windows == 6
+
+
+def test_windows_join_without_gaps_or_duplicates(full):
+    audio, streamer, _ = full
+    # with full decoding the buffer keeps the codes of the whole track: the streamed audio
+    # is the track they decode to, sample for sample
+    assert streamer.frame_offset == 0
+    with torch.inference_mode():
+        track = streamer.apply_delay_pattern_mask(streamer.token_cache)[0]
+    assert track.shape == audio.shape
+    np.testing.assert_allclose(audio, track, atol=1e-6)
+
+
+def test_incremental_windows_match_full_decoding(generator, full):
+    audio = generate(generator, "incremental")
+    assert audio.shape == full[0].shape
+    np.testing.assert_allclose(audio, full[0], atol=1e-3 * np.abs(full[0]).max())
+
+
+def test_cancelling_during_the_second_window_stops_the_generation(generator, monkeypatch):
+    windows_before = metrics.snapshot().get("long_form_windows", 0)
+    ticket = generator.admit()
+    cancel_at = int(WINDOW_S * FRAME_RATE) + 10
+    monkeypatch.setattr(RecordingStreamer, "ticket", ticket)
+    monkeypatch.setattr(RecordingStreamer, "cancel_at", cancel_at)
+
+    audio = generate(generator, "incremental", ticket=ticket)
+    deadline = time.monotonic() + 30
+    while generator.generation_pool.in_flight:
+        assert time.monotonic() < deadline, "the generation didn't stop"
+        time.sleep(0.01)
+
+    # stopped at the next token, in the second window
+    streamer = RecordingStreamer.instances[-1]
+    assert cancel_at <= streamer.generated_tokens <= cancel_at + 1
+    assert metrics.snapshot()["long_form_windows"] - windows_before == 2
+    assert 0 < audio.shape[0] < DURATION_S * SAMPLING_RATE
@@ -0,0 +1,98 @@
+import asyncio
+import os
+import tempfile
+from threading import Event
+
+import pytest
+from fastapi.testclient import TestClient
+
+# the app's generator is created on import, without a model until the app starts
+os.environ.setdefault("STORAGE_BACKEND", "local")
+os.environ.setdefault("LOCAL_STORAGE_DIR", tempfile.mkdtemp())
+os.environ.setdefault("CACHE_MAX_MB", "0")
+
+import main  # noqa: E402
+
+PARAMS = {"uuid": "song", "prompt": "calm piano", "duration": 10}
+
+
+@pytest.fixture
+def generator(monkeypatch):
+    """The app's generator, ready, with a stub job streaming the audio of each request."""
+    generator = main.musicGenGenerator
+    ready = Event()
+    ready.set()
+    monkeypatch.setattr(generator, "ready", ready)
+    monkeypatch.setattr(generator, "prepare_preset", lambda preset: None)
+
+    def generate_audio_stream(ticket, **kwargs):
+        ticket.release()
+        yield b"RIFF"
+
+    monkeypatch.setattr(generator, "generate_audio_stream", generate_audio_stream)
+    return generator
+
+
+@pytest.fixture
+def client():
+    # without the context manager, the app doesn't start loading the model
+    return TestClient(main.app)
+
+
+def test_requests_wait_for_the_model(client):
+    response = client.get("/generate_audio", params=PARAMS)
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "30"
+
+
+def test_requests_past_the_queue_depth_get_a_429(generator, client):
+    pool = generator.generation_pool
+    tickets = [generator.admit() for _ in range(pool.slots + pool.queue_depth)]
+    try:
+        response = client.get("/generate_audio", params=PARAMS)
+    finally:
+        for ticket in tickets:
+            ticket.release()
+
+    assert response.status_code == 429
+    assert response.headers["Retry-After"] == "30"
+
+
+def test_queued_requests_get_their_position(generator, client):
+    pool = generator.generation_pool
+    tickets = [generator.admit() for _ in range(pool.slots)]
+    try:
+        response = client.get("/generate_audio", params=PARAMS)
+    finally:
+        for ticket in tickets:
+            ticket.release()
+
+    assert response.status_code == 200
+    assert response.content == b"RIFF"
+    assert response.headers["X-Queue-Position"] == "1"
+    assert response.headers["X-Queue-ETA"] == "30.0"
+    assert pool.in_flight == 0
+
+
+def test_disconnected_client_cancels_the_generation(generator):
+    ticket = generator.admit()
+
+    async def leave_after_the_first_chunk():
+        stream = main.stream_until_disconnect(iter([b"RIFF", b"audio"]), ticket)
+        assert await stream.__anext__() == b"RIFF"
+        await stream.aclose()
+
+    asyncio.run(leave_after_the_first_chunk())
+    assert ticket.cancelled
+    ticket.release()
+
+
+def test_finished_stream_does_not_cancel_the_generation(generator):
+    ticket = generator.admit()
+
+    async def listen_to_the_end():
+        return [chunk async for chunk in main.stream_until_disconnect(iter([b"RIFF"]), ticket)]
+
+    assert asyncio.run(listen_to_the_end()) == [b"RIFF"]
+    assert not ticket.cancelled
+    ticket.release()
@@ -0,0 +1,91 @@
+import numpy as np
+import pytest
+import torch
+
+from benchmarks.tiny_musicgen import build_offline_processor, build_tiny_model
+from service.musicgen_stream import ChunkSchedule, GenerationFailed, MusicgenStreamer
+
+MAX_NEW_TOKENS = 150
+PLAY_STEPS = 25
+
+
+@pytest.fixture(scope="module")
+def model():
+    return build_tiny_model()
+
+
+@pytest.fixture(scope="module")
+def tokens(model):
+    """The token cache of a generation on the tiny model, replayed into every streamer."""
+    processor = build_offline_processor()
+    inputs = processor(text=["calm piano"], padding=True, return_tensors="pt")
+    streamer = MusicgenStreamer(model, device="cpu", play_steps=PLAY_STEPS, decode_worker=False)
+    torch.manual_seed(0)
+    model.generate(**inputs, max_new_tokens=MAX_NEW_TOKENS, streamer=streamer)
+    return streamer.token_cache.clone()
+
+
+@pytest.fixture(scope="module")
+def track(model, tokens):
+    """The whole track decoded at once."""
+    streamer = MusicgenStreamer(model, device="cpu", play_steps=PLAY_STEPS)
+    with torch.inference_mode():
+        return streamer.apply_delay_pattern_mask(tokens)[0]
+
+
+def stream(model, tokens, **kwargs) -> np.ndarray:
+    """Feed `tokens` to a streamer the way generate does, and join the audio it streams."""
+    streamer = MusicgenStreamer(
+        model, device="cpu", play_steps=PLAY_STEPS, max_new_tokens=MAX_NEW_TOKENS, **kwargs
+    )
+    streamer.put(tokens[:, :1])
+    for column in range(1, tokens.shape[-1]):
+        streamer.put(tokens[:, column])
+    streamer.end()
+    chunks = list(streamer)
+    assert len(chunks) > 2
+    return np.concatenate(chunks)
+
+
+@pytest.mark.parametrize("decode_worker", [False, True])
+def test_full_decoding_streams_the_track(model, tokens, track, decode_worker):
+    audio = stream(model, tokens, decode_mode="full", decode_worker=decode_worker)
+    assert audio.shape == track.shape
+    # only the float rounding of decoding shorter code sequences differs
+    np.testing.assert_allclose(audio, track, atol=1e-6)
+
+
+@pytest.mark.parametrize("decode_worker", [False, True])
+def test_incremental_decoding_matches_full_decoding(model, tokens, track, decode_worker):
+    audio = stream(model, tokens, decode_mode="incremental", decode_worker=decode_worker)
+    assert audio.shape == track.shape
+    # the context in front of each chunk warms the codec up to the state of a full decoding
+    np.testing.assert_allclose(audio, track, atol=1e-3 * np.abs(track).max())
+
+
+@pytest.mark.parametrize("decode_worker", [False, True])
+def test_failure_reaches_the_consumer(model, tokens, decode_worker):
+    streamer = MusicgenStreamer(
+        model, device="cpu", play_steps=PLAY_STEPS, decode_worker=decode_worker, timeout=10
+    )
+    streamer.put(tokens[:, :1])
+    for column in range(1, PLAY_STEPS + 1):
+        streamer.put(tokens[:, column])
+    streamer.fail(RuntimeError("out of memory"))
+
+    # the audio decoded before the failure comes first
+    assert next(streamer).shape[-1] > 0
+    with pytest.raises(GenerationFailed, match="out of memory"):
+        next(streamer)
+
+
+def test_schedule_without_adaptation_ignores_the_generation_speed():
+    schedule = ChunkSchedule(first_chunk_s=1.0, growth=2.0, max_chunk_s=4.0)
+    # a slow generation keeps small chunks
+    assert schedule.next_steps(50, 50, buffered_s=1.0, generated_fps=10.0) == 50
+
+    timing_independent = schedule.without_adaptation()
+    assert timing_independent != schedule
+    assert timing_independent.next_steps(50, 50, buffered_s=1.0, generated_fps=10.0) == 100
+    assert timing_independent.next_steps(100, 50, buffered_s=1.0, generated_fps=10.0) == 200
+    assert timing_independent.next_steps(200, 50, buffered_s=1.0, generated_fps=10.0) == 200
@@ -0,0 +1,63 @@
+from google.auth.credentials import AnonymousCredentials
+from google.cloud import storage
+from requests.structures import CaseInsensitiveDict
+
+from service.storage_backend import UPLOAD_CHUNK_SIZE, GCSStorageBackend
+
+SESSION_URL = "https://storage.googleapis.com/upload/session"
+
+
+class FakeResponse:
+    def __init__(self, status_code, headers=None):
+        self.status_code = status_code
+        self.headers = CaseInsensitiveDict(headers or {})
+        self.content = b""
+
+
+class FakeTransport:
+    """Answers the requests of a resumable upload the way GCS does."""
+
+    is_mtls = False
+
+    def __init__(self):
+        self.requests = []
+
+    def request(self, method, url, data=None, headers=None, **kwargs):
+        self.requests.append((method, url))
+        if method == "POST":
+            return FakeResponse(200, {"location": SESSION_URL})
+        if method == "PUT":
+            # the chunk is stored, the upload goes on
+            return FakeResponse(308, {"range": f"bytes=0-{UPLOAD_CHUNK_SIZE - 1}"})
+        return FakeResponse(499)
+
+
+def storage_backend(transport):
+    client = storage.Client(project="test", credentials=AnonymousCredentials())
+    client._http_internal = transport
+    backend = GCSStorageBackend("bucket")
+    backend._client = client
+    return backend
+
+
+def test_aborted_upload_deletes_its_session():
+    # drives a real BlobWriter: fails if the internals cancel_blob_writer relies on change
+    transport = FakeTransport()
+    upload = storage_backend(transport).open_upload("song.wav")
+    upload.write(b"a" * (UPLOAD_CHUNK_SIZE + 10))
+    upload.abort()
+    upload.join(timeout=10)
+
+    assert [method for method, _ in transport.requests] == ["POST", "PUT", "DELETE"]
+    # the rest of the track is never sent, which would have finalized the upload
+    assert transport.requests[-1] == ("DELETE", SESSION_URL)
+
+
+def test_upload_aborted_before_its_first_chunk_sends_nothing():
+    transport = FakeTransport()
+    upload = storage_backend(transport).open_upload("song.wav")
+    upload.write(b"RIFF")
+    upload.abort()
+    upload.join(timeout=10)
+
+    assert transport.requests == []
@@ -1,6 +1,6 @@
 import logging
 import os
-from typing import List, Optional
+from typing import List, Literal, Optional
 
 from pydantic import Field
 from pydantic_settings import BaseSettings, SettingsConfigDict
@@ -124,6 +124,29 @@ class Settings(BaseSettings):
 
     # External services
     MUSICGEN_URL: str = Field(default="", env="MUSICGEN_URL")
+    # replicate, musicgen (the service at MUSICGEN_URL) or auto (musicgen, else replicate)
+    MUSIC_BACKEND: Literal["replicate", "musicgen", "auto"] = Field(
+        default="auto", env="MUSIC_BACKEND"
+    )
+    # seconds the service at MUSICGEN_URL is skipped after failing without a Retry-After
+    MUSICGEN_RETRY_S: float = Field(default=30.0, env="MUSICGEN_RETRY_S")
+
+    # Shared HTTP client
+    HTTP_CONNECT_TIMEOUT_S: float = Field(default=10.0, env="HTTP_CONNECT_TIMEOUT_S")
+    HTTP_READ_TIMEOUT_S: float = Field(default=60.0, env="HTTP_READ_TIMEOUT_S")
+    HTTP_MAX_CONNECTIONS: int = Field(default=100, env="HTTP_MAX_CONNECTIONS")
+    HTTP_MAX_KEEPALIVE_CONNECTIONS: int = Field(default=20, env="HTTP_MAX_KEEPALIVE_CONNECTIONS")
+    # Replicate predictions taking longer than this are cancelled
+    REPLICATE_TIMEOUT_S: float = Field(default=600.0, env="REPLICATE_TIMEOUT_S")
+
+    # Generation jobs
+    JOB_STORE: Literal["firestore", "memory"] = Field(default="firestore", env="JOB_STORE")
+    JOB_CONCURRENCY: int = Field(default=4, env="JOB_CONCURRENCY")
+    # finished jobs are kept in memory this long, and in their Firestore document
+    JOB_TTL_S: float = Field(default=3600.0, env="JOB_TTL_S")
+    JOB_KEEPALIVE_S: float = Field(default=15.0, env="JOB_KEEPALIVE_S")
+    # how often the events of a job running on another instance are read from Firestore
+    JOB_POLL_S: float = Field(default=2.0, env="JOB_POLL_S")
 
     # Email service (optional)
     GOOGLE_APP_EMAIL: str = Field(default="", env="GOOGLE_APP_EMAIL")
@@ -157,6 +180,9 @@ class Settings(BaseSettings):
         """Initialize settings with validation."""
         super().__init__(**data)
         
+        if self.MUSIC_BACKEND == "musicgen" and not self.MUSICGEN_URL:
+            raise ValueError("MUSICGEN_URL is required with MUSIC_BACKEND=musicgen.")
+
         # Validate required fields for local vs production
         if self.ENV != "production":
             # Local mode: ensure required secrets are available
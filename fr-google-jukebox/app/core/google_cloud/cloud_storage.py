@@ -1,4 +1,7 @@
-from google.cloud.storage import Client
+import logging
+from typing import Iterator, Optional
+
+from google.cloud.storage import Blob, Client
 
 from app.core.config import settings
 
@@ -26,7 +29,41 @@ class CloudStorageService:
         blob.upload_from_string(data, content_type=content_type)
         return f"https://storage.googleapis.com/{bucket_name}/{destination_blob_name}"
 
+    def open_writer(
+        self, bucket_name, destination_blob_name, content_type="audio/wav", chunk_size=None
+    ):
+        """A file object sending what is written to it in a resumable upload, in chunks of
+        `chunk_size` bytes. The blob is only created when the file is closed."""
+        blob = self.client.bucket(bucket_name).blob(destination_blob_name)
+        return blob.open("wb", content_type=content_type, chunk_size=chunk_size)
+
+    def cancel_writer(self, writer):
+        """Drop a writer of open_writer without creating its blob.
+
+        Closing the writer finalizes the upload, and a dropped writer is closed when it is
+        garbage collected. Its buffer is closed instead so it counts as closed, and the
+        resumable session, if one was started, is cancelled. Same as `cancel_blob_writer` in
+        fr-google-jukebox-musicgen/service/storage_backend.py."""
+        writer._buffer.close()
+        if writer._upload_and_transport:
+            upload, transport = writer._upload_and_transport
+            try:
+                # GCS answers 499 once the session is cancelled
+                transport.request("DELETE", upload.resumable_url)
+            except Exception as e:
+                logging.warning(f"Could not cancel the upload session: {e}")
+
     def delete_folder(self, bucket_name, folder_name):
         bucket = self.client.bucket(bucket_name)
         for blob in bucket.list_blobs(prefix=folder_name):
             blob.delete()
+
+    def get_blob(self, bucket_name, file_name) -> Optional[Blob]:
+        """The blob with its size and etag loaded, None when it doesn't exist."""
+        return self.client.bucket(bucket_name).get_blob(file_name)
+
+    def iter_range(self, blob: Blob, start, end, chunk_size=1024 * 1024) -> Iterator[bytes]:
+        """Download bytes `start` to `end` (inclusive) of the blob in chunks. The blob comes
+        from get_blob, so every chunk is read from the same generation of the object."""
+        for offset in range(start, end + 1, chunk_size):
+            yield blob.download_as_bytes(start=offset, end=min(offset + chunk_size, end + 1) - 1)
@@ -12,13 +12,25 @@ from app.api.deps import raise_500
 from app.api.router import api_router
 from app.core.cloud_logging import LoggingMiddleware
 from app.core.config import settings
+from app.core.http_client import close_http_client, get_http_client
 from app.middleware import ExceptionMiddleware, LoggingMiddlewareReq, MetricMiddleware
+from app.music.endpoints.jobs import cancel_jobs
 from app.music.models.prompt import PromptMusic
 from app.music.service.generative_ai import MusicGenerator
 
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # one connection pool for the outgoing requests of every endpoint
+    get_http_client()
+    yield
+    await cancel_jobs()
+    await close_http_client()
+
+
 app = FastAPI(
     title=settings.PROJECT_NAME,
+    lifespan=lifespan,
     openapi_url=f"{settings.API_PREFIX}/openapi.json",
     docs_url=f"{settings.API_PREFIX}/docs",
     redoc_url=f"{settings.API_PREFIX}/redoc",
@@ -0,0 +1,102 @@
+import asyncio
+import logging
+from typing import Optional
+
+from fastapi import APIRouter, status
+from fastapi.responses import StreamingResponse
+
+from app.api.deps import raise_400, raise_404
+from app.core.config import settings
+from app.music.endpoints.music import generate_and_store
+from app.music.models.job import Job
+from app.music.models.prompt import PromptMusic
+from app.music.service.job_store import FirestoreJobStore, JobStore
+
+router = APIRouter()
+
+job_store = FirestoreJobStore() if settings.JOB_STORE == "firestore" else JobStore()
+# generations run concurrently by this instance, the other jobs wait queued
+job_slots = asyncio.Semaphore(settings.JOB_CONCURRENCY)
+# references to the running jobs, the event loop only keeps weak ones
+job_tasks = set()
+
+
+async def run_job(generation_prompt: PromptMusic):
+    job_id = generation_prompt.uuid
+
+    async def on_progress(job_status: str, progress: float):
+        job = job_store.jobs[job_id]
+        # watchers are woken up for every percent, not for every chunk
+        if job_status != job.status or int(progress) != int(job.progress):
+            await job_store.update(job_id, status=job_status, progress=progress)
+
+    try:
+        async with job_slots:
+            await job_store.update(job_id, status="generating")
+            storage_uri = await generate_and_store(generation_prompt, on_progress)
+        await job_store.update(job_id, status="done", progress=100.0, audio=storage_uri)
+    except asyncio.CancelledError:
+        await job_store.update(job_id, status="failed", error="Cancelled")
+        raise
+    except Exception as e:
+        logging.error(e)
+        await job_store.update(job_id, status="failed", error=str(e))
+
+
+async def cancel_jobs():
+    """Stop the running jobs, on shutdown."""
+    for task in list(job_tasks):
+        task.cancel()
+    await asyncio.gather(*job_tasks, return_exceptions=True)
+
+
+@router.post("", response_model=Job, status_code=status.HTTP_202_ACCEPTED)
+async def create_job(generation_prompt: PromptMusic) -> Job:
+    if generation_prompt.duration is None:
+        raise_400("Duration is required")
+    # a song has one generation at a time
+    if job_store.running(generation_prompt.uuid):
+        return job_store.jobs[generation_prompt.uuid]
+
+    job = await job_store.create(generation_prompt.uuid, generation_prompt.genre)
+    task = asyncio.create_task(run_job(generation_prompt))
+    job_tasks.add(task)
+    task.add_done_callback(job_tasks.discard)
+    return job
+
+
+@router.get("/{id}", response_model=Job, status_code=status.HTTP_200_OK)
+async def get_job(id: str, genre: Optional[str] = None) -> Job:
+    # jobs of other instances are read from their song's document, found by genre
+    job = await job_store.get(id, genre)
+    if job is None:
+        raise_404(f"Job {id} not found")
+    return job
+
+
+@router.get(
+    "/{id}/events",
+    responses={
+        200: {
+            "content": {"text/event-stream": {}},
+            "description": "Server-sent events of the job, until it is done or failed",
+        }
+    },
+)
+async def get_job_events(id: str, genre: Optional[str] = None) -> StreamingResponse:
+    if await job_store.get(id, genre) is None:
+        raise_404(f"Job {id} not found")
+
+    async def events():
+        async for job in job_store.watch(id, genre):
+            if job is None:
+                # a comment, for the proxies closing idle connections
+                yield ": keepalive\n\n"
+            else:
+                yield f"data: {job.json()}\n\n"
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
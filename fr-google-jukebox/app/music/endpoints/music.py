@@ -1,15 +1,12 @@
-from io import BytesIO
 import logging
-import math
-import struct
 import time
-import wave
-from typing import Annotated
+from typing import Annotated, Awaitable, Callable, Literal, Optional
 import uuid
 from datetime import datetime
 
 from google.cloud.firestore_v1 import DocumentSnapshot
-from fastapi import APIRouter, BackgroundTasks, Depends, status
+from fastapi import APIRouter, BackgroundTasks, Depends, Header, HTTPException, Query, status
+from starlette.concurrency import run_in_threadpool
 from fastapi.responses import StreamingResponse, Response
 
 from app.api.deps import raise_404, raise_500
@@ -22,7 +19,17 @@ from app.music.dependencies import get_genre
 from app.music.models.instrument import InstrumentBase
 from app.music.models.music import GenreBase, MusicCreate, MusicRead, MusicUpdate
 from app.music.models.prompt import PromptBase, PromptCover, PromptMusic
+from app.music.service.audio_upload import AudioUpload
+from app.music.service.audio_encoder import MEDIA_TYPES, get_bitrate, require_av
+from app.music.service.byte_range import (
+    WAV_HEADER_SIZE,
+    parse_range,
+    patch_wav_sizes,
+    wav_byte_rate,
+)
 from app.music.service.generative_ai import CoverGenerator, MusicGenerator
+from app.music.service.synth import fallback_wav
+from app.music.service.wav_stream import transcode_wav_stream
 from fastapi.responses import JSONResponse
 
 
@@ -33,6 +40,9 @@ cloud_storage_service = CloudStorageService()
 cover_generator = CoverGenerator()
 music_generator = MusicGenerator()
 
+# share of the progress of a generation taken by the generation, the rest by the upload
+GENERATION_PROGRESS = 90.0
+
 
 @router.get(
     "/genre/all",
@@ -158,31 +168,12 @@ async def generate_cover(cover_prompt: PromptCover) -> MusicCreate:
         raise_500()
 
 
-@router.get(
-    "/song",
-    responses={
-        200: {
-            "content": {"audio/wav": {}},
-            "description": "Returning a generated wav file",
-        }
-    },
-)
-async def generate_music(
-    uuid: str,
-    genre: Annotated[str, Depends(get_genre)],
-    title: str,
-    prompt: str,
-    duration: int,
-    creator: str,
-    background_tasks: BackgroundTasks,
-):
-
-    generation_prompt = PromptMusic(
-        uuid=uuid, genre=genre, title=title, prompt=prompt, duration=duration, creator=creator
-    )
+def audio_upload(uuid: str) -> AudioUpload:
+    return AudioUpload(cloud_storage_service, settings.GCLOUD_MUSIC_BUCKET, f"{uuid}/output.wav")
 
-    storage_uri = f"https://storage.googleapis.com/{settings.GCLOUD_MUSIC_BUCKET}/{generation_prompt.uuid}/output.wav"
 
+async def mark_audio_stored(generation_prompt: PromptMusic, storage_uri: str):
+    """Point the song's document to its stored audio."""
     id_ = generation_prompt.uuid
     firestore_object: MusicUpdate = await crud.firestore.get_document_in_subcollection(
         settings.JUKEBOX_COLLECTION, settings.MUSIC_SUB_COLLECTION, generation_prompt.genre, id_
@@ -200,43 +191,113 @@ async def generate_music(
         dict(firestore_object),
     )
 
-    buffer = BytesIO()
+
+async def generate_and_store(
+    generation_prompt: PromptMusic,
+    on_progress: Optional[Callable[[str, float], Awaitable[None]]] = None,
+) -> str:
+    """Generate the song while uploading it, and point its document to the stored WAV once
+    the upload is committed. The offline track of the genre is stored instead when every
+    backend fails. `on_progress(status, percent)` is awaited as the audio arrives, with
+    the percent estimated from the announced byte rate and the requested duration."""
+    storage_uri = (
+        f"https://storage.googleapis.com/{settings.GCLOUD_MUSIC_BUCKET}"
+        f"/{generation_prompt.uuid}/output.wav"
+    )
+
+    # the WAV is uploaded as it is generated
+    upload = audio_upload(generation_prompt.uuid)
 
     try:
         try:
-            async for chunk in music_generator.generate(generation_prompt):
-                buffer.write(chunk)
+            received, expected = 0, None
+            async for chunk in music_generator.generate(generation_prompt, upload=upload):
+                if expected is None:
+                    byte_rate = wav_byte_rate(chunk) or 0
+                    expected = WAV_HEADER_SIZE + byte_rate * generation_prompt.duration
+                received += len(chunk)
+                if on_progress is not None and expected > WAV_HEADER_SIZE:
+                    await on_progress(
+                        "generating", GENERATION_PROGRESS * min(received / expected, 1.0)
+                    )
         except Exception as ai_err:
             # TODO: Re-enable when Replicate credits are available
             logging.warning(f"AI music generation failed (using test tone): {ai_err}")
-            buffer = BytesIO()
-            # Generate a simple test WAV tone
-            sample_rate = 44100
-            duration_secs = generation_prompt.duration
-            frequency = 440.0  # A4 note
-            num_samples = sample_rate * duration_secs
-            wav_buffer = BytesIO()
-            with wave.open(wav_buffer, 'w') as wav_file:
-                wav_file.setnchannels(1)
-                wav_file.setsampwidth(2)
-                wav_file.setframerate(sample_rate)
-                for i in range(num_samples):
-                    # Simple sine wave with fade in/out
-                    t = i / sample_rate
-                    fade = min(1.0, i / (sample_rate * 0.1), (num_samples - i) / (sample_rate * 0.1))
-                    value = int(16000 * fade * math.sin(2 * math.pi * frequency * t))
-                    wav_file.writeframes(struct.pack('<h', value))
-            buffer = wav_buffer
-
-        # Upload the WAV to GCS
-        buffer.seek(0)
-        destination_blob = f"{generation_prompt.uuid}/output.wav"
-        cloud_storage_service.upload_file(
-            settings.GCLOUD_MUSIC_BUCKET,
-            destination_blob,
-            buffer.read(),
-            content_type="audio/wav",
-        )
+            await upload.abort()
+            upload = audio_upload(generation_prompt.uuid)
+            # A track of the genre synthesized offline, cached per genre and duration
+            await upload.write(
+                await run_in_threadpool(
+                    fallback_wav, generation_prompt.genre, generation_prompt.duration
+                )
+            )
+
+        # The song only points to the WAV once it is stored
+        if on_progress is not None:
+            await on_progress("uploading", GENERATION_PROGRESS)
+        if not await upload.commit():
+            raise RuntimeError(f"The audio of {generation_prompt.uuid} was not stored")
+        await mark_audio_stored(generation_prompt, storage_uri)
+        return storage_uri
+
+    except BaseException:
+        await upload.abort()
+        raise
+
+
+async def stream_and_store(generation_prompt: PromptMusic, storage_uri: str):
+    """The generated WAV, uploaded while it is streamed. The song points to it once the
+    upload is committed, a stream the client leaves stores nothing."""
+    upload = audio_upload(generation_prompt.uuid)
+    try:
+        async for chunk in music_generator.generate(generation_prompt, upload=upload):
+            yield chunk
+    except BaseException:
+        await upload.abort()
+        raise
+
+    try:
+        if not await upload.commit():
+            raise RuntimeError(f"The audio of {generation_prompt.uuid} was not stored")
+        await mark_audio_stored(generation_prompt, storage_uri)
+    except Exception as e:
+        # the client has the whole track already (Firestore is expected to fail in local
+        # mode without credentials)
+        logging.warning(f"Storing the song failed: {e}")
+
+
+@router.get(
+    "/song",
+    responses={
+        200: {
+            "content": {"audio/wav": {}},
+            "description": "Returning a generated wav file",
+        }
+    },
+)
+async def generate_music(
+    uuid: str,
+    genre: Annotated[str, Depends(get_genre)],
+    title: str,
+    prompt: str,
+    duration: int,
+    creator: str,
+    background_tasks: BackgroundTasks,
+    preset: Optional[Literal["draft", "standard", "studio"]] = None,
+):
+
+    generation_prompt = PromptMusic(
+        uuid=uuid,
+        genre=genre,
+        title=title,
+        prompt=prompt,
+        duration=duration,
+        creator=creator,
+        preset=preset,
+    )
+
+    try:
+        storage_uri = await generate_and_store(generation_prompt)
 
         return JSONResponse(
             content={
@@ -252,64 +313,119 @@ async def generate_music(
     except Exception as e:
         logging.error(e)
         raise_500()
-    finally:
-        buffer.close()
 
 
 @router.get(
     "/song/stream",
     responses={
         200: {
-            "content": {"audio/wav": {}},
-            "description": "Returning a generated wav file",
+            "content": {media_type: {} for media_type in MEDIA_TYPES.values()},
+            "description": "Returning a generated wav file, or its Opus, FLAC or MP3 encoding",
         }
     },
 )
 async def generate_music_stream(
-    uuid: str, genre: Annotated[str, Depends(get_genre)], title: str, prompt: str, duration: int, creator: str = "Unknown"
+    uuid: str,
+    genre: Annotated[str, Depends(get_genre)],
+    title: str,
+    prompt: str,
+    duration: int,
+    creator: str = "Unknown",
+    output_format: Literal["wav", "opus", "flac", "mp3"] = Query("wav", alias="format"),
+    preset: Optional[Literal["draft", "standard", "studio"]] = None,
 ) -> StreamingResponse:
 
+    if output_format != "wav":
+        try:
+            require_av(output_format)
+        except RuntimeError as e:
+            raise_500(str(e))
+
     generation_prompt = PromptMusic(
-        uuid=uuid, genre=genre, title=title, prompt=prompt, duration=duration, creator=creator
+        uuid=uuid,
+        genre=genre,
+        title=title,
+        prompt=prompt,
+        duration=duration,
+        creator=creator,
+        preset=preset,
     )
 
     storage_uri = f"https://storage.googleapis.com/{settings.GCLOUD_MUSIC_BUCKET}/{generation_prompt.uuid}/output.wav"
 
     try:
-        # Try to update Firestore if credentials are available (optional in local mode)
-        id_ = generation_prompt.uuid
-        firestore_object: MusicUpdate = await crud.firestore.get_document_in_subcollection(
-            settings.JUKEBOX_COLLECTION, settings.MUSIC_SUB_COLLECTION, generation_prompt.genre, id_
-        )
 
-        firestore_object["duration"] = generation_prompt.duration
-        firestore_object["audio"] = storage_uri
-        firestore_object["updated_at"] = datetime.now()
+        audio_stream = stream_and_store(generation_prompt, storage_uri)
+        if output_format != "wav":
+            # the generated WAV is re-encoded as it is downloaded
+            audio_stream = transcode_wav_stream(
+                audio_stream, output_format, bitrate=get_bitrate(output_format)
+            )
 
-        await crud.firestore.update_document_in_subcollection(
-            settings.JUKEBOX_COLLECTION,
-            settings.MUSIC_SUB_COLLECTION,
-            generation_prompt.genre,
-            id_,
-            dict(firestore_object),
-        )
-    except Exception as fs_error:
-        # Firestore update failed (expected in local mode without credentials)
-        # Continue with music generation anyway
-        logging.warning(f"Firestore update skipped: {fs_error}")
-
-    try:
-
-        return StreamingResponse(
-            music_generator.generate(generation_prompt),
-            media_type="audio/x-wav",
-        )
+        return StreamingResponse(audio_stream, media_type=MEDIA_TYPES[output_format])
 
     except Exception as e:
         logging.error(e)
         raise_500()
 
 
+def stream_track(blob, start: int, end: int):
+    chunks = cloud_storage_service.iter_range(blob, start, end)
+    # only the first chunk can hold the header
+    yield patch_wav_sizes(next(chunks, b""), start, blob.size)
+    yield from chunks
+
+
+@router.get(
+    "/song/{id}/audio",
+    responses={
+        200: {"content": {"audio/wav": {}}, "description": "Returning a stored wav file"},
+        206: {"content": {"audio/wav": {}}, "description": "Returning the requested range"},
+    },
+)
+async def get_music_audio(
+    id: str,
+    range_header: Annotated[Optional[str], Header(alias="Range")] = None,
+    if_range: Annotated[Optional[str], Header()] = None,
+) -> StreamingResponse:
+
+    blob = await run_in_threadpool(
+        cloud_storage_service.get_blob, settings.GCLOUD_MUSIC_BUCKET, f"{id}/output.wav"
+    )
+    if blob is None:
+        raise_404()
+
+    size = blob.size
+    etag = f'"{blob.etag}"'
+    headers = {"Accept-Ranges": "bytes", "ETag": etag}
+    byte_range = None
+    # a range of an older version of the file would be spliced with the new one
+    if range_header and (if_range is None or if_range == etag):
+        try:
+            byte_range = parse_range(range_header, size)
+        except ValueError:
+            raise HTTPException(
+                status_code=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE,
+                headers={"Content-Range": f"bytes */{size}"},
+            )
+
+    if byte_range is None:
+        start, end = 0, size - 1
+        status_code = status.HTTP_200_OK
+    else:
+        start, end = byte_range
+        status_code = status.HTTP_206_PARTIAL_CONTENT
+        headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+    headers["Content-Length"] = str(end - start + 1)
+
+    return StreamingResponse(
+        stream_track(blob, start, end),
+        status_code=status_code,
+        media_type=blob.content_type or "audio/wav",
+        headers=headers,
+    )
+
+
 @router.put(
     "/{id}",
     response_model=MusicUpdate,
@@ -0,0 +1,21 @@
+from datetime import datetime
+from typing import Literal, Optional
+
+from pydantic import BaseModel, Field
+
+JobStatus = Literal["queued", "generating", "uploading", "done", "failed"]
+
+TERMINAL_STATUSES = ("done", "failed")
+
+
+class Job(BaseModel):
+    """Generation job of a song, its id is the song's uuid"""
+
+    id: str
+    genre: str
+    status: JobStatus = "queued"
+    # percent complete, estimated from the audio received for the requested duration
+    progress: float = Field(0.0, ge=0, le=100)
+    audio: Optional[str] = None
+    error: Optional[str] = None
+    updated_at: datetime
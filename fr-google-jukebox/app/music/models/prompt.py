@@ -1,5 +1,5 @@
 from pydantic import BaseModel, Field, validator
-from typing import Optional
+from typing import Literal, Optional
 from app.core.config import settings
 
 
@@ -41,3 +41,5 @@ class PromptCover(PromptBase):
 
 class PromptMusic(PromptBase):
     uuid: str = Field(...)
+    # speed and quality trade-off of the generation, the generator's default when unset
+    preset: Optional[Literal["draft", "standard", "studio"]] = None
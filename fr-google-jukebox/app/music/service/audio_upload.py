@@ -0,0 +1,139 @@
+import asyncio
+import io
+import logging
+import time
+from datetime import datetime, timezone
+from tempfile import SpooledTemporaryFile
+from typing import Optional
+
+from starlette.concurrency import run_in_threadpool
+
+from app.core.google_cloud.cloud_storage import CloudStorageService
+
+# resumable uploads are sent in multiples of 256 KiB
+UPLOAD_CHUNK_SIZE = 4 * 256 * 1024
+# bytes of the track held in memory before it is spooled to disk
+SPOOL_MAX_MEMORY = 8 * 1024 * 1024
+# how long and how often to look for the object of a backend that stores the track itself
+BACKEND_COMMIT_TIMEOUT_S = 60.0
+BACKEND_COMMIT_POLL_S = 1.0
+
+
+class AudioUpload:
+    """Uploads a track to GCS while it is streamed to the client.
+
+    `write` only spools the chunk, a background task sends the spooled bytes in a resumable
+    upload, so a slow upload never holds back the stream and memory stays bounded however
+    far behind it is. The object is only created by `commit`; after `abort`, or when the
+    upload fails, nothing is stored.
+
+    When the backend uploads the track itself (`stored_by_backend`), nothing is written and
+    `commit` waits for the backend's object to be created instead, an object stored before
+    this upload started (an earlier generation of the song) doesn't count.
+    """
+
+    def __init__(
+        self,
+        storage: CloudStorageService,
+        bucket_name: str,
+        blob_name: str,
+        content_type: str = "audio/wav",
+    ):
+        self.storage = storage
+        self.bucket_name = bucket_name
+        self.blob_name = blob_name
+        self.content_type = content_type
+        self.spool = SpooledTemporaryFile(max_size=SPOOL_MAX_MEMORY)
+        self.size = 0
+        self.uploaded = 0
+        self.closed = False
+        self.aborted = False
+        self.stored_by_backend = False
+        self.more = asyncio.Event()
+        self.writer = None
+        self.task: Optional[asyncio.Task] = None
+        self.started_at = datetime.now(timezone.utc)
+
+    def _failed(self) -> bool:
+        return self.task is not None and self.task.done() and self.task.exception() is not None
+
+    async def write(self, chunk: bytes):
+        if self.task is None:
+            self.task = asyncio.create_task(self._upload())
+        if self._failed():
+            # nothing will be stored, the rest of the track isn't kept either
+            return
+        self.spool.seek(0, io.SEEK_END)
+        self.spool.write(chunk)
+        self.size += len(chunk)
+        self.more.set()
+
+    async def _upload(self):
+        self.writer = await run_in_threadpool(
+            self.storage.open_writer,
+            self.bucket_name,
+            self.blob_name,
+            content_type=self.content_type,
+            chunk_size=UPLOAD_CHUNK_SIZE,
+        )
+        while True:
+            await self.more.wait()
+            self.more.clear()
+            while self.uploaded < self.size and not self.aborted:
+                self.spool.seek(self.uploaded)
+                data = self.spool.read(UPLOAD_CHUNK_SIZE)
+                await run_in_threadpool(self.writer.write, data)
+                self.uploaded += len(data)
+            if self.aborted:
+                return
+            if self.closed:
+                break
+        # finalizes the resumable upload, the object only exists from here on
+        await run_in_threadpool(self.writer.close)
+
+    async def commit(self) -> bool:
+        """Wait for the whole track to be stored, False when it wasn't."""
+        if self.stored_by_backend:
+            self.spool.close()
+            return await self._wait_for_backend()
+        if self.task is None:
+            self.spool.close()
+            return False
+        self.closed = True
+        self.more.set()
+        try:
+            await self.task
+        except Exception as e:
+            logging.warning(f"Upload of {self.blob_name} failed: {e}")
+            if self.writer is not None and not self.writer.closed:
+                await run_in_threadpool(self.storage.cancel_writer, self.writer)
+            return False
+        finally:
+            self.spool.close()
+        return True
+
+    async def _wait_for_backend(self) -> bool:
+        # the backend finalizes its upload once the stream has ended
+        deadline = time.monotonic() + BACKEND_COMMIT_TIMEOUT_S
+        while True:
+            blob = await run_in_threadpool(self.storage.get_blob, self.bucket_name, self.blob_name)
+            if blob is not None and blob.time_created >= self.started_at:
+                return True
+            if time.monotonic() >= deadline:
+                return False
+            await asyncio.sleep(BACKEND_COMMIT_POLL_S)
+
+    async def abort(self):
+        """Drop the upload, once this returns the object won't be created by it."""
+        self.aborted = True
+        if self.task is not None:
+            # the task stops after the chunk being sent, the writer isn't closed since
+            # closing it would finalize the upload
+            self.more.set()
+            try:
+                await self.task
+            except Exception:
+                pass
+            if self.writer is not None and not self.writer.closed:
+                await run_in_threadpool(self.storage.cancel_writer, self.writer)
+        self.spool.close()
@@ -0,0 +1,53 @@
+from typing import Optional, Tuple
+
+# Size of the header written by pcm.wav_header, RIFF size at 4 and data size at 40
+WAV_HEADER_SIZE = 44
+
+
+def parse_range(range_header: str, size: int) -> Optional[Tuple[int, int]]:
+    """First and last byte (inclusive) requested by a `Range: bytes=...` header.
+
+    Returns None when the whole object should be sent instead: other units, or several
+    ranges, which clients can't rely on being served. Raises ValueError when the range
+    can't be satisfied."""
+    unit, _, ranges = range_header.partition("=")
+    if unit.strip() != "bytes" or "," in ranges:
+        return None
+    first, _, last = ranges.strip().partition("-")
+    try:
+        if first:
+            start = int(first)
+            end = min(int(last), size - 1) if last else size - 1
+        else:
+            # suffix range, the last N bytes
+            start = max(size - int(last), 0)
+            end = size - 1
+    except ValueError:
+        return None
+    if start > end or start >= size:
+        raise ValueError(f"Range {range_header!r} can't be satisfied for {size} bytes")
+    return start, end
+
+
+def patch_wav_sizes(data: bytes, start: int, size: int) -> bytes:
+    """Correct the sizes in the header of a WAV object of `size` bytes, when `data` starts
+    at byte `start` of the object and covers the header.
+
+    Tracks streamed before their length was known were stored with a placeholder data
+    size, which makes players report a wrong duration and refuse to seek."""
+    if start != 0 or len(data) < WAV_HEADER_SIZE:
+        return data
+    if data[:4] != b"RIFF" or data[8:12] != b"WAVE" or data[36:40] != b"data":
+        return data
+    header = bytearray(data[:WAV_HEADER_SIZE])
+    header[4:8] = (size - 8).to_bytes(4, "little")
+    header[40:44] = (size - WAV_HEADER_SIZE).to_bytes(4, "little")
+    return bytes(header) + data[WAV_HEADER_SIZE:]
+
+
+def wav_byte_rate(data: bytes) -> Optional[int]:
+    """Bytes per second of audio announced by the WAV header at the start of `data`, None
+    when `data` doesn't start with a WAV whose first chunk is its format."""
+    if len(data) < 32 or data[:4] != b"RIFF" or data[8:12] != b"WAVE" or data[12:16] != b"fmt ":
+        return None
+    return int.from_bytes(data[28:32], "little")
@@ -1,13 +1,32 @@
+import asyncio
+import logging
+import time
+from typing import Optional
+
 import google.generativeai as genai
-import requests
+import httpx
 import vertexai
 import replicate
-import io
 
 from vertexai.preview.vision_models import ImageGenerationModel
 
 from app.core.config import settings
+from app.core.http_client import get_http_client
 from app.music.models.prompt import PromptBase, PromptCover, PromptMusic
+from app.music.service.audio_upload import AudioUpload
+
+# Replicate inputs of the generation presets. Replicate only hosts the large MusicGen, the
+# draft preset uses its mono version without guidance and studio is the same as standard.
+REPLICATE_PRESETS = {
+    "draft": {"model_version": "large", "classifier_free_guidance": 1},
+    "standard": {"model_version": "stereo-large"},
+    "studio": {"model_version": "stereo-large"},
+}
+
+# meta/musicgen
+MUSICGEN_VERSION = "671ac645ce5e552cc63a54a2bbff63fcf798043055d2dac5fc9e36a837eedcfb"
+# size of the chunks the generated audio is streamed in
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
 
 
 class GenerativeAI:
@@ -83,7 +102,14 @@ class CoverGenerator(GenerativeAI):
             raise e
 
 
-class MusicGenerator(GenerativeAI):
+class BackendUnavailableError(Exception):
+    """The music backend can't take a generation right now, another one may."""
+
+
+class ReplicateMusicBackend:
+    name = "replicate"
+    stores_audio = False
+
     def __init__(self):
         self._client = None
 
@@ -94,28 +120,116 @@ class MusicGenerator(GenerativeAI):
         return self._client
 
     async def generate(self, prompt: PromptMusic):
+        # Use Replicate MusicGen model, polling the prediction without blocking the loop
+        prediction = await self.client.predictions.async_create(
+            version=MUSICGEN_VERSION,
+            input={
+                "prompt": prompt.prompt,
+                "duration": prompt.duration,
+                **REPLICATE_PRESETS[prompt.preset or "standard"],
+            },
+        )
         try:
-            # Use Replicate MusicGen model
-            output = self.client.run(
-                "meta/musicgen:671ac645ce5e552cc63a54a2bbff63fcf798043055d2dac5fc9e36a837eedcfb",
-                input={
-                    "prompt": prompt.prompt,
-                    "duration": prompt.duration,
-                    "model_version": "stereo-large",
-                },
-            )
+            await asyncio.wait_for(prediction.async_wait(), settings.REPLICATE_TIMEOUT_S)
+        except (asyncio.TimeoutError, asyncio.CancelledError):
+            # timed out, or the client went away: stop paying for the prediction
+            await prediction.async_cancel()
+            raise
+        if prediction.status != "succeeded":
+            raise RuntimeError(f"Replicate prediction {prediction.status}: {prediction.error}")
 
-            # output is a URL to the generated audio file
-            # Download it and yield as chunks
-            response = requests.get(output, stream=True)
+        # output is a URL to the generated audio file
+        # Download it and yield as chunks
+        async with get_http_client().stream("GET", prediction.output) as response:
             response.raise_for_status()
+            async for chunk in response.aiter_bytes(DOWNLOAD_CHUNK_SIZE):
+                yield chunk
+
+
+class SelfHostedMusicBackend:
+    """Streams the WAV of the fr-google-jukebox-musicgen service at `url` as it is generated.
+
+    The service answers 429 when its queue is full and 503 while its model loads, with the
+    seconds to wait in Retry-After. The backend is then skipped for that long, as it is for
+    MUSICGEN_RETRY_S after a connection error or a server error."""
+
+    name = "musicgen"
+    # the service uploads the track it generates to the bucket itself
+    stores_audio = True
+
+    def __init__(self, url: str):
+        self.url = url.rstrip("/")
+        self.unavailable_until = 0.0
+
+    @property
+    def available(self) -> bool:
+        return time.monotonic() >= self.unavailable_until
 
-            for chunk in response.iter_content(chunk_size=1024):
-                if chunk:
+    def mark_unavailable(self, retry_after: Optional[str] = None):
+        try:
+            delay = float(retry_after)
+        except (TypeError, ValueError):
+            delay = settings.MUSICGEN_RETRY_S
+        self.unavailable_until = time.monotonic() + delay
+
+    async def generate(self, prompt: PromptMusic):
+        params = {"uuid": prompt.uuid, "prompt": prompt.prompt, "duration": prompt.duration}
+        if prompt.preset:
+            params["preset"] = prompt.preset
+        try:
+            async with get_http_client().stream(
+                "GET", f"{self.url}/generate_audio", params=params
+            ) as response:
+                if response.status_code in (429, 503) or response.status_code >= 500:
+                    self.mark_unavailable(response.headers.get("Retry-After"))
+                    raise BackendUnavailableError(f"{self.url} answered {response.status_code}")
+                response.raise_for_status()
+                # chunks are forwarded as they arrive, the first one as soon as it is decoded
+                async for chunk in response.aiter_bytes():
                     yield chunk
+        except httpx.TransportError as e:
+            self.mark_unavailable()
+            raise BackendUnavailableError(f"{self.url} unreachable: {e!r}") from e
 
-        except Exception as e:
-            raise e
+
+class MusicGenerator(GenerativeAI):
+    """Generates the music with the backends of MUSIC_BACKEND.
+
+    `auto` streams from the self-hosted service at MUSICGEN_URL and fails over to Replicate
+    when it is saturated or down, as long as no audio was sent yet. The audio of backends
+    that don't store the track is also written to `upload` as it is streamed."""
+
+    def __init__(self):
+        self.replicate = ReplicateMusicBackend()
+        self.musicgen = (
+            SelfHostedMusicBackend(settings.MUSICGEN_URL) if settings.MUSICGEN_URL else None
+        )
+
+    def backends(self) -> list:
+        if settings.MUSIC_BACKEND == "replicate" or self.musicgen is None:
+            return [self.replicate]
+        if settings.MUSIC_BACKEND == "musicgen":
+            return [self.musicgen]
+        return ([self.musicgen] if self.musicgen.available else []) + [self.replicate]
+
+    async def generate(self, prompt: PromptMusic, upload: Optional[AudioUpload] = None):
+        backends = self.backends()
+        for index, backend in enumerate(backends):
+            started = False
+            try:
+                async for chunk in backend.generate(prompt):
+                    started = True
+                    if upload is not None:
+                        if backend.stores_audio:
+                            upload.stored_by_backend = True
+                        else:
+                            await upload.write(chunk)
+                    yield chunk
+                return
+            except BackendUnavailableError as e:
+                if started or index == len(backends) - 1:
+                    raise
+                logging.warning(f"Music backend {backend.name} unavailable, failing over: {e}")
 
 
 class SettingsGenerator(GenerativeAI):
@@ -0,0 +1,122 @@
+import asyncio
+import logging
+import time
+from datetime import datetime
+from typing import AsyncIterator, Dict, Optional
+
+from app.core.config import settings
+from app.firestore import crud
+from app.music.models.job import TERMINAL_STATUSES, Job
+
+
+class JobStore:
+    """The generation jobs of this instance, in memory.
+
+    Every update wakes the watchers of the job up. Finished jobs are forgotten JOB_TTL_S
+    after their last update. Subclasses also save the jobs elsewhere (`save`) and load the
+    jobs of other instances from there (`load`), which the watchers then poll.
+    """
+
+    def __init__(self):
+        self.jobs: Dict[str, Job] = {}
+        # set and replaced on every update of the job
+        self.changed: Dict[str, asyncio.Event] = {}
+
+    def _prune(self):
+        now = datetime.now()
+        for job_id, job in list(self.jobs.items()):
+            age_s = (now - job.updated_at).total_seconds()
+            if job.status in TERMINAL_STATUSES and age_s > settings.JOB_TTL_S:
+                del self.jobs[job_id]
+                del self.changed[job_id]
+
+    def running(self, job_id: str) -> bool:
+        job = self.jobs.get(job_id)
+        return job is not None and job.status not in TERMINAL_STATUSES
+
+    async def create(self, job_id: str, genre: str) -> Job:
+        self._prune()
+        job = Job(id=job_id, genre=genre, updated_at=datetime.now())
+        self.jobs[job_id] = job
+        self.changed[job_id] = asyncio.Event()
+        await self.save(job)
+        return job
+
+    async def update(self, job_id: str, **fields) -> Job:
+        previous = self.jobs[job_id]
+        job = previous.copy(update={**fields, "updated_at": datetime.now()})
+        self.jobs[job_id] = job
+        self.changed.pop(job_id).set()
+        self.changed[job_id] = asyncio.Event()
+        # progress is only saved every 10%, the watchers of this instance see all of it
+        if job.status != previous.status or job.progress // 10 != previous.progress // 10:
+            await self.save(job)
+        return job
+
+    async def get(self, job_id: str, genre: Optional[str] = None) -> Optional[Job]:
+        if job_id in self.jobs:
+            return self.jobs[job_id]
+        return await self.load(job_id, genre) if genre else None
+
+    async def watch(
+        self, job_id: str, genre: Optional[str] = None
+    ) -> AsyncIterator[Optional[Job]]:
+        """The job every time it changes, until it is finished. None is yielded every
+        JOB_KEEPALIVE_S without changes, to keep the connection of the watcher alive."""
+        last, last_sent = None, time.monotonic()
+        while True:
+            changed = self.changed.get(job_id)
+            job = await self.get(job_id, genre)
+            if job is None:
+                return
+            if job != last:
+                last, last_sent = job, time.monotonic()
+                yield job
+                if job.status in TERMINAL_STATUSES:
+                    return
+            elif time.monotonic() - last_sent >= settings.JOB_KEEPALIVE_S:
+                last_sent = time.monotonic()
+                yield None
+
+            if changed is None:
+                await asyncio.sleep(settings.JOB_POLL_S)
+            else:
+                try:
+                    await asyncio.wait_for(changed.wait(), settings.JOB_KEEPALIVE_S)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def save(self, job: Job):
+        pass
+
+    async def load(self, job_id: str, genre: str) -> Optional[Job]:
+        return None
+
+
+class FirestoreJobStore(JobStore):
+    """Also keeps the jobs in the `job` field of their song's Firestore document."""
+
+    async def save(self, job: Job):
+        try:
+            await crud.firestore.update_document_in_subcollection(
+                settings.JUKEBOX_COLLECTION,
+                settings.MUSIC_SUB_COLLECTION,
+                job.genre,
+                job.id,
+                {"job": job.dict(exclude={"id", "genre"})},
+            )
+        except Exception as fs_error:
+            # Firestore update failed (expected in local mode without credentials)
+            logging.warning(f"Firestore job update skipped: {fs_error}")
+
+    async def load(self, job_id: str, genre: str) -> Optional[Job]:
+        try:
+            document = await crud.firestore.get_document_in_subcollection(
+                settings.JUKEBOX_COLLECTION, settings.MUSIC_SUB_COLLECTION, genre, job_id
+            )
+        except Exception as fs_error:
+            logging.warning(f"Firestore job fetch skipped: {fs_error}")
+            return None
+        if not document or not document.get("job"):
+            return None
+        return Job(id=job_id, genre=genre, **document["job"])
@@ -0,0 +1,134 @@
+# Copy of fr-google-jukebox-musicgen/service/pcm.py, the backend and the MusicGen
+# service are built separately. Keep both files the same apart from this comment.
+import sys
+from typing import Optional
+
+import numpy as np
+
+SAMPLE_FORMATS = ("int16", "int24", "float32")
+
+# bytes per sample and full scale of each format
+_SAMPLE_WIDTHS = {"int16": 2, "int24": 3, "float32": 4}
+_FULL_SCALES = {"int16": 32767.0, "int24": 8388607.0, "float32": 1.0}
+
+# Data size announced by the header of a stream whose length isn't known yet
+STREAMING_DATA_SIZE = 2000 * 10**6
+
+
+class PcmEncoder:
+    """Converts float audio in [-1, 1] to interleaved little-endian PCM bytes.
+
+    Samples are scaled to the full range of the format and clipped instead of wrapping
+    around. Integer formats can be dithered (triangular, one LSB) before rounding. The
+    working buffers are kept between calls, so encoding the chunks of a stream doesn't
+    allocate once they have reached their largest size.
+    """
+
+    def __init__(
+        self,
+        sample_format: str = "int16",
+        channels: int = 1,
+        dither: bool = False,
+        seed: Optional[int] = None,
+    ):
+        if sample_format not in SAMPLE_FORMATS:
+            raise ValueError(
+                f"sample_format must be one of {SAMPLE_FORMATS}, got {sample_format!r}"
+            )
+        if channels not in (1, 2):
+            raise ValueError(f"channels must be 1 or 2, got {channels}")
+        if sys.byteorder != "little":
+            raise RuntimeError("PcmEncoder only supports little-endian hosts")
+
+        self.sample_format = sample_format
+        self.channels = channels
+        self.dither = dither and sample_format != "float32"
+        self.sample_width = _SAMPLE_WIDTHS[sample_format]
+        self.full_scale = _FULL_SCALES[sample_format]
+        # integer formats go one step further on the negative side
+        self.lowest = -self.full_scale if sample_format == "float32" else -self.full_scale - 1
+        self.rng = np.random.default_rng(seed)
+
+        self.samples = np.empty(0, dtype=np.float32)
+        self.noise = np.empty(0, dtype=np.float32)
+        self.output = np.empty(0, dtype=np.uint8)
+
+    def _reserve(self, num_samples: int):
+        if self.samples.shape[0] < num_samples:
+            self.samples = np.empty(num_samples, dtype=np.float32)
+            self.noise = np.empty(num_samples, dtype=np.float32) if self.dither else self.noise
+            # int24 goes through 4 byte integers before dropping their top byte
+            self.output = np.empty(num_samples * max(self.sample_width, 4), dtype=np.uint8)
+
+    def encode(self, audio: np.ndarray) -> bytes:
+        """Encode `audio`, shaped (frames,) for mono or (channels, frames). Mono audio is
+        duplicated on both channels of a stereo encoder."""
+        audio = np.asarray(audio)
+        if audio.ndim == 1:
+            audio = audio[None, :]
+        if audio.shape[0] not in (1, self.channels):
+            raise ValueError(f"Expected 1 or {self.channels} channels, got {audio.shape[0]}")
+
+        num_frames = audio.shape[-1]
+        num_samples = num_frames * self.channels
+        self._reserve(num_samples)
+        samples = self.samples[:num_samples]
+
+        if self.channels == 1:
+            np.multiply(audio[0], self.full_scale, out=samples)
+        else:
+            # interleave the channels: frame 0 left, frame 0 right, frame 1 left, ...
+            np.multiply(audio.T, self.full_scale, out=samples.reshape(num_frames, self.channels))
+
+        if self.dither:
+            # triangular noise of one LSB peak, the difference of two uniform variables
+            noise = self.noise[:num_samples]
+            self.rng.random(out=noise, dtype=np.float32)
+            np.add(samples, noise, out=samples)
+            self.rng.random(out=noise, dtype=np.float32)
+            np.subtract(samples, noise, out=samples)
+
+        np.clip(samples, self.lowest, self.full_scale, out=samples)
+        if self.sample_format == "float32":
+            return samples.tobytes()
+
+        np.rint(samples, out=samples)
+        if self.sample_format == "int16":
+            integers = self.output[: num_samples * 2].view(np.int16)
+            np.copyto(integers, samples, casting="unsafe")
+            return integers.tobytes()
+
+        integers = self.output[: num_samples * 4].view(np.int32)
+        np.copyto(integers, samples, casting="unsafe")
+        # the three low bytes of each little-endian int32
+        return integers.view(np.uint8).reshape(num_samples, 4)[:, :3].tobytes()
+
+
+def wav_header(
+    sample_rate: int,
+    channels: int = 1,
+    sample_format: str = "int16",
+    data_size: int = STREAMING_DATA_SIZE,
+) -> bytes:
+    """RIFF/WAVE header for PCM data in `sample_format`. Streams whose length isn't known
+    yet announce STREAMING_DATA_SIZE bytes of data."""
+    if sample_format not in SAMPLE_FORMATS:
+        raise ValueError(f"sample_format must be one of {SAMPLE_FORMATS}, got {sample_format!r}")
+    sample_width = _SAMPLE_WIDTHS[sample_format]
+    # format tag 1 is integer PCM, 3 is IEEE float
+    format_tag = 3 if sample_format == "float32" else 1
+
+    o = bytes("RIFF", "ascii")  # (4byte) Marks file as RIFF
+    o += (data_size + 36).to_bytes(4, "little")  # (4byte) File size excluding this and RIFF
+    o += bytes("WAVE", "ascii")  # (4byte) File type
+    o += bytes("fmt ", "ascii")  # (4byte) Format Chunk Marker
+    o += (16).to_bytes(4, "little")  # (4byte) Length of above format data
+    o += (format_tag).to_bytes(2, "little")  # (2byte) Format type
+    o += (channels).to_bytes(2, "little")  # (2byte)
+    o += (sample_rate).to_bytes(4, "little")  # (4byte)
+    o += (sample_rate * channels * sample_width).to_bytes(4, "little")  # (4byte) Byte rate
+    o += (channels * sample_width).to_bytes(2, "little")  # (2byte) Block align
+    o += (sample_width * 8).to_bytes(2, "little")  # (2byte) Bits per sample
+    o += bytes("data", "ascii")  # (4byte) Data Chunk Marker
+    o += (data_size).to_bytes(4, "little")  # (4byte) Data size in bytes
+    return o
@@ -0,0 +1,119 @@
+from functools import lru_cache
+from typing import List, Sequence
+
+import numpy as np
+
+from app.music.service.pcm import PcmEncoder, wav_header
+
+SAMPLE_RATE = 44100
+# peak level of the rendered tracks, leaving headroom under full scale
+LEVEL = 0.5
+
+
+def note_frequency(note: int) -> float:
+    """Frequency of a MIDI note number, 69 being A4 at 440 Hz."""
+    return 440.0 * 2 ** ((note - 69) / 12)
+
+
+def tone(
+    frequency: float, duration_s: float, sample_rate: int = SAMPLE_RATE, harmonics: int = 1
+) -> np.ndarray:
+    """A tone of `harmonics` partials in 1/k amplitudes, peaking at most at 1."""
+    t = np.arange(int(duration_s * sample_rate), dtype=np.float32) / sample_rate
+    partials = np.arange(1, harmonics + 1, dtype=np.float32)
+    # one row per partial, summed over the rows
+    waves = np.sin((2 * np.pi * frequency) * partials[:, None] * t) / partials[:, None]
+    return (waves.sum(axis=0) / (1 / partials).sum()).astype(np.float32)
+
+
+def chord(
+    notes: Sequence[int], duration_s: float, sample_rate: int = SAMPLE_RATE, harmonics: int = 1
+) -> np.ndarray:
+    """The MIDI `notes` played together, peaking at most at 1."""
+    tones = [tone(note_frequency(note), duration_s, sample_rate, harmonics) for note in notes]
+    return np.mean(tones, 0)
+
+
+def fade(audio: np.ndarray, fade_in_s: float, fade_out_s: float, sample_rate: int = SAMPLE_RATE):
+    """Apply linear fades to both ends of `audio`, in place."""
+    fade_in = min(int(fade_in_s * sample_rate), audio.shape[-1])
+    fade_out = min(int(fade_out_s * sample_rate), audio.shape[-1])
+    if fade_in:
+        audio[..., :fade_in] *= np.linspace(0, 1, fade_in, endpoint=False, dtype=audio.dtype)
+    if fade_out:
+        audio[..., -fade_out:] *= np.linspace(1, 0, fade_out, endpoint=False, dtype=audio.dtype)
+    return audio
+
+
+def decay(audio: np.ndarray, decay_s: float, sample_rate: int = SAMPLE_RATE):
+    """Make `audio` die out exponentially, like a plucked or struck note, in place."""
+    t = np.arange(audio.shape[-1], dtype=audio.dtype) / sample_rate
+    audio *= np.exp(-t / decay_s)
+    return audio
+
+
+class Pattern:
+    """A chord progression played in a loop: every beat strikes the chord of its bar, with
+    the root an octave lower on the first beat of the bar."""
+
+    def __init__(
+        self,
+        bpm: float,
+        progression: List[Sequence[int]],
+        beats_per_bar: int = 4,
+        harmonics: int = 1,
+        sustain: float = 0.5,
+    ):
+        self.bpm = bpm
+        self.progression = progression
+        self.beats_per_bar = beats_per_bar
+        self.harmonics = harmonics
+        # decay time of a struck chord, as a fraction of the beat
+        self.sustain = sustain
+
+    def render_bar(self, notes: Sequence[int], sample_rate: int = SAMPLE_RATE) -> np.ndarray:
+        beat_s = 60.0 / self.bpm
+        beat = chord(notes, beat_s, sample_rate, self.harmonics)
+        # short fades keep the strikes from clicking
+        fade(decay(beat, beat_s * self.sustain, sample_rate), 0.005, 0.01, sample_rate)
+        bar = np.tile(beat, self.beats_per_bar)
+
+        bass = tone(note_frequency(notes[0] - 12), beat_s, sample_rate, self.harmonics)
+        fade(decay(bass, beat_s, sample_rate), 0.005, 0.01, sample_rate)
+        bar[: bass.shape[0]] += bass
+        return bar / 2
+
+    def render(self, duration_s: float, sample_rate: int = SAMPLE_RATE) -> np.ndarray:
+        """The pattern looped over `duration_s`, each bar is only synthesized once."""
+        loop = np.concatenate([self.render_bar(notes, sample_rate) for notes in self.progression])
+        return np.resize(loop, int(duration_s * sample_rate))
+
+
+GENRE_PATTERNS = {
+    "Ambiente": Pattern(60, [(60, 64, 67, 71), (57, 60, 64, 67)], sustain=2.0),
+    "Chill Out": Pattern(85, [(62, 65, 69, 72), (55, 59, 62, 65), (60, 64, 67, 71)], sustain=1.0),
+    "Classic": Pattern(90, [(60, 64, 67), (65, 69, 72), (67, 71, 74), (60, 64, 67)], 3),
+    "Corporate": Pattern(110, [(60, 64, 67), (67, 71, 74), (57, 60, 64), (65, 69, 72)]),
+    "Country": Pattern(120, [(67, 71, 74), (60, 64, 67), (62, 66, 69)], 2, harmonics=3),
+    "EDM": Pattern(128, [(57, 60, 64), (53, 57, 60), (60, 64, 67), (55, 59, 62)], sustain=0.25),
+    "Folk": Pattern(100, [(62, 66, 69), (67, 71, 74), (69, 73, 76)], 3, harmonics=2),
+    "Funk": Pattern(105, [(64, 67, 71, 74), (69, 73, 76, 79)], harmonics=3, sustain=0.2),
+    "Hip Hop": Pattern(90, [(57, 60, 64, 67), (62, 65, 69, 72)], harmonics=2, sustain=0.3),
+    "Jazz": Pattern(100, [(62, 65, 69, 72), (67, 71, 74, 77), (60, 64, 67, 71)], sustain=0.8),
+    "Rock": Pattern(120, [(64, 71, 76), (60, 67, 72), (67, 74, 79), (62, 69, 74)], harmonics=4),
+    "Videogames": Pattern(
+        140, [(72, 76, 79), (69, 72, 76), (65, 69, 72), (67, 71, 74)], harmonics=5, sustain=0.3
+    ),
+}
+
+
+@lru_cache(maxsize=16)
+def fallback_wav(genre: str, duration_s: int) -> bytes:
+    """The int16 WAV played when the music generation fails, rendered once per genre and
+    duration."""
+    pattern = GENRE_PATTERNS.get(genre)
+    # genres without a pattern get the A4 tone the fallback used to be
+    audio = pattern.render(duration_s) if pattern else tone(440.0, duration_s)
+    fade(audio, 0.1, 0.1)
+    pcm = PcmEncoder("int16").encode(LEVEL * audio / max(np.abs(audio).max(), 1e-9))
+    return wav_header(SAMPLE_RATE, 1, "int16", data_size=len(pcm)) + pcm
@@ -0,0 +1,113 @@
+from typing import AsyncIterator, Optional
+
+import numpy as np
+
+from app.music.service.audio_encoder import StreamingAudioEncoder
+
+# format tags of the fmt chunk
+_PCM = 1
+_IEEE_FLOAT = 3
+_EXTENSIBLE = 0xFFFE
+
+
+class WavStreamReader:
+    """Parses a WAV file as its bytes arrive and returns the samples read so far.
+
+    The header chunks are parsed once they are complete, then every call to `feed` returns
+    the whole frames received as float audio shaped (channels, frames). Streamed WAVs
+    often announce a wrong data size, the data chunk is read until the stream ends.
+    """
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.riff_checked = False
+        self.in_data = False
+        self.format_tag = None
+        self.channels = None
+        self.sample_rate = None
+        self.sample_width = None
+
+    def feed(self, data: bytes) -> np.ndarray:
+        self.buffer += data
+        if not self.in_data:
+            self._parse_header()
+        if not self.in_data:
+            return np.zeros((self.channels or 1, 0), dtype=np.float32)
+
+        block_align = self.channels * self.sample_width
+        size = len(self.buffer) // block_align * block_align
+        frames = self._to_float(bytes(self.buffer[:size]))
+        del self.buffer[:size]
+        return frames.reshape(-1, self.channels).T
+
+    def _parse_header(self):
+        if not self.riff_checked:
+            if len(self.buffer) < 12:
+                return
+            if self.buffer[:4] != b"RIFF" or self.buffer[8:12] != b"WAVE":
+                raise ValueError("Not a WAV stream")
+            del self.buffer[:12]
+            self.riff_checked = True
+
+        while len(self.buffer) >= 8:
+            chunk_id = bytes(self.buffer[:4])
+            chunk_size = int.from_bytes(self.buffer[4:8], "little")
+            if chunk_id == b"data":
+                if self.format_tag is None:
+                    raise ValueError("WAV data chunk before its fmt chunk")
+                del self.buffer[:8]
+                self.in_data = True
+                return
+            # chunks are padded to an even size
+            padded_size = chunk_size + chunk_size % 2
+            if len(self.buffer) < 8 + padded_size:
+                return
+            if chunk_id == b"fmt ":
+                self._parse_format(bytes(self.buffer[8 : 8 + chunk_size]))
+            del self.buffer[: 8 + padded_size]
+
+    def _parse_format(self, fmt: bytes):
+        format_tag = int.from_bytes(fmt[0:2], "little")
+        if format_tag == _EXTENSIBLE:
+            # the actual tag starts the sub-format GUID
+            format_tag = int.from_bytes(fmt[24:26], "little")
+        bits = int.from_bytes(fmt[14:16], "little")
+        if (format_tag, bits) not in ((_PCM, 16), (_PCM, 24), (_PCM, 32), (_IEEE_FLOAT, 32)):
+            raise ValueError(f"Unsupported WAV format {format_tag} with {bits} bits")
+        self.format_tag = format_tag
+        self.channels = int.from_bytes(fmt[2:4], "little")
+        self.sample_rate = int.from_bytes(fmt[4:8], "little")
+        self.sample_width = bits // 8
+
+    def _to_float(self, data: bytes) -> np.ndarray:
+        if self.format_tag == _IEEE_FLOAT:
+            return np.frombuffer(data, dtype="<f4")
+        if self.sample_width == 2:
+            return np.frombuffer(data, dtype="<i2") / np.float32(2**15)
+        if self.sample_width == 4:
+            return np.frombuffer(data, dtype="<i4") / np.float32(2**31)
+        # int24: each sample goes in the three high bytes of an int32
+        samples = np.zeros((len(data) // 3, 4), dtype=np.uint8)
+        samples[:, 1:] = np.frombuffer(data, dtype=np.uint8).reshape(-1, 3)
+        return samples.view("<i4")[:, 0] / np.float32(2**31)
+
+
+async def transcode_wav_stream(
+    wav_chunks: AsyncIterator[bytes], output_format: str, bitrate: Optional[int] = None
+) -> AsyncIterator[bytes]:
+    """Re-encode a streamed WAV to `output_format`, yielding the frames as they are encoded."""
+    reader = WavStreamReader()
+    encoder = None
+    async for chunk in wav_chunks:
+        audio = reader.feed(chunk)
+        if encoder is None:
+            if reader.sample_rate is None:
+                continue
+            encoder = StreamingAudioEncoder(
+                output_format, reader.sample_rate, reader.channels, bitrate=bitrate
+            )
+        data = encoder.encode(audio)
+        if data:
+            yield data
+    if encoder is not None:
+        yield encoder.close()
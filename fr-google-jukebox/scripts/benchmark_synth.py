@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark of the offline fallback track of /song.
+
+Compares the sample by sample loop the fallback used to be (math.sin, struct.pack and
+writeframes for every sample) with the NumPy synth, rendered from scratch and memoized.
+
+    python scripts/benchmark_synth.py --duration 35 --genre Jazz
+"""
+
+import argparse
+import math
+import os
+import struct
+import sys
+import time
+import wave
+from io import BytesIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from app.music.service.synth import SAMPLE_RATE, fallback_wav  # noqa: E402
+
+
+def loop_wav(duration_s: int) -> bytes:
+    frequency = 440.0
+    num_samples = SAMPLE_RATE * duration_s
+    wav_buffer = BytesIO()
+    with wave.open(wav_buffer, "w") as wav_file:
+        wav_file.setnchannels(1)
+        wav_file.setsampwidth(2)
+        wav_file.setframerate(SAMPLE_RATE)
+        for i in range(num_samples):
+            t = i / SAMPLE_RATE
+            fade = min(1.0, i / (SAMPLE_RATE * 0.1), (num_samples - i) / (SAMPLE_RATE * 0.1))
+            value = int(16000 * fade * math.sin(2 * math.pi * frequency * t))
+            wav_file.writeframes(struct.pack("<h", value))
+    return wav_buffer.getvalue()
+
+
+def best_of(runs: int, function, *args) -> float:
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        function(*args)
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the offline fallback track")
+    parser.add_argument("--duration", type=int, default=35)
+    parser.add_argument("--genre", default="Jazz")
+    parser.add_argument("--runs", type=int, default=3)
+    args = parser.parse_args()
+
+    def rendered(genre, duration):
+        fallback_wav.cache_clear()
+        return fallback_wav(genre, duration)
+
+    results = {
+        "python loop": best_of(args.runs, loop_wav, args.duration),
+        "numpy synth": best_of(args.runs, rendered, args.genre, args.duration),
+        "numpy synth, memoized": best_of(args.runs, fallback_wav, args.genre, args.duration),
+    }
+    print(f"{args.duration} s of {args.genre} at {SAMPLE_RATE} Hz, best of {args.runs}")
+    for name, seconds in results.items():
+        speedup = results["python loop"] / seconds
+        print(f"   {name:<24}{seconds * 1000:10.3f} ms {speedup:10.0f}x")
+
+
+if __name__ == "__main__":
+    main()
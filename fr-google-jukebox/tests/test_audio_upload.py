@@ -0,0 +1,91 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+from app.music.service import audio_upload
+from app.music.service.audio_upload import AudioUpload
+
+
+class FakeWriter:
+    def __init__(self, fail=False):
+        self.fail = fail
+        self.data = b""
+        self.closed = False
+
+    def write(self, data):
+        if self.fail:
+            raise ConnectionError("upload session expired")
+        self.data += data
+
+    def close(self):
+        self.closed = True
+
+
+class FakeStorage:
+    def __init__(self, fail=False, blob=None):
+        self.writer = FakeWriter(fail)
+        self.blob = blob
+        self.cancelled = []
+
+    def open_writer(self, bucket_name, blob_name, content_type=None, chunk_size=None):
+        return self.writer
+
+    def cancel_writer(self, writer):
+        self.cancelled.append(writer)
+
+    def get_blob(self, bucket_name, blob_name):
+        return self.blob
+
+
+async def test_commit_stores_the_track():
+    storage = FakeStorage()
+    upload = AudioUpload(storage, "bucket", "song/output.wav")
+    for chunk in (b"RIFF", b"audio" * 1000):
+        await upload.write(chunk)
+
+    assert await upload.commit()
+    assert storage.writer.data == b"RIFF" + b"audio" * 1000
+    assert storage.writer.closed
+
+
+async def test_failed_upload_is_cancelled_and_reported():
+    storage = FakeStorage(fail=True)
+    upload = AudioUpload(storage, "bucket", "song/output.wav")
+    await upload.write(b"RIFF")
+    await asyncio.sleep(0.1)
+    # the rest of the track isn't spooled for an upload that can't happen
+    await upload.write(b"audio" * 1000)
+    assert upload.size == 4
+
+    assert not await upload.commit()
+    assert storage.cancelled == [storage.writer]
+    assert not storage.writer.closed
+
+
+async def test_abort_does_not_finalize_the_upload():
+    storage = FakeStorage()
+    upload = AudioUpload(storage, "bucket", "song/output.wav")
+    await upload.write(b"RIFF")
+    await upload.abort()
+
+    assert storage.cancelled == [storage.writer]
+    assert not storage.writer.closed
+
+
+async def test_backend_upload_is_waited_for():
+    now = datetime.now(timezone.utc)
+    storage = FakeStorage(blob=SimpleNamespace(time_created=now + timedelta(seconds=5)))
+    upload = AudioUpload(storage, "bucket", "song/output.wav")
+    upload.stored_by_backend = True
+    assert await upload.commit()
+
+
+async def test_earlier_backend_upload_does_not_count(monkeypatch):
+    monkeypatch.setattr(audio_upload, "BACKEND_COMMIT_TIMEOUT_S", 0.05)
+    monkeypatch.setattr(audio_upload, "BACKEND_COMMIT_POLL_S", 0.01)
+    # the track of an earlier generation of the song
+    stored_at = datetime.now(timezone.utc) - timedelta(minutes=5)
+    storage = FakeStorage(blob=SimpleNamespace(time_created=stored_at))
+    upload = AudioUpload(storage, "bucket", "song/output.wav")
+    upload.stored_by_backend = True
+    assert not await upload.commit()
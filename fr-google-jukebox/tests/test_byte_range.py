@@ -0,0 +1,66 @@
+import pytest
+
+from app.music.service.byte_range import (
+    WAV_HEADER_SIZE,
+    parse_range,
+    patch_wav_sizes,
+    wav_byte_rate,
+)
+from app.music.service.pcm import wav_header
+
+
+@pytest.mark.parametrize(
+    "range_header, expected",
+    [
+        ("bytes=0-99", (0, 99)),
+        ("bytes=100-", (100, 999)),
+        ("bytes=500-5000", (500, 999)),
+        ("bytes=999-999", (999, 999)),
+        ("bytes=-100", (900, 999)),
+        ("bytes=-5000", (0, 999)),
+        (" bytes = 10-20 ", (10, 20)),
+    ],
+)
+def test_parse_range(range_header, expected):
+    assert parse_range(range_header, 1000) == expected
+
+
+@pytest.mark.parametrize(
+    "range_header",
+    ["items=0-99", "bytes=0-99,200-299", "bytes=abc-", "bytes=0-x", "bytes=", "bytes"],
+)
+def test_parse_range_falls_back_to_the_whole_object(range_header):
+    assert parse_range(range_header, 1000) is None
+
+
+@pytest.mark.parametrize("range_header", ["bytes=1000-", "bytes=1000-2000", "bytes=50-10"])
+def test_parse_range_unsatisfiable(range_header):
+    with pytest.raises(ValueError):
+        parse_range(range_header, 1000)
+
+
+def test_patch_wav_sizes():
+    data = wav_header(32000) + bytes(100)
+    patched = patch_wav_sizes(data, 0, 10_044)
+    assert int.from_bytes(patched[4:8], "little") == 10_044 - 8
+    assert int.from_bytes(patched[40:44], "little") == 10_000
+    # only the sizes change
+    assert patched[:4] == data[:4]
+    assert patched[8:40] == data[8:40]
+    assert patched[WAV_HEADER_SIZE:] == data[WAV_HEADER_SIZE:]
+
+
+def test_patch_wav_sizes_leaves_other_data_alone():
+    data = wav_header(32000) + bytes(100)
+    # a range starting after the header
+    assert patch_wav_sizes(data[50:], 50, 10_044) == data[50:]
+    # a range ending inside the header
+    assert patch_wav_sizes(data[:20], 0, 10_044) == data[:20]
+    # not a WAV
+    assert patch_wav_sizes(b"ID3" + bytes(100), 0, 10_044) == b"ID3" + bytes(100)
+
+
+def test_wav_byte_rate():
+    assert wav_byte_rate(wav_header(32000, 2, "int24")) == 32000 * 2 * 3
+    assert wav_byte_rate(wav_header(32000)[:20]) is None
+    assert wav_byte_rate(b"ID3" + bytes(100)) is None
@@ -0,0 +1,70 @@
+from google.auth.credentials import AnonymousCredentials
+from google.cloud.storage import Client
+from requests.structures import CaseInsensitiveDict
+
+from app.core.google_cloud.cloud_storage import CloudStorageService
+
+SESSION_URL = "https://storage.googleapis.com/upload/session"
+CHUNK_SIZE = 256 * 1024
+
+
+class FakeResponse:
+    def __init__(self, status_code, headers=None):
+        self.status_code = status_code
+        self.headers = CaseInsensitiveDict(headers or {})
+        self.content = b""
+
+
+class FakeTransport:
+    """Answers the requests of a resumable upload the way GCS does."""
+
+    is_mtls = False
+
+    def __init__(self):
+        self.requests = []
+
+    def request(self, method, url, data=None, headers=None, **kwargs):
+        self.requests.append((method, url))
+        if method == "POST":
+            return FakeResponse(200, {"location": SESSION_URL})
+        if method == "PUT":
+            # the chunk is stored, the upload goes on
+            return FakeResponse(308, {"range": f"bytes=0-{CHUNK_SIZE - 1}"})
+        return FakeResponse(499)
+
+
+def storage_service(transport):
+    client = Client(project="test", credentials=AnonymousCredentials())
+    client._http_internal = transport
+    service = CloudStorageService()
+    service._client = client
+    return service
+
+
+def test_cancelled_writer_deletes_its_upload_session():
+    # drives a real BlobWriter: fails if the internals cancel_writer relies on change
+    transport = FakeTransport()
+    service = storage_service(transport)
+    writer = service.open_writer("bucket", "song/output.wav", chunk_size=CHUNK_SIZE)
+    writer.write(b"a" * (CHUNK_SIZE + 10))
+    assert [method for method, _ in transport.requests] == ["POST", "PUT"]
+
+    service.cancel_writer(writer)
+    writer.close()
+    del writer
+
+    # the rest of the track is never sent, which would have finalized the upload
+    assert transport.requests[2:] == [("DELETE", SESSION_URL)]
+
+
+def test_cancelled_writer_without_a_session_sends_nothing():
+    transport = FakeTransport()
+    service = storage_service(transport)
+    writer = service.open_writer("bucket", "song/output.wav", chunk_size=CHUNK_SIZE)
+    writer.write(b"RIFF")
+
+    service.cancel_writer(writer)
+    writer.close()
+
+    assert writer.closed
+    assert transport.requests == []
@@ -0,0 +1,122 @@
+import asyncio
+
+import pytest
+
+from app.core.config import settings
+from app.music.service.job_store import JobStore
+
+
+class RecordingJobStore(JobStore):
+    def __init__(self):
+        super().__init__()
+        self.saved = []
+
+    async def save(self, job):
+        self.saved.append((job.status, job.progress))
+
+
+async def test_update_replaces_the_job():
+    store = RecordingJobStore()
+    created = await store.create("song", "Jazz")
+    updated = await store.update("song", status="generating", progress=5.0)
+
+    assert created.status == "queued"
+    assert updated.status == "generating"
+    assert updated.progress == 5.0
+    assert updated.updated_at >= created.updated_at
+    assert await store.get("song") is updated
+    assert store.running("song")
+
+
+async def test_update_wakes_the_watchers_up():
+    store = JobStore()
+    await store.create("song", "Jazz")
+    changed = store.changed["song"]
+
+    await store.update("song", progress=1.0)
+    assert changed.is_set()
+    # the next update gets a new event
+    assert not store.changed["song"].is_set()
+
+
+async def test_update_saves_status_changes_and_every_10_percent():
+    store = RecordingJobStore()
+    await store.create("song", "Jazz")
+    await store.update("song", status="generating")
+    for progress in (3.0, 9.0, 10.0, 15.0, 42.0, 49.0):
+        await store.update("song", progress=progress)
+    await store.update("song", status="done", progress=100.0)
+
+    assert store.saved == [
+        ("queued", 0.0),
+        ("generating", 0.0),
+        ("generating", 10.0),
+        ("generating", 42.0),
+        ("done", 100.0),
+    ]
+    assert not store.running("song")
+
+
+async def test_watch_yields_every_change_until_the_job_is_finished():
+    store = JobStore()
+    await store.create("song", "Jazz")
+    watcher = store.watch("song")
+
+    assert (await anext(watcher)).status == "queued"
+    await store.update("song", status="generating", progress=50.0)
+    assert (await anext(watcher)).progress == 50.0
+    await store.update("song", status="uploading", progress=100.0)
+    assert (await anext(watcher)).status == "uploading"
+    await store.update("song", status="done", audio="gs://bucket/song.wav")
+    assert (await anext(watcher)).audio == "gs://bucket/song.wav"
+    with pytest.raises(StopAsyncIteration):
+        await anext(watcher)
+
+
+async def test_watch_sees_the_updates_made_while_it_waits():
+    store = JobStore()
+    await store.create("song", "Jazz")
+
+    async def generate():
+        for progress in (25.0, 50.0, 75.0):
+            await asyncio.sleep(0.01)
+            await store.update("song", status="generating", progress=progress)
+        await asyncio.sleep(0.01)
+        await store.update("song", status="failed", error="boom")
+
+    task = asyncio.create_task(generate())
+    jobs = [job async for job in store.watch("song")]
+    await task
+
+    assert [job.progress for job in jobs] == [0.0, 25.0, 50.0, 75.0, 75.0]
+    assert jobs[-1].status == "failed"
+    assert jobs[-1].error == "boom"
+
+
+async def test_watch_keeps_the_connection_alive(monkeypatch):
+    monkeypatch.setattr(settings, "JOB_KEEPALIVE_S", 0.01)
+    store = JobStore()
+    await store.create("song", "Jazz")
+    watcher = store.watch("song")
+
+    assert (await anext(watcher)).status == "queued"
+    assert await anext(watcher) is None
+    await watcher.aclose()
+
+
+async def test_watch_unknown_job():
+    store = JobStore()
+    assert [job async for job in store.watch("song", "Jazz")] == []
+
+
+async def test_finished_jobs_are_forgotten(monkeypatch):
+    monkeypatch.setattr(settings, "JOB_TTL_S", 0.0)
+    store = JobStore()
+    await store.create("running", "Jazz")
+    await store.create("finished", "Jazz")
+    await store.update("finished", status="done")
+    await asyncio.sleep(0.01)
+
+    await store.create("new", "Jazz")
+    assert set(store.jobs) == {"running", "new"}
+    assert set(store.changed) == {"running", "new"}
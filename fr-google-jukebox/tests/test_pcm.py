@@ -0,0 +1,118 @@
+import wave
+from io import BytesIO
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+from app.music.service.pcm import STREAMING_DATA_SIZE, PcmEncoder, wav_header
+
+
+def test_int16_scales_and_clips():
+    encoder = PcmEncoder("int16")
+    data = encoder.encode(np.array([0.0, 0.5, 1.0, -1.0, 2.0, -2.0], dtype=np.float32))
+    assert np.frombuffer(data, dtype="<i2").tolist() == [0, 16384, 32767, -32767, 32767, -32768]
+
+
+def test_int24_keeps_the_three_low_bytes():
+    encoder = PcmEncoder("int24")
+    data = encoder.encode(np.array([0.0, 1.0, -1.0, -2.0], dtype=np.float32))
+    assert len(data) == 4 * 3
+    samples = [int.from_bytes(data[i : i + 3], "little", signed=True) for i in range(0, 12, 3)]
+    assert samples == [0, 8388607, -8388607, -8388608]
+
+
+def test_float32_is_only_clipped():
+    encoder = PcmEncoder("float32", dither=True)
+    data = encoder.encode(np.array([0.25, -0.75, 1.5], dtype=np.float32))
+    assert np.frombuffer(data, dtype="<f4").tolist() == [0.25, -0.75, 1.0]
+
+
+def test_stereo_interleaves_the_channels():
+    encoder = PcmEncoder("int16", channels=2)
+    audio = np.array([[0.0, 0.5], [1.0, -1.0]], dtype=np.float32)
+    data = encoder.encode(audio)
+    assert np.frombuffer(data, dtype="<i2").tolist() == [0, 32767, 16384, -32767]
+
+
+def test_stereo_duplicates_mono_audio():
+    encoder = PcmEncoder("int16", channels=2)
+    data = encoder.encode(np.array([0.5, -0.5], dtype=np.float32))
+    assert np.frombuffer(data, dtype="<i2").tolist() == [16384, 16384, -16384, -16384]
+
+
+def test_rejects_other_channel_counts():
+    with pytest.raises(ValueError):
+        PcmEncoder("int16", channels=3)
+    with pytest.raises(ValueError):
+        PcmEncoder("int16", channels=2).encode(np.zeros((3, 4), dtype=np.float32))
+
+
+def test_rejects_unknown_sample_formats():
+    with pytest.raises(ValueError):
+        PcmEncoder("int8")
+    with pytest.raises(ValueError):
+        wav_header(32000, sample_format="int8")
+
+
+def test_reused_buffers_only_return_the_current_chunk():
+    encoder = PcmEncoder("int16")
+    encoder.encode(np.full(100, 0.5, dtype=np.float32))
+    data = encoder.encode(np.array([1.0, -1.0], dtype=np.float32))
+    assert np.frombuffer(data, dtype="<i2").tolist() == [32767, -32767]
+
+
+def test_dither_stays_within_one_lsb():
+    audio = np.linspace(-0.9, 0.9, 1000, dtype=np.float32)
+    plain = np.frombuffer(PcmEncoder("int16").encode(audio), dtype="<i2").astype(int)
+    dithered = PcmEncoder("int16", dither=True, seed=0).encode(audio)
+    dithered = np.frombuffer(dithered, dtype="<i2").astype(int)
+    assert np.abs(dithered - plain).max() <= 1
+    assert (dithered != plain).any()
+
+
+def test_dither_is_reproducible_with_a_seed():
+    audio = np.linspace(-0.9, 0.9, 1000, dtype=np.float32)
+    first = PcmEncoder("int24", dither=True, seed=1).encode(audio)
+    second = PcmEncoder("int24", dither=True, seed=1).encode(audio)
+    assert first == second
+
+
+@pytest.mark.parametrize("channels", [1, 2])
+@pytest.mark.parametrize("sample_format", ["int16", "int24"])
+def test_wav_header_is_read_back_by_the_wave_module(sample_format, channels):
+    encoder = PcmEncoder(sample_format, channels=channels)
+    data = encoder.encode(np.linspace(-1, 1, 320, dtype=np.float32))
+    header = wav_header(32000, channels, sample_format, data_size=len(data))
+    assert len(header) == 44
+
+    with wave.open(BytesIO(header + data)) as wav:
+        assert wav.getframerate() == 32000
+        assert wav.getnchannels() == channels
+        assert wav.getsampwidth() == encoder.sample_width
+        assert wav.getnframes() == 320
+        assert wav.readframes(320) == data
+
+
+def test_wav_header_float32():
+    header = wav_header(48000, 2, "float32", data_size=800)
+    assert int.from_bytes(header[20:22], "little") == 3
+    assert int.from_bytes(header[28:32], "little") == 48000 * 2 * 4
+    assert int.from_bytes(header[32:34], "little") == 8
+    assert int.from_bytes(header[34:36], "little") == 32
+    assert int.from_bytes(header[40:44], "little") == 800
+
+
+def test_wav_header_of_a_stream():
+    header = wav_header(32000)
+    assert int.from_bytes(header[4:8], "little") == STREAMING_DATA_SIZE + 36
+    assert int.from_bytes(header[40:44], "little") == STREAMING_DATA_SIZE
+
+
+def test_copies_are_the_same():
+    backend = Path(__file__).parents[1] / "app" / "music" / "service" / "pcm.py"
+    service = Path(__file__).parents[2] / "fr-google-jukebox-musicgen" / "service" / "pcm.py"
+    if not service.exists():
+        pytest.skip("the MusicGen service isn't checked out next to the backend")
+    # the first two lines point to the other copy
+    assert backend.read_bytes().splitlines()[2:] == service.read_bytes().splitlines()[2:]